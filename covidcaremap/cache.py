@@ -0,0 +1,407 @@
+"""
+Persistent on-disk cache for remote data sources.
+
+Downloads are stored once per distinct content (keyed by SHA-256) under
+data/local/http-cache, and are revalidated against the remote server with
+ETag / Last-Modified conditional requests once their TTL has passed.
+Several sources can be fetched concurrently with DownloadCache.fetch_all.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+
+from covidcaremap.data import local_data_path
+
+# Seconds a cached download is considered fresh before it is revalidated.
+DEFAULT_TTL = 60 * 60
+
+# Maximum total size of cached downloads before least recently used
+# entries are evicted.
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+# Set this environment variable to any non-empty value to only serve
+# previously cached downloads and never touch the network.
+OFFLINE_ENV_VAR = 'COVID19_OFFLINE'
+
+# Seconds after its last use during which a download is never evicted, so
+# that a path just returned by fetch stays valid until the caller opens it.
+DEFAULT_EVICTION_GRACE = 60
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Number of times a failed request or interrupted download is retried,
+# and the base delay in seconds for the exponential backoff between tries.
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+def offline_from_env():
+    return bool(os.environ.get(OFFLINE_ENV_VAR))
+
+class DownloadCache:
+    """Content-addressed download cache with conditional-GET revalidation.
+
+    Args:
+        cache_dir: Directory to store downloads in. Defaults to data/local/http-cache.
+        ttl: Seconds for which a download is served without contacting the server.
+            Use 0 to always revalidate, None to never revalidate.
+        max_bytes: Size bound for the cache. Least recently used downloads are
+            evicted when it is exceeded.
+        eviction_grace: Seconds after its last use during which a download is
+            kept even if the cache is over max_bytes. Paths returned by fetch
+            and fetch_all stay valid for at least this long, even while other
+            threads fetch and evict.
+        offline: If True, serve the last good copy of each download and fail
+            for anything that has not been cached. Defaults to the value of
+            the COVID19_OFFLINE environment variable.
+        session: Optional requests.Session to make all requests with. By default
+            a pooled session is kept per host.
+        retries: Number of retries for failed requests and interrupted downloads.
+        backoff: Base delay in seconds between retries, doubled on every retry.
+        timeout: Timeout in seconds for connecting and for each read.
+        pool_size: Maximum number of pooled connections per host.
+    """
+    INDEX_FILE = 'index.json'
+    BLOB_DIR = 'blobs'
+    PARTIAL_DIR = 'partial'
+
+    def __init__(self,
+                 cache_dir=None,
+                 ttl=DEFAULT_TTL,
+                 max_bytes=DEFAULT_MAX_BYTES,
+                 eviction_grace=DEFAULT_EVICTION_GRACE,
+                 offline=None,
+                 session=None,
+                 retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF,
+                 timeout=60,
+                 pool_size=8):
+        if cache_dir is None:
+            cache_dir = local_data_path('http-cache')
+        if offline is None:
+            offline = offline_from_env()
+
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.eviction_grace = eviction_grace
+        self.offline = offline
+        self.session = session
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.pool_size = pool_size
+
+        self._sessions = {}
+        self._lock = threading.RLock()
+        os.makedirs(os.path.join(self.cache_dir, self.BLOB_DIR), exist_ok=True)
+        os.makedirs(os.path.join(self.cache_dir, self.PARTIAL_DIR), exist_ok=True)
+
+    ## Index handling
+
+    def _index_path(self):
+        return os.path.join(self.cache_dir, self.INDEX_FILE)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.cache_dir, self.BLOB_DIR, digest)
+
+    def _read_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self._index_path())
+
+    def _update_entry(self, url, **values):
+        with self._lock:
+            index = self._read_index()
+            entry = index.setdefault(url, {})
+            entry.update(values)
+            entry['accessed_at'] = time.time()
+            self._write_index(index)
+            return entry
+
+    def get_entry(self, url):
+        """Returns the index entry for a URL, or None if the URL
+        has no usable cached copy."""
+        entry = self._read_index().get(url)
+        if entry is None or not os.path.exists(self._blob_path(entry['sha256'])):
+            return None
+        return entry
+
+    ## Fetching
+
+    def _session_for(self, url):
+        """Returns the pooled session for the URL's host, so concurrent
+        fetches against one host reuse its connections."""
+        if self.session is not None:
+            return self.session
+
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                        pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[host] = session
+            return self._sessions[host]
+
+    def _get(self, url, headers):
+        """Makes a streaming GET request, retrying connection errors and
+        server errors with exponential backoff."""
+        attempt = 0
+        while True:
+            try:
+                r = self._session_for(url).get(url,
+                                               headers=headers,
+                                               stream=True,
+                                               timeout=self.timeout)
+                if r.status_code < 500 or attempt >= self.retries:
+                    return r
+                r.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    def fetch(self, url, ttl=None):
+        """Returns the local path of the cached content for url,
+        downloading or revalidating it if necessary.
+
+        Args:
+            url: URL to fetch.
+            ttl: Override for this cache's TTL.
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        entry = self.get_entry(url)
+
+        if self.offline:
+            if entry is None:
+                raise Exception('{} is not cached and offline mode is enabled'.format(url))
+            return self._hit(url, entry)
+
+        if entry is not None and ttl is not None and time.time() - entry['validated_at'] < ttl:
+            return self._hit(url, entry)
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        headers.update(self._resume_headers(url))
+
+        try:
+            r = self._get(url, headers)
+            if r.status_code == 416 and 'Range' in headers:
+                # The partial download can't be continued, e.g. because it is
+                # already complete. Start over with a full download.
+                r.close()
+                self._discard_partial(url)
+                for header in ['Range', 'If-Range']:
+                    del headers[header]
+                r = self._get(url, headers)
+        except requests.RequestException as e:
+            if entry is None:
+                raise
+            warnings.warn('Could not reach {} ({}); using cached copy'.format(url, e))
+            return self._hit(url, entry)
+
+        with r:
+            if r.status_code == 304 and entry is not None:
+                self._update_entry(url, validated_at=time.time())
+                return self._blob_path(entry['sha256'])
+
+            if r.status_code not in (200, 206) and entry is not None:
+                warnings.warn('Got HTTP {} for {}; using cached copy'.format(r.status_code, url))
+                return self._hit(url, entry)
+
+            r.raise_for_status()
+            return self._store(url, r)
+
+    def fetch_all(self, urls, max_workers=8):
+        """Fetches several URLs concurrently.
+
+        Wall-clock time is bounded by the slowest download rather than
+        the sum of all of them.
+
+        Args:
+            urls: URLs to fetch.
+            max_workers: Maximum number of concurrent downloads.
+
+        Returns:
+            Dict of url -> local path of the cached content.
+        """
+        urls = list(dict.fromkeys(urls))
+        if not urls:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(urls))) as executor:
+            paths = executor.map(self.fetch, urls)
+            return dict(zip(urls, paths))
+
+    def _hit(self, url, entry):
+        self._update_entry(url)
+        return self._blob_path(entry['sha256'])
+
+    ## Downloading
+
+    def _partial_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, self.PARTIAL_DIR, key)
+
+    def _resume_headers(self, url):
+        """Headers to continue a partial download of url left by an
+        interrupted earlier attempt, if there is one."""
+        part_path = self._partial_path(url)
+        try:
+            with open(part_path + '.json') as f:
+                validator = json.load(f).get('validator')
+            offset = os.path.getsize(part_path)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+        if not validator or not offset:
+            return {}
+        # If-Range makes the server send the whole body if the resource changed.
+        return {'Range': 'bytes={}-'.format(offset), 'If-Range': validator}
+
+    def _discard_partial(self, url):
+        """Removes the partial download of url, if there is one."""
+        part_path = self._partial_path(url)
+        for path in [part_path, part_path + '.json']:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _store(self, url, response):
+        """Streams a response body into the blob store and records it in the index.
+
+        Interrupted transfers are retried with a Range request that continues
+        from the bytes already on disk, as long as the server supports it.
+        """
+        part_path = self._partial_path(url)
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        with open(part_path + '.json', 'w') as f:
+            json.dump({'validator': etag or last_modified}, f)
+
+        attempt = 0
+        while True:
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            try:
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                break
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                response.close()
+                if attempt >= self.retries:
+                    raise
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+                response = self._get(url, self._resume_headers(url))
+                if response.status_code == 416:
+                    # Can't continue from what is on disk; download it all again.
+                    response.close()
+                    os.remove(part_path)
+                    response = self._get(url, {})
+                response.raise_for_status()
+
+        response.close()
+
+        digest = hashlib.sha256()
+        size = 0
+        with open(part_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        sha256 = digest.hexdigest()
+
+        with self._lock:
+            os.replace(part_path, self._blob_path(sha256))
+            os.remove(part_path + '.json')
+            self._update_entry(url,
+                               sha256=sha256,
+                               size=size,
+                               etag=etag,
+                               last_modified=last_modified,
+                               validated_at=time.time())
+            self.evict()
+        return self._blob_path(sha256)
+
+    ## Eviction
+
+    def evict(self, max_bytes=None):
+        """Removes least recently used downloads until the cache
+        fits within max_bytes (defaults to this cache's max_bytes).
+
+        Downloads used within eviction_grace seconds are kept, so the cache
+        can stay over max_bytes until they age out.
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        with self._lock:
+            index = self._read_index()
+
+            def total_size(entries):
+                # Identical content is stored once, so count each blob once.
+                return sum(dict((e['sha256'], e['size']) for e in entries.values()).values())
+
+            by_access = sorted(index, key=lambda url: index[url]['accessed_at'])
+            recently_used = time.time() - self.eviction_grace
+            # Always keep the most recently used entry
+            for url in by_access[:-1]:
+                if total_size(index) <= max_bytes or index[url]['accessed_at'] >= recently_used:
+                    break
+                del index[url]
+
+            self._write_index(index)
+
+            referenced = set(e['sha256'] for e in index.values())
+            blob_dir = os.path.join(self.cache_dir, self.BLOB_DIR)
+            for digest in os.listdir(blob_dir):
+                if digest not in referenced:
+                    os.remove(os.path.join(blob_dir, digest))
+
+    def clear(self):
+        """Removes all cached downloads."""
+        with self._lock:
+            self._write_index({})
+            self.evict()
+
+_default_cache = None
+
+def get_default_cache():
+    """Returns the process-wide DownloadCache, creating it on first use."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = DownloadCache()
+    return _default_cache
+
+def set_default_cache(cache):
+    """Replace the process-wide DownloadCache, e.g. to change the TTL,
+    size bound or offline mode for all fetches."""
+    global _default_cache
+    _default_cache = cache
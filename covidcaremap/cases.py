@@ -1,7 +1,13 @@
+import os
+
 import pandas as pd
 
-from covidcaremap.data import external_data_path, processed_data_path
-from covidcaremap.util import fetch_df
+from covidcaremap.data import (external_data_path,
+                               processed_data_path,
+                               local_data_path,
+                               read_us_counties_gdf)
+from covidcaremap.cache import get_default_cache
+from covidcaremap.util import fetch_df, fetch_csv_columns
 
 import geopandas as gpd
 
@@ -27,30 +33,55 @@ def get_nytimes_cases_by_county():
 def get_nytimes_cases_by_state():
     return fetch_df(NYTIMES_STATE_URL)
 
-def get_county_case_info(date=None):
+def get_county_case_info(date=None, store=None):
     """Generates confirmed cases and deaths information per county, merged with population data
     in a geodataframe. This pulls from the latest files at
     https://usafacts.org/visualizations/coronavirus-covid-19-spread-map/
 
     Args:
         date: Date in MM/DD/YY format (same as USAFacts column names). Use None to get latest.
+        store: Optional USAFacts CaseStore. If given, case information is read from the
+            store's partition for the date rather than from the remote files.
     """
+    if store is not None:
+        county_cases = _get_county_case_info_from_store(store, date)
+    else:
+        county_cases = _get_county_case_info_from_usafacts(date)
+
+    # Read in processed pop data. Requires that the notebook to generate has been run
+    # "Merge Region and Census Data"
+    counties = read_us_counties_gdf()
+    counties['countyFIPS'] = counties['COUNTY_FIPS'].astype(int)
+
+    return counties.merge(county_cases, on='countyFIPS').drop(columns=['countyFIPS'])
+
+def prefetch_usafacts():
+    """Downloads the USAFacts cases and deaths files concurrently into the download cache."""
+    get_default_cache().fetch_all([USAFACTS_CASES_URL, USAFACTS_DEATHS_URL])
+
+def _get_county_case_info_from_usafacts(date):
+    prefetch_usafacts()
+
+    id_columns = ['countyFIPS', 'County Name', 'State', 'stateFIPS']
+
     def get_latest_case_info(url, column_name):
-        df = fetch_df(url)
-        col = df.columns[-1]
+        # Read the header first so that only the ID columns and the single
+        # requested date column are parsed out of the wide CSV.
+        columns = fetch_csv_columns(url)
+        last_updated = columns[-1]
+        col = last_updated
         if date is not None:
-            if not date in df.columns:
+            if not date in columns:
                 raise Exception('Date {} not in dataset or not in proper format'.format(date))
             col = date
+        df = fetch_df(url,
+                      usecols=id_columns + [col],
+                      dtype={'County Name': str, 'State': str})
         per_county_counts = df[col]
-        df['{} Last Updated'.format(column_name)] = df.columns[-1]
+        df['{} Last Updated'.format(column_name)] = last_updated
         df[column_name] = per_county_counts
         return df[
-            [
-                'countyFIPS',
-                'County Name',
-                'State',
-                'stateFIPS',
+            id_columns + [
                 column_name,
                 '{} Last Updated'.format(column_name)
             ]
@@ -64,7 +95,7 @@ def get_county_case_info(date=None):
         USAFACTS_DEATHS_URL,
         'Deaths')
 
-    county_cases = latest_confirmed[
+    return latest_confirmed[
         ['countyFIPS',
          'Confirmed Cases',
          'Confirmed Cases Last Updated'
@@ -76,9 +107,248 @@ def get_county_case_info(date=None):
         ]
     ])
 
-    # Read in processed pop data. Requires that the notebook to generate has been run
-    # "Merge Region and Census Data"
-    counties = gpd.read_file(processed_data_path('us_counties_with_pop.geojson'))
-    counties['countyFIPS'] = counties['COUNTY_FIPS'].astype(int)
+def _get_county_case_info_from_store(store, date):
+    as_of_date = None
+    if date is not None:
+        as_of_date = pd.to_datetime(date, format='%m/%d/%y')
 
-    return counties.merge(county_cases, on='countyFIPS').drop(columns=['countyFIPS'])
+    latest = store.as_of(as_of_date)
+    if latest.empty or (as_of_date is not None and latest['date'].max() != as_of_date):
+        raise Exception('Date {} not in dataset or not in proper format'.format(date))
+
+    last_updated = format_usafacts_date(store.last_date())
+    return pd.DataFrame({
+        'countyFIPS': latest['fips'].values,
+        'Confirmed Cases': latest['cases'].values,
+        'Confirmed Cases Last Updated': last_updated,
+        'Deaths': latest['deaths'].values,
+        'Deaths Last Updated': last_updated
+    })
+
+## Long-format case store
+
+USAFACTS = 'usafacts'
+NYTIMES = 'nytimes'
+
+def parse_usafacts_date_columns(columns):
+    """Returns a dict of column name -> Timestamp for the date columns of a
+    wide USAFacts CSV. Non-date (ID) columns are left out."""
+    result = {}
+    for column in columns:
+        for fmt in ('%m/%d/%y', '%Y-%m-%d'):
+            try:
+                result[column] = pd.to_datetime(column, format=fmt)
+                break
+            except ValueError:
+                pass
+    return result
+
+def format_usafacts_date(date):
+    """Formats a date the way USAFacts names its date columns, e.g. 4/3/20"""
+    return '{}/{}/{}'.format(date.month, date.day, date.strftime('%y'))
+
+def usafacts_to_long(cases_df, deaths_df):
+    """Converts the wide USAFacts cases and deaths tables (one column per day)
+    into a long (fips, date, cases, deaths) table.
+
+    "Statewide Unallocated" rows, which USAFacts gives a countyFIPS of 0,
+    are assigned the state-level FIPS code (stateFIPS * 1000).
+    """
+    def melt(df, value_name):
+        dates = parse_usafacts_date_columns(df.columns)
+        fips = df['countyFIPS'].where(df['countyFIPS'] != 0, df['stateFIPS'] * 1000)
+        long_df = df[list(dates)].assign(fips=fips.astype('int64')) \
+                                 .melt(id_vars='fips', var_name='date', value_name=value_name)
+        long_df['date'] = long_df['date'].map(dates)
+        return long_df.groupby(['fips', 'date'], as_index=False)[value_name].sum()
+
+    return melt(cases_df, 'cases').merge(melt(deaths_df, 'deaths'),
+                                         on=['fips', 'date'],
+                                         how='outer')
+
+def nytimes_to_long(df):
+    """Converts the NYTimes county table into a long (fips, date, cases, deaths) table,
+    dropping rows that are not attributed to a county FIPS code."""
+    df = df[df['fips'].notnull()]
+    return pd.DataFrame({
+        'fips': df['fips'].astype('int64').values,
+        'date': pd.to_datetime(df['date']).values,
+        'cases': df['cases'].values,
+        'deaths': df['deaths'].values
+    })
+
+class CaseStore:
+    """Long-format (fips, date, cases, deaths) store of county case data.
+
+    Data is kept in one Parquet file per calendar month, so that adding a day
+    only rewrites the current month and date queries only read the months
+    they cover.
+
+    Args:
+        source: The case data source, USAFACTS or NYTIMES.
+        root: Directory to store partitions in. Defaults to data/local/case-store/<source>.
+    """
+    COLUMNS = ['fips', 'date', 'cases', 'deaths']
+
+    def __init__(self, source=USAFACTS, root=None):
+        if source not in (USAFACTS, NYTIMES):
+            raise Exception('Unknown case data source {}'.format(source))
+        if root is None:
+            root = local_data_path(os.path.join('case-store', source))
+        os.makedirs(root, exist_ok=True)
+
+        self.source = source
+        self.root = root
+
+    @staticmethod
+    def month_of(date):
+        return date.strftime('%Y-%m')
+
+    def _partition_path(self, month):
+        return os.path.join(self.root, '{}.parquet'.format(month))
+
+    def partitions(self):
+        """Returns the sorted months (YYYY-MM) that have data in the store."""
+        return sorted(f[:-len('.parquet')]
+                      for f in os.listdir(self.root)
+                      if f.endswith('.parquet'))
+
+    def _read_partition(self, month, columns=None):
+        return pd.read_parquet(self._partition_path(month), columns=columns)
+
+    def last_date(self):
+        """Returns the most recent date in the store, or None if it is empty."""
+        partitions = self.partitions()
+        if not partitions:
+            return None
+        return self._read_partition(partitions[-1], columns=['date'])['date'].max()
+
+    def append(self, df):
+        """Appends long-format rows that are newer than the store's last date.
+
+        Returns:
+            The number of rows appended.
+        """
+        df = df[self.COLUMNS]
+        if df.empty:
+            return 0
+        last_date = self.last_date()
+        if last_date is not None:
+            df = df[df['date'] > last_date]
+        if df.empty:
+            return 0
+
+        for month, month_df in df.groupby(df['date'].dt.strftime('%Y-%m')):
+            path = self._partition_path(month)
+            if os.path.exists(path):
+                month_df = pd.concat([self._read_partition(month), month_df])
+            month_df.sort_values(['date', 'fips']) \
+                    .reset_index(drop=True) \
+                    .to_parquet(path, index=False)
+
+        return len(df)
+
+    def update(self):
+        """Pulls any dates newer than the store's last date from the source.
+
+        For USAFacts, only the new date columns of the wide CSVs are parsed.
+
+        Returns:
+            The number of rows appended.
+        """
+        last_date = self.last_date()
+
+        def is_new(date):
+            return last_date is None or date > last_date
+
+        if self.source == USAFACTS:
+            prefetch_usafacts()
+
+            def fetch_new(url):
+                dates = parse_usafacts_date_columns(fetch_csv_columns(url))
+                new_columns = [c for c, d in dates.items() if is_new(d)]
+                return fetch_df(url, usecols=['countyFIPS', 'stateFIPS'] + new_columns)
+
+            cases = fetch_new(USAFACTS_CASES_URL)
+            deaths = fetch_new(USAFACTS_DEATHS_URL)
+            new_rows = usafacts_to_long(cases, deaths)
+        else:
+            chunks = fetch_df(NYTIMES_COUNTY_URL,
+                              usecols=['date', 'fips', 'cases', 'deaths'],
+                              chunksize=100000)
+            new_rows = pd.concat([nytimes_to_long(chunk) for chunk in chunks])
+            new_rows = new_rows[new_rows['date'].map(is_new)]
+
+        return self.append(new_rows)
+
+    def clear(self):
+        """Removes all partitions, e.g. to rebuild after upstream revisions."""
+        for month in self.partitions():
+            os.remove(self._partition_path(month))
+
+    def read(self, start=None, end=None, fips=None, columns=None):
+        """Reads the rows between start and end dates (inclusive), only touching
+        the monthly partitions that overlap the range.
+
+        Args:
+            start: First date to include. None means the beginning of the store.
+            end: Last date to include. None means the end of the store.
+            fips: Optional list of FIPS codes to filter to.
+            columns: Optional subset of columns to read.
+        """
+        if start is not None:
+            start = pd.Timestamp(start)
+        if end is not None:
+            end = pd.Timestamp(end)
+
+        if columns is not None:
+            columns = list(dict.fromkeys(['fips', 'date'] + list(columns)))
+
+        months = [m for m in self.partitions()
+                  if (start is None or m >= self.month_of(start)) and
+                     (end is None or m <= self.month_of(end))]
+        if not months:
+            return pd.DataFrame(columns=columns or self.COLUMNS)
+
+        df = pd.concat([self._read_partition(m, columns=columns) for m in months],
+                       ignore_index=True)
+        keep = pd.Series(True, index=df.index)
+        if start is not None:
+            keep &= df['date'] >= start
+        if end is not None:
+            keep &= df['date'] <= end
+        if fips is not None:
+            keep &= df['fips'].isin(fips)
+        return df[keep].reset_index(drop=True)
+
+    def as_of(self, date=None):
+        """Returns the latest row per FIPS code on or before date.
+
+        Args:
+            date: The as-of date. None means the store's last date.
+        """
+        months = self.partitions()
+        if date is not None:
+            date = pd.Timestamp(date)
+            months = [m for m in months if m <= self.month_of(date)]
+
+        # Walk back from the most recent partition. A FIPS code keeps the row
+        # from the latest partition it appears in, so codes missing from
+        # recent months (e.g. a county that stopped reporting) are kept.
+        latest = []
+        found = set()
+        for month in reversed(months):
+            df = self._read_partition(month)
+            if date is not None:
+                df = df[df['date'] <= date]
+            df = df[~df['fips'].isin(found)]
+            if not df.empty:
+                latest.append(df.sort_values(['fips', 'date']).groupby('fips').tail(1))
+                found.update(df['fips'].unique())
+
+        if latest:
+            return pd.concat(latest) \
+                     .sort_values('fips') \
+                     .reset_index(drop=True)
+
+        return pd.DataFrame(columns=self.COLUMNS)
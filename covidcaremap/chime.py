@@ -1,13 +1,14 @@
+import hashlib
 import json
+import os
+import tempfile
 from collections import ChainMap
 
+import numpy as np
 import pandas as pd
 
-from penn_chime.parameters import Parameters
-from penn_chime.models import RegionalSirModel
-from penn_chime.utils import RateLos
-
-from covidcaremap.cases import get_county_case_info
+# penn_chime and the case data sources are imported where they are used,
+# so that importing this module for DEFAULT_PARAMS stays cheap.
 
 DEFAULT_PARAMS = {
 
@@ -67,17 +68,25 @@ def params_to_json(p):
         'recovery_days': p.recovery_days
     }
 
-def get_parameters_for_region(region_population,
-                              region_cases,
-                              num_days=60,
-                              param_override=None):
+def get_effective_params(param_override=None):
+    """Returns the CHIME parameters with any overrides applied on top of
+    DEFAULT_PARAMS and the default market share."""
     if param_override is None:
         param_override = {}
 
-    p = dict(ChainMap({
+    return dict(ChainMap(param_override, {
         # Hospital Market Share (0.00001 - 1.0)
         "market_share": 1.0,
+    }, DEFAULT_PARAMS))
 
+def get_parameters_for_region(region_population,
+                              region_cases,
+                              num_days=60,
+                              param_override=None):
+    from penn_chime.parameters import Parameters
+    from penn_chime.utils import RateLos
+
+    p = dict(ChainMap({
         # Currently Known Regional Infections (>=0)
         "known_infected": region_cases,
 
@@ -87,7 +96,7 @@ def get_parameters_for_region(region_population,
         # Seems like a viz thing
         "as_date": False,
 
-    }, DEFAULT_PARAMS, param_override))
+    }, get_effective_params(param_override)))
 
     p['current_hospitalized'] = None # Unused for regional calculation
 
@@ -125,7 +134,11 @@ def get_regional_predictions(
         population_column='Population',
         cases_column='Confirmed Cases',
         num_days=60,
-        region_param_override=None
+        region_param_override=None,
+        engine='chime',
+        workers=None,
+        executor=None,
+        cache=None
 ):
     """Runs a regional CHIME prediction based on region population and case counts.
 
@@ -137,36 +150,489 @@ def get_regional_predictions(
         region_param_override: A dictionary with keys of region IDs and values being
             being a dict of overridding values for the CHIME parameters. This allows
             regional parameters to be supplied by the user per region.
+        engine: 'chime' to run penn_chime's RegionalSirModel for each region, or 'numpy'
+            to advance all regions at once with run_regional_sir.
+        workers: The number of processes to run regions in. Regions are split into
+            balanced chunks, and the result is identical to a serial run.
+            Defaults to running serially.
+        executor: An existing concurrent.futures.Executor to run the chunks
+            of regions in, instead of creating a process pool.
+        cache: Optional ProjectionCache. Regions whose population, cases and effective
+            parameters were projected before are read from the cache, and only the
+            remaining regions are run.
 
     Returns:
         A dataframe with the region_id, day, and projection numbers.
     """
-    def run_row(row):
-        if row[cases_column] <= 0:
-            return None
+    if region_param_override is None:
+        region_param_override = {}
+
+    if engine not in ('chime', 'numpy'):
+        raise Exception('Unknown CHIME engine {}'.format(engine))
+
+    if engine == 'numpy' and cache is None and workers is None and executor is None:
+        return run_regional_sir(regions_df,
+                                region_id_column,
+                                population_column=population_column,
+                                cases_column=cases_column,
+                                num_days=num_days,
+                                region_param_override=region_param_override)
+
+    regions = regions_df[regions_df[cases_column] > 0]
+    tasks = [(population, cases, region_param_override.get(region_id))
+             for region_id, population, cases in zip(regions[region_id_column],
+                                                     regions[population_column],
+                                                     regions[cases_column])]
+
+    run_fn = _run_regions_numpy if engine == 'numpy' else _run_regions
+
+    def run(tasks):
+        if workers is None and executor is None:
+            return run_fn(tasks, num_days)
+        return _run_regions_in_executor(tasks, num_days, workers, executor, run_fn=run_fn)
+
+    if cache is None:
+        results = run(tasks)
+    else:
+        keys = [cache.key(population, cases, num_days, param_override, engine)
+                for population, cases, param_override in tasks]
+        results = [cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, result in zip(missing, run([tasks[i] for i in missing])):
+                cache.put(keys[i], result)
+                results[i] = result
+
+    # Assemble a single frame from the per-region arrays, in region order.
+    columns = results[0][2] if results else PREDICTION_COLUMNS
+    days = np.concatenate([r[0] for r in results]) if results else np.array([], dtype=int)
+    values = (np.concatenate([r[1] for r in results])
+              if results else np.empty((0, len(columns) - 1)))
+    region_ids = np.repeat(regions[region_id_column].values, [len(r[0]) for r in results])
+
+    predictions_by_county = pd.DataFrame(values, columns=columns[1:], index=days)
+    predictions_by_county.insert(0, columns[0], days)
+    predictions_by_county.insert(0, region_id_column, region_ids)
 
-        p = get_parameters_for_region(row[population_column], row[cases_column], num_days=num_days)
+    return predictions_by_county
+
+def _run_regions(tasks, num_days):
+    """Runs RegionalSirModel for each (population, cases, param_override) task.
+
+    Returns a compact (days, values, columns) tuple per region rather than
+    DataFrames, so results are cheap to send back from worker processes.
+    """
+    from penn_chime.models import RegionalSirModel
+
+    results = []
+    for population, cases, param_override in tasks:
+        p = get_parameters_for_region(population,
+                                      cases,
+                                      num_days=num_days,
+                                      param_override=param_override)
         m = RegionalSirModel(p)
         merged = m.dispositions_df.join(m.admits_df.set_index('day'), lsuffix='_total', rsuffix='_admitted')
         merged = merged.join(m.census_df.set_index('day').add_suffix('_census'))
         merged = merged.dropna().round()
-        merged[region_id_column] = row[region_id_column]
 
-        # Reorder columns
-        cols = list(merged.columns.values)
-        cols = cols[-1:] + cols[:-1]
-        merged = merged[cols]
+        columns = list(merged.columns.values)
+        results.append((merged['day'].to_numpy(),
+                        merged.drop(columns=['day']).to_numpy(dtype=float),
+                        columns))
+
+    return results
+
+def _run_regions_numpy(tasks, num_days):
+    """Runs the vectorized SIR engine over the tasks, returning
+    results in the same form as _run_regions."""
+    overrides = dict((i, task[2]) for i, task in enumerate(tasks) if task[2])
+    params = get_region_param_arrays(np.arange(len(tasks)), overrides)
+    values, valid = sir_projection_arrays([task[0] for task in tasks],
+                                          [task[1] for task in tasks],
+                                          num_days,
+                                          params)
+    return [(np.nonzero(valid[i])[0], values[i][valid[i]], PREDICTION_COLUMNS)
+            for i in range(len(tasks))]
+
+def _run_regions_in_executor(tasks, num_days, workers=None, executor=None, run_fn=_run_regions):
+    """Splits the tasks into balanced chunks and runs them with run_fn in a
+    process pool (or the given executor). Results are returned in task order."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # A few chunks per worker keeps workers busy without much pickling overhead.
+    # Every region projects the same number of days, so equal sized chunks
+    # are balanced.
+    n_chunks = max(1, min(len(tasks), workers * 4))
+    bounds = np.linspace(0, len(tasks), n_chunks + 1).astype(int)
+    chunks = [tasks[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def run(executor):
+        results = []
+        for chunk_results in executor.map(run_fn, chunks, [num_days] * len(chunks)):
+            results.extend(chunk_results)
+        return results
+
+    if executor is not None:
+        return run(executor)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return run(executor)
+
+## Vectorized SIR engine
+
+DISPOSITIONS = ['hospitalized', 'icu', 'ventilated']
+
+PREDICTION_COLUMNS = (['day'] +
+                      ['{}_total'.format(d) for d in DISPOSITIONS] +
+                      ['{}_admitted'.format(d) for d in DISPOSITIONS] +
+                      ['{}_census'.format(d) for d in DISPOSITIONS])
+
+def get_region_param_arrays(region_ids, region_param_override=None):
+    """Returns a dict of CHIME parameter name -> array of that parameter's
+    effective value for each region in region_ids."""
+    if region_param_override is None:
+        region_param_override = {}
+
+    defaults = get_effective_params()
+    arrays = dict((k, np.full(len(region_ids), v, dtype=float))
+                  for k, v in defaults.items())
+    for i, region_id in enumerate(region_ids):
+        for k, v in region_param_override.get(region_id, {}).items():
+            arrays[k][i] = v
+    return arrays
+
+def sir_projection_arrays(population, cases, num_days, params):
+    """Projects dispositions, admissions and census for many regions at once.
+
+    This follows the arithmetic of penn_chime's RegionalSirModel step by step,
+    with every quantity held as an array of shape (regions x days).
 
-        return merged.rename(columns={'index': 'day'})
+    Args:
+        population: Array of region populations.
+        cases: Array of region confirmed case counts.
+        num_days: Number of days to project.
+        params: Dict of parameter name -> array of per-region values,
+            as returned by get_region_param_arrays.
 
-    predictions_by_county = pd.concat(
-        filter(lambda x: x is not None,
-               [run_row(row[1]) for row in regions_df.iterrows()])
-    )
+    Returns:
+        Tuple of (values, valid), where values is a float array of shape
+        (regions x days+1 x 9) holding the total, admitted and census columns of
+        PREDICTION_COLUMNS for days 0 to num_days, and valid is a boolean array of
+        shape (regions x days+1) marking the days penn_chime reports for each region.
+    """
+    population = np.asarray(population, dtype=float)
+    cases = np.asarray(cases, dtype=float)
+    n_regions = len(population)
+    n_steps = num_days + 1
+
+    infected = cases / params['detection_probability']
+    susceptible = population - infected
+    recovered = np.zeros(n_regions)
+
+    doubling_time = params['doubling_time']
+    with np.errstate(divide='ignore'):
+        intrinsic_growth_rate = np.where(doubling_time > 0.0,
+                                         2.0 ** (1.0 / doubling_time) - 1.0,
+                                         0.0)
+    gamma = 1.0 / params['recovery_days']
+    beta = ((intrinsic_growth_rate + gamma)
+            / susceptible
+            * (1.0 - params['relative_contact_rate']))
+
+    # SIR simulation, renormalizing to the total population each day.
+    s, i, r = susceptible, infected, recovered
+    n = s + i + r
+    infected_by_day = np.empty((n_regions, n_steps))
+    recovered_by_day = np.empty((n_regions, n_steps))
+    for day in range(n_steps):
+        infected_by_day[:, day] = i
+        recovered_by_day[:, day] = r
+        s_n = np.maximum((-beta * s * i) + s, 0.0)
+        i_n = np.maximum((beta * s * i - gamma * i) + i, 0.0)
+        r_n = np.maximum(gamma * i + r, 0.0)
+        scale = n / (s_n + i_n + r_n)
+        s, i, r = s_n * scale, i_n * scale, r_n * scale
+
+    patients = infected_by_day + recovered_by_day
+    days = np.arange(n_steps)
+
+    values = np.full((n_regions, n_steps, 3 * len(DISPOSITIONS)), np.nan)
+    max_los = np.zeros(n_regions, dtype=int)
+    for k, disposition in enumerate(DISPOSITIONS):
+        rate = params['{}_rate'.format(disposition)]
+        los = params['{}_los'.format(disposition)].astype(int)
+        max_los = np.maximum(max_los, los)
+
+        total = patients * (rate * params['market_share'])[:, np.newaxis]
+
+        # New admissions; undefined on the first and last day.
+        admitted = np.full((n_regions, n_steps), np.nan)
+        admitted[:, 1:-1] = total[:, 1:-1] - total[:, :-2]
+
+        # Census is admissions over the length of stay.
+        cumulative = np.zeros((n_regions, n_steps))
+        cumulative[:, 1:-1] = np.cumsum(admitted[:, 1:-1], axis=1)
+        lagged_index = days[np.newaxis, :] - los[:, np.newaxis]
+        lagged = np.where(lagged_index > 0,
+                          np.take_along_axis(cumulative, np.maximum(lagged_index, 0), axis=1),
+                          0.0)
+        census = np.ceil(cumulative - lagged)
+
+        values[:, :, k] = total
+        values[:, :, len(DISPOSITIONS) + k] = admitted
+        values[:, :, 2 * len(DISPOSITIONS) + k] = census
+
+    valid = (days[np.newaxis, :] >= 1) & (days[np.newaxis, :] <= num_days - max_los[:, np.newaxis])
+    valid &= ~np.isnan(values).any(axis=2)
+
+    return np.round(values), valid
+
+def run_regional_sir(regions_df,
+                     region_id_column,
+                     population_column='Population',
+                     cases_column='Confirmed Cases',
+                     num_days=60,
+                     region_param_override=None):
+    """Vectorized equivalent of get_regional_predictions with the 'chime' engine.
+
+    All regions are advanced together as arrays and the result is written
+    into a single preallocated frame, instead of building and concatenating
+    a DataFrame per region. See get_regional_predictions for arguments.
+    """
+    regions = regions_df[regions_df[cases_column] > 0]
+    region_ids = regions[region_id_column].values
 
-    return predictions_by_county
+    params = get_region_param_arrays(region_ids, region_param_override)
+    values, valid = sir_projection_arrays(regions[population_column].values,
+                                          regions[cases_column].values,
+                                          num_days,
+                                          params)
+
+    region_index, day = np.nonzero(valid)
+    result = pd.DataFrame(values[region_index, day], columns=PREDICTION_COLUMNS[1:])
+    result.insert(0, 'day', day)
+    result.insert(0, region_id_column, region_ids[region_index])
+    result.index = day
+    return result
+
+def get_county_predictions(num_days=60, region_param_override=None, engine='chime', cache=None):
+    from covidcaremap.cases import get_county_case_info
 
-def get_county_predictions(num_days=60, region_param_override=None):
     cases_by_county = get_county_case_info()
     return get_regional_predictions(cases_by_county,
-                                    region_id_column='County Name')
+                                    region_id_column='County Name',
+                                    num_days=num_days,
+                                    region_param_override=region_param_override,
+                                    engine=engine,
+                                    cache=cache)
+
+## Projection cache
+
+class ProjectionCache:
+    """Persistent cache of per-region projections.
+
+    Each region's projection is stored under a hash of its population, case
+    count, effective CHIME parameters, number of days and engine, so a run
+    only recomputes regions whose inputs changed since an earlier run.
+
+    Args:
+        cache_dir: Directory to store projections in.
+            Defaults to data/local/chime-projections.
+    """
+    # Bump to invalidate projections stored by earlier versions of the model code.
+    VERSION = 1
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            from covidcaremap.data import local_data_path
+            cache_dir = local_data_path('chime-projections')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, population, cases, num_days, param_override=None, engine='chime'):
+        """Returns the cache key for a region's projection inputs."""
+        inputs = {
+            'version': self.VERSION,
+            'engine': engine,
+            'population': float(population),
+            'cases': float(cases),
+            'num_days': int(num_days),
+            'params': dict((k, float(v)) for k, v in get_effective_params(param_override).items())
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """Returns the cached (days, values, columns) projection for key, or None."""
+        try:
+            with np.load(self._path(key)) as f:
+                result = (f['days'], f['values'], list(f['columns']))
+        except (FileNotFoundError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Stores a (days, values, columns) projection under key."""
+        days, values, columns = result
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, days=days, values=values, columns=np.array(columns, dtype=str))
+        os.replace(tmp_path, self._path(key))
+
+    def stats(self):
+        """Returns the number of regions served from and missing from the cache."""
+        return { 'hits': self.hits, 'misses': self.misses }
+
+    def clear(self):
+        """Removes all cached projections."""
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+## Ensembles
+
+def sample_param_draws(distributions, n_draws, seed=None):
+    """Samples CHIME parameter draws for run_regional_ensemble.
+
+    Args:
+        distributions: Dict of parameter name -> distribution. A distribution is either a
+            (low, high) tuple for a uniform distribution, or a function taking a
+            numpy RandomState and a size and returning that many samples.
+        n_draws: Number of draws.
+        seed: Optional random seed.
+
+    Returns:
+        DataFrame with one column per parameter and one row per draw.
+    """
+    rng = np.random.RandomState(seed)
+    draws = {}
+    for name, distribution in distributions.items():
+        if callable(distribution):
+            draws[name] = np.asarray(distribution(rng, n_draws), dtype=float)
+        else:
+            low, high = distribution
+            draws[name] = rng.uniform(low, high, size=n_draws)
+    return pd.DataFrame(draws)
+
+def grid_param_draws(grid):
+    """Builds CHIME parameter draws for every combination of the given values.
+
+    Args:
+        grid: Dict of parameter name -> list of values.
+
+    Returns:
+        DataFrame with one column per parameter and one row per combination.
+    """
+    names = list(grid)
+    index = pd.MultiIndex.from_product([grid[name] for name in names], names=names)
+    return index.to_frame(index=False)
+
+# Number of (draw x day) projection rows evaluated per ensemble batch. Each row holds
+# one float per projection column, so the default keeps a batch to roughly 100MB.
+DEFAULT_ENSEMBLE_CHUNK_ELEMENTS = 1000000
+
+def iter_regional_ensemble(regions_df,
+                           region_id_column,
+                           param_draws,
+                           population_column='Population',
+                           cases_column='Confirmed Cases',
+                           num_days=60,
+                           percentiles=(5, 50, 95),
+                           region_param_override=None,
+                           chunk_elements=DEFAULT_ENSEMBLE_CHUNK_ELEMENTS,
+                           regions_per_chunk=None):
+    """Runs every (region x draw) combination through the vectorized SIR engine and
+    yields percentile summaries, one DataFrame per chunk of regions.
+
+    Only one chunk's draws are held in memory at a time. Chunks are sized so that
+    regions * len(param_draws) * (num_days + 1) stays within chunk_elements, with
+    at least one region per chunk.
+
+    Args:
+        regions_df: The regions to be run over. Requires an ID, population, and cases columns.
+        region_id_column: The column holding the region ID.
+        param_draws: DataFrame of parameter values with one row per draw, e.g. from
+            sample_param_draws or grid_param_draws. Parameters that are not columns
+            keep their DEFAULT_PARAMS values.
+        population_column: The column holding the population count.
+        cases_column: The column holding the number of confirmed cases.
+        num_days: Number of days to project.
+        percentiles: Percentiles to summarize each projection column by.
+        region_param_override: Per-region parameter overrides, as in
+            get_regional_predictions. These take precedence over the draws.
+        chunk_elements: Budget of (region x draw x day) projection rows per batch.
+        regions_per_chunk: Number of regions to evaluate per batch. Overrides
+            chunk_elements if given.
+
+    Yields:
+        DataFrames with the region ID, day, and a '<column>_p<percentile>' column
+        for each projection column and percentile.
+    """
+    if region_param_override is None:
+        region_param_override = {}
+
+    unknown = set(param_draws.columns) - set(get_effective_params())
+    if unknown:
+        raise Exception('Unknown CHIME parameters: {}'.format(', '.join(sorted(unknown))))
+
+    regions = regions_df[regions_df[cases_column] > 0]
+    region_ids = regions[region_id_column].values
+    populations = regions[population_column].values
+    cases = regions[cases_column].values
+    n_draws = len(param_draws)
+    if regions_per_chunk is None:
+        regions_per_chunk = max(1, chunk_elements // (max(n_draws, 1) * (num_days + 1)))
+
+    summary_columns = ['{}_p{}'.format(column, pct)
+                       for pct in percentiles
+                       for column in PREDICTION_COLUMNS[1:]]
+
+    for start in range(0, len(regions), regions_per_chunk):
+        chunk = slice(start, start + regions_per_chunk)
+        chunk_ids = region_ids[chunk]
+        n_regions = len(chunk_ids)
+
+        # Rows are ordered region-major: row = region * n_draws + draw.
+        params = get_region_param_arrays(np.repeat(chunk_ids, n_draws))
+        for name in param_draws.columns:
+            params[name] = np.tile(param_draws[name].to_numpy(dtype=float), n_regions)
+        for j, region_id in enumerate(chunk_ids):
+            for name, value in region_param_override.get(region_id, {}).items():
+                params[name][j * n_draws:(j + 1) * n_draws] = value
+
+        values, valid = sir_projection_arrays(np.repeat(populations[chunk], n_draws),
+                                              np.repeat(cases[chunk], n_draws),
+                                              num_days,
+                                              params)
+        values = values.reshape(n_regions, n_draws, num_days + 1, -1)
+        valid = valid.reshape(n_regions, n_draws, num_days + 1)
+        values[~valid] = np.nan
+
+        # Days that any draw reports are kept; percentiles are over the draws reporting them.
+        region_index, day = np.nonzero(valid.any(axis=1))
+        with np.errstate(invalid='ignore'):
+            summary = np.nanpercentile(values[region_index, :, day], percentiles, axis=1)
+
+        # (percentiles x rows x columns) -> (rows x percentiles * columns)
+        summary = np.concatenate(list(summary), axis=1)
+        result = pd.DataFrame(summary, columns=summary_columns)
+        result.insert(0, 'day', day)
+        result.insert(0, region_id_column, chunk_ids[region_index])
+        yield result
+
+def run_regional_ensemble(regions_df, region_id_column, param_draws, **kwargs):
+    """Runs an ensemble of CHIME projections and returns percentile summaries
+    per region and day. See iter_regional_ensemble for arguments."""
+    chunks = list(iter_regional_ensemble(regions_df, region_id_column, param_draws, **kwargs))
+    if not chunks:
+        return pd.DataFrame(columns=[region_id_column, 'day'])
+    return pd.concat(chunks, ignore_index=True)
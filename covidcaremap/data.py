@@ -1,14 +1,13 @@
 import os
-import io
 import json
-from zipfile import ZipFile
+import hashlib
+import threading
+from collections import OrderedDict
 
-import pandas as pd
-import geopandas as gpd
-import requests
+# pandas and geopandas are imported where they are used, so that scripts
+# which only need the data path helpers don't pay for importing them.
 
 from covidcaremap.constants import state_name_to_abbreviation
-from covidcaremap.util import fetch_df
 
 DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../data'))
 
@@ -38,6 +37,129 @@ def local_data_path(fname):
 def data_path(fname):
     return os.path.join(DATA_DIR, fname)
 
+GEO_CACHE_DIR_NAME = 'geo-cache'
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_geojson_gdf(path):
+    """Reads a GeoJSON file into a GeoDataFrame through a GeoParquet sidecar.
+
+    The first read parses the GeoJSON and writes a GeoParquet copy (WKB geometry)
+    to data/local/geo-cache. Later reads load the sidecar instead, as long as the
+    source file's modification time and size, or failing that its SHA-256 hash,
+    still match what the sidecar was built from. Falls back to parsing the GeoJSON
+    if pyarrow is not installed.
+    """
+    import geopandas as gpd
+
+    name = os.path.basename(path)
+    sidecar_path = local_data_path(os.path.join(GEO_CACHE_DIR_NAME, name + '.parquet'))
+    meta_path = sidecar_path + '.json'
+    os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+
+    stat = os.stat(path)
+    source = {'path': os.path.abspath(path), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, ValueError):
+        meta = None
+
+    if meta is not None and os.path.exists(sidecar_path) and meta['path'] == source['path']:
+        fresh = meta['mtime'] == source['mtime'] and meta['size'] == source['size']
+        if not fresh and meta['size'] == source['size']:
+            # The file was touched (e.g. by a checkout) - compare contents.
+            source['sha256'] = _file_sha256(path)
+            fresh = meta['sha256'] == source['sha256']
+            if fresh:
+                with open(meta_path, 'w') as f:
+                    json.dump(source, f)
+        if fresh:
+            try:
+                return gpd.read_parquet(sidecar_path)
+            except ImportError:
+                pass
+
+    gdf = gpd.read_file(path, encoding='utf-8')
+    try:
+        gdf.to_parquet(sidecar_path)
+    except ImportError:
+        return gdf
+
+    if 'sha256' not in source:
+        source['sha256'] = _file_sha256(path)
+    with open(meta_path, 'w') as f:
+        json.dump(source, f)
+
+    return gdf
+
+class GeoDataFrameRegistry:
+    """Process-wide memo of GeoDataFrames read from disk.
+
+    Each file is read once (through read_geojson_gdf) and kept in a bounded
+    least-recently-used cache. Entries are reloaded if the file changes on disk,
+    and can be dropped explicitly with invalidate(). Callers receive a copy of
+    the shared frame, so modifying it doesn't affect other callers.
+
+    Args:
+        max_entries: Maximum number of frames kept in memory.
+    """
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _file_key(path):
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size)
+
+    def get(self, path):
+        """Returns a copy of the GeoDataFrame for path, reading it on first use."""
+        path = os.path.abspath(path)
+        key = self._file_key(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                self._entries.move_to_end(path)
+            else:
+                self.misses += 1
+                entry = (key, read_geojson_gdf(path))
+                self._entries[path] = entry
+                self._entries.move_to_end(path)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return entry[1].copy()
+
+    def invalidate(self, path=None):
+        """Drops the frame for path, or all frames if path is None."""
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(path), None)
+
+    def stats(self):
+        """Returns the hit and miss counts and the memory used by each cached frame."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'memory_bytes': dict((path, int(gdf.memory_usage(deep=True).sum()))
+                                     for path, (_, gdf) in self._entries.items())
+            }
+
+region_layers = GeoDataFrameRegistry()
+
 def read_hcris_gj():
     return json.loads(open(processed_data_path('usa_hospital_beds_hcris2018.geojson')).read())
 
@@ -45,18 +167,18 @@ def read_facility_gj():
     return json.loads(open(published_data_path('us_healthcare_capacit-facility-CovidCareMap.geojson')))
 
 def read_facility_gdf():
-    return gpd.read_file(published_data_path('us_healthcare_capacity-facility-CovidCareMap.geojson'),
-                         encoding='utf-8')
+    return region_layers.get(published_data_path('us_healthcare_capacity-facility-CovidCareMap.geojson'))
 
 def read_us_counties_gdf():
-    return gpd.read_file(processed_data_path('us_counties_with_pop.geojson'), encoding='utf-8')
+    return region_layers.get(processed_data_path('us_counties_with_pop.geojson'))
 
 def read_us_states_gdf():
-    df = gpd.read_file(processed_data_path('us_states_with_pop.geojson'), encoding='utf-8')
+    df = region_layers.get(processed_data_path('us_states_with_pop.geojson'))
     return df
 
 def read_us_hrr_gdf():
-    return gpd.read_file(processed_data_path('us_hrr_with_pop.geojson'), encoding='utf-8')
+    return region_layers.get(processed_data_path('us_hrr_with_pop.geojson'))
 
 def read_census_data_df():
+    import pandas as pd
     return pd.read_csv(external_data_path('us-census-cc-est2018-alldata.csv'), encoding='unicode_escape')
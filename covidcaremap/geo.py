@@ -1,13 +1,128 @@
+import hashlib
 import math
+import os
+from collections import OrderedDict
 
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from difflib import SequenceMatcher
-from fuzzywuzzy import fuzz
 
 from covidcaremap.constants import *
-from covidcaremap.data import read_us_counties_gdf, read_us_states_gdf, read_us_hrr_gdf
+from covidcaremap.data import (local_data_path,
+                               read_us_counties_gdf,
+                               read_us_states_gdf,
+                               read_us_hrr_gdf)
+
+def point_coordinates(gdf):
+    """Returns an (n x 2) array of the x and y coordinates of the point
+    geometries in gdf, with NaN rows for missing or empty geometries."""
+    geometry = gdf.geometry
+    valid = (~(geometry.isna() | geometry.is_empty)).values
+    coords = np.full((len(gdf), 2), np.nan)
+    coords[valid, 0] = geometry[valid].x.values
+    coords[valid, 1] = geometry[valid].y.values
+    return coords
+
+def points_within_distance(left, right, distance):
+    """Finds every pair of points from left and right that are within distance
+    of each other, using a KD-tree query over the point coordinates.
+
+    Args:
+        left: Geopandas dataframe of points, in a projected CRS.
+        right: Geopandas dataframe of points, in the same CRS as left.
+        distance: Maximum distance between paired points, in units of the CRS.
+
+    Returns:
+        Tuple of arrays (left_positions, right_positions, distances), holding the
+        positional index of each pair's points and the distance between them,
+        ordered by left then right position.
+    """
+    from scipy.spatial import cKDTree
+
+    left_coords = point_coordinates(left)
+    right_coords = point_coordinates(right)
+    left_valid = np.nonzero(~np.isnan(left_coords).any(axis=1))[0]
+    right_valid = np.nonzero(~np.isnan(right_coords).any(axis=1))[0]
+
+    pairs = cKDTree(left_coords[left_valid]).sparse_distance_matrix(
+        cKDTree(right_coords[right_valid]),
+        distance,
+        output_type='ndarray'
+    )
+    order = np.lexsort((pairs['j'], pairs['i']))
+    pairs = pairs[order]
+    return left_valid[pairs['i']], right_valid[pairs['j']], pairs['v']
+
+def normalize_strings(values):
+    """Normalizes strings for similarity scoring: lowercases, replaces
+    punctuation with spaces and collapses whitespace. Values that are
+    not strings become NaN.
+
+    Args:
+        values: Array-like of values.
+
+    Returns:
+        Numpy object array of normalized strings.
+    """
+    values = pd.Series(np.asarray(values, dtype=object))
+    values = values.where(values.map(type) == str)
+    return (values.str.lower()
+                  .str.replace(r'[^0-9a-z]+', ' ', regex=True)
+                  .str.strip()
+                  .to_numpy(dtype=object))
+
+def similarity_scores(left_values, right_values, workers=1):
+    """Scores aligned pairs of strings with rapidfuzz's ratio in bulk.
+
+    Args:
+        left_values: Array-like of strings.
+        right_values: Array-like of strings, aligned with left_values.
+        workers: Number of threads to score with. -1 uses all cores.
+
+    Returns:
+        Float array of 0-100 scores. Pairs where either value is not a string score 0.
+    """
+    from rapidfuzz import fuzz
+
+    left_values = np.asarray(left_values, dtype=object)
+    right_values = np.asarray(right_values, dtype=object)
+    is_str = np.frompyfunc(lambda v: type(v) is str, 1, 1)
+    valid = (is_str(left_values) & is_str(right_values)).astype(bool)
+
+    scores = np.zeros(len(left_values))
+    if not valid.any():
+        return scores
+
+    try:
+        from rapidfuzz.process import cpdist
+    except ImportError:
+        # Older rapidfuzz versions without pairwise batch scoring.
+        scores[valid] = [fuzz.ratio(l, r)
+                         for l, r in zip(left_values[valid], right_values[valid])]
+    else:
+        scores[valid] = cpdist(list(left_values[valid]),
+                               list(right_values[valid]),
+                               scorer=fuzz.ratio,
+                               workers=workers)
+    return scores
+
+def weighted_similarity_scores(left_columns, right_columns, weights=None, workers=1):
+    """Weighted sum of similarity_scores over several aligned columns.
+
+    Args:
+        left_columns: List of array-likes of strings.
+        right_columns: List of array-likes of strings, aligned with left_columns.
+        weights: Weight per column. Defaults to equal weights summing to 1.
+        workers: Number of threads to score with. -1 uses all cores.
+    """
+    if weights is None:
+        weights = [1 / len(left_columns) for x in left_columns]
+
+    score = None
+    for l, r, w in zip(left_columns, right_columns, weights):
+        column_score = similarity_scores(l, r, workers=workers) * w
+        score = column_score if score is None else score + column_score
+    return score
 
 def spatial_join_facilities(left,
                             right,
@@ -18,7 +133,11 @@ def spatial_join_facilities(left,
                             similarity_weights=None,
                             distance=150,
                             dist_epsg='EPSG:5070',
-                            merge_unmatched=True):
+                            merge_unmatched=True,
+                            distance_weight=None,
+                            include_distance=False,
+                            normalize=False,
+                            workers=1):
     """Spatially join two facility datasets. Full outer join - no facilitie will be
     dropped from the resulting data in case of no match.
 
@@ -38,6 +157,13 @@ def spatial_join_facilities(left,
             Defaults to EPSG:5070 (NAD83 / Conus Albers) for the U.S.
         merge_unmatched: If True, merges in unmatched items from the right data.
             Defaults to True.
+        distance_weight: If set, adds a distance score to the similarity score with this
+            weight. The distance score is 100 for facilities at the same location, falling
+            linearly to 0 at 'distance' meters apart.
+        include_distance: If True, the result has a 'distance' column with the distance
+            in meters between matched facilities.
+        normalize: If True, similarity properties are compared after normalize_strings.
+        workers: Number of threads to score similarities with. -1 uses all cores.
 
     Returns:
         A joined dataframe with two columns: lid_property and rid_property. These
@@ -48,41 +174,34 @@ def spatial_join_facilities(left,
         Similarity score is the weighted average of the similarity indexes from the
         similarity_property values.
 
+        Candidate matches are found by querying the facility points for pairs within
+        'distance' of each other, rather than by intersecting buffered points. Among
+        candidates with equal similarity, the closest one is matched.
+
         Logic taken from hifld-licensed-bed-counts-for-all-US-health-facilities from @aaronxsu
     """
-
     # Reproject to EPSG:5070 (NAD83 / Conus Albers)
-    left = left.to_crs('EPSG:5070')
-    right = right.to_crs('EPSG:5070')
-
-    lprefix = 'left_'
-    rprefix = 'right_'
-
-    # Add prefixes
-    left = left.add_prefix('{}_'.format(lprefix))
-    right = right.add_prefix('{}_'.format(rprefix))
-    def prefix(prefix, name):
-        return '{}_{}'.format(prefix, name)
-
-    # Reset geometry
-    left['geometry'] = left[prefix(lprefix, 'geometry')]
-    right['geometry'] = right[prefix(rprefix, 'geometry')]
-
-    # Save point location to new field
-    left['point_geometry'] = left['geometry']
-
-    # Buffer
-    left['geometry'] = left.buffer(distance)
-
-    joined = gpd.sjoin(left, right, how='left', op='intersects')
-
-    # Map columns to account for prefix
-    pre_lid_property = '{}_{}'.format(lprefix, lid_property)
-    pre_rid_property = '{}_{}'.format(rprefix, rid_property)
-    lsimilarity_properties = ['{}_{}'.format(lprefix, p)
-                              for p in lsimilarity_properties]
-    rsimilarity_properties = ['{}_{}'.format(rprefix, p)
-                              for p in rsimilarity_properties]
+    left = left.to_crs(dist_epsg)
+    right = right.to_crs(dist_epsg)
+
+    left_ids = left[lid_property].values
+    right_ids = right[rid_property].values
+
+    left_positions, right_positions, distances = points_within_distance(left, right, distance)
+
+    # One row per candidate pair, plus a row for every left facility without candidates.
+    unmatched_left = np.ones(len(left), dtype=bool)
+    unmatched_left[left_positions] = False
+    matched = pd.DataFrame({
+        'left_id': left_ids[left_positions],
+        'right_id': right_ids[right_positions],
+        'distance': distances
+    })
+    joined_and_unmatched = pd.DataFrame({
+        'left_id': left_ids[unmatched_left],
+        'right_id': np.nan,
+        'distance': np.nan
+    })
 
     # Deduplication - use a similarity index on name and address
     # and choose the matched item that has the highest score.
@@ -91,55 +210,247 @@ def spatial_join_facilities(left,
     if similarity_weights is None:
         similarity_weights = [1 / sim_prop_len for x in lsimilarity_properties]
 
-    def get_similarity_score(row):
-        score = 0.0
-        for ((l, r), w) in zip(zip(lsimilarity_properties, rsimilarity_properties), similarity_weights):
-            # For joins that don't match, right properties give float 'nan' value.
-            if type(row[r]) is str:
-                score += (fuzz.ratio(row[l], row[r]) * w)
-        return score
-
-    joined['similarity'] = joined.apply(get_similarity_score, axis = 1)
-
-    joined_and_matched = joined[~joined[pre_rid_property].isnull()]
-    joined_and_unmatched = joined[joined[pre_rid_property].isnull()]
+    def similarity_column(df, column, positions):
+        # Normalize each facility's value once, rather than once per candidate pair.
+        values = df[column].values
+        if normalize:
+            values = normalize_strings(values)
+        return values[positions]
+
+    similarity = weighted_similarity_scores(
+        [similarity_column(left, p, left_positions) for p in lsimilarity_properties],
+        [similarity_column(right, p, right_positions) for p in rsimilarity_properties],
+        similarity_weights,
+        workers=workers
+    )
+    if distance_weight is not None:
+        similarity += distance_weight * 100 * (1 - distances / distance)
+    matched['similarity'] = similarity
 
     # Deduplicate left's object_ids
-    deduplicated = joined_and_matched.sort_values(by=[pre_lid_property, 'similarity'], ascending=False) \
-                         .drop_duplicates(subset=[pre_lid_property])
+    deduplicated = matched.sort_values(by=['left_id', 'similarity', 'distance'],
+                                       ascending=[False, False, True]) \
+                          .drop_duplicates(subset=['left_id'])
 
     # Deduplicate any 'right' facilities that were matched to more than one
     # 'left' facility. Do this by creating another dataframe containing the 'right'
     # facility and it's closest match, joining back with the dataframe,
     # and reseting matches on any where the identified 'left' ID isn't the same
     # as the row's 'left' ID.
-    right_matches = deduplicated[[pre_rid_property, pre_lid_property, 'similarity']]
-    right_matches = right_matches.sort_values(by=[pre_rid_property, 'similarity'], ascending=False)
-    right_matches = right_matches.drop_duplicates(subset=[pre_rid_property])
-    right_matches = right_matches.rename({pre_lid_property: 'matched_left_id'}, axis=1)
-    deduplicated = deduplicated.merge(right_matches, on=pre_rid_property)
-    deduplicated.loc[
-        deduplicated[pre_lid_property] != deduplicated['matched_left_id'],
-        pre_rid_property
-    ] = np.NaN
+    right_matches = deduplicated[['right_id', 'left_id', 'similarity', 'distance']]
+    right_matches = right_matches.sort_values(by=['right_id', 'similarity', 'distance'],
+                                              ascending=[False, False, True])
+    right_matches = right_matches.drop_duplicates(subset=['right_id'])
+    right_matches = right_matches[['right_id', 'left_id']].rename({'left_id': 'matched_left_id'}, axis=1)
+    deduplicated = deduplicated.merge(right_matches, on='right_id')
+    rematched = deduplicated['left_id'] != deduplicated['matched_left_id']
+    deduplicated.loc[rematched, 'right_id'] = np.nan
+    deduplicated.loc[rematched, 'distance'] = np.nan
 
     # Rejoin unmatched.
     deduplicated = pd.concat([deduplicated, joined_and_unmatched])
 
     # Join back 'right' unmatched if desired.
     if merge_unmatched:
-        matched_right_ids = deduplicated[pre_rid_property]
-        unmatched_right = right[~right[pre_rid_property].isin(matched_right_ids)]
+        matched_right_ids = deduplicated['right_id']
+        unmatched_right = pd.DataFrame({
+            'right_id': right_ids[~pd.Series(right_ids).isin(matched_right_ids).values]
+        })
 
         all_facilities = pd.concat([deduplicated, unmatched_right])
     else:
         all_facilities = deduplicated
 
-    result = all_facilities.rename({ pre_lid_property: lid_property,
-                                     pre_rid_property: rid_property }, axis=1)
+    result = all_facilities.rename({ 'left_id': lid_property,
+                                     'right_id': rid_property }, axis=1)
+
+    columns = [lid_property, rid_property]
+    if include_distance:
+        columns.append('distance')
+    return result[columns]
+
+
+## Region assignment
+
+REGION_ASSIGNMENT_DIR_NAME = 'region-assignments'
+
+# Number of assignment files kept under REGION_ASSIGNMENT_DIR_NAME.
+MAX_REGION_ASSIGNMENTS = 32
 
-    return result[[lid_property, rid_property]]
+def _geometry_key(*gdfs):
+    """Hash of the CRS and geometries (in order) of the given GeoDataFrames."""
+    h = hashlib.sha256()
+    for gdf in gdfs:
+        h.update(('' if gdf.crs is None else gdf.crs.to_wkt()).encode('utf-8'))
+        try:
+            wkbs = gdf.geometry.to_wkb()
+        except AttributeError:
+            # Older geopandas without vectorized WKB export.
+            wkbs = [None if geometry is None else geometry.wkb for geometry in gdf.geometry]
+        h.update(str(len(gdf)).encode('utf-8'))
+        for wkb in wkbs:
+            h.update(b'' if wkb is None else wkb)
+    return h.hexdigest()
 
+def _bulk_query(sindex, geometries, predicate):
+    """Queries a spatial index with many geometries at once, returning
+    (input positions, tree positions)."""
+    try:
+        return sindex.query(geometries, predicate=predicate)
+    except TypeError:
+        # Older geopandas only supports bulk queries through query_bulk.
+        return sindex.query_bulk(geometries, predicate=predicate)
+
+## Prepared region geometries
+
+class PreparedRegions:
+    """Region geometries prepared for repeated point-in-polygon queries.
+
+    The geometries are prepared once and kept, along with an STRtree over their
+    bounding boxes. Queries find bounding box candidates in the tree and test
+    them against the prepared geometries in one vectorized call, which is much
+    cheaper than an unprepared test of every candidate.
+
+    Args:
+        regions: Geopandas dataframe of region polygons.
+    """
+    def __init__(self, regions):
+        import shapely
+
+        self.geometries = np.asarray(regions.geometry.values, dtype=object)
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+    def query(self, geometries):
+        """Finds which regions intersect each of the given geometries.
+
+        Returns:
+            Tuple of arrays (input positions, region positions) of intersecting
+            pairs, ordered by input then region position.
+        """
+        import shapely
+
+        geometries = np.asarray(geometries, dtype=object)
+        input_positions, region_positions = self.tree.query(geometries)
+        hits = shapely.intersects(self.geometries[region_positions],
+                                  geometries[input_positions])
+
+        input_positions = input_positions[hits]
+        region_positions = region_positions[hits]
+        order = np.lexsort((region_positions, input_positions))
+        return input_positions[order], region_positions[order]
+
+_prepared_regions = OrderedDict()
+
+# Number of PreparedRegions kept in memory by prepared_regions.
+MAX_PREPARED_REGIONS = 4
+
+def prepared_regions(regions):
+    """Returns PreparedRegions for regions, reusing the ones prepared
+    for the same geometries by earlier calls."""
+    key = _geometry_key(regions)
+    if key in _prepared_regions:
+        _prepared_regions.move_to_end(key)
+        return _prepared_regions[key]
+
+    prepared = PreparedRegions(regions)
+    _prepared_regions[key] = prepared
+    while len(_prepared_regions) > MAX_PREPARED_REGIONS:
+        _prepared_regions.popitem(last=False)
+    return prepared
+
+def _intersecting_regions(facilities, regions):
+    """(facility positions, region positions) of intersecting pairs."""
+    try:
+        from shapely import prepare
+    except ImportError:
+        # Shapely < 2 has no vectorized prepared geometries.
+        return _bulk_query(regions.sindex, facilities.geometry.values, 'intersects')
+    return prepared_regions(regions).query(facilities.geometry.values)
+
+def assign_facilities_to_regions(facilities, regions, use_cache=True):
+    """Finds the region containing each facility with a single bulk
+    point-in-polygon query against the regions' prepared geometries
+    (see prepared_regions).
+
+    Assignments are persisted under data/local/region-assignments, keyed by
+    the facility and region CRS and geometries, so repeated aggregations of the
+    same facility snapshot to the same regions skip the spatial work. Only the
+    MAX_REGION_ASSIGNMENTS most recently used assignments are kept
+    (see evict_region_assignments).
+
+    Args:
+        facilities: Geopandas dataframe of facility points.
+        regions: Geopandas dataframe of region polygons, in the same CRS.
+        use_cache: If False, always recompute and don't persist the assignments.
+
+    Returns:
+        Integer array aligned with facilities holding the position in regions of
+        each facility's region, or -1 for facilities outside every region. A facility
+        on the border of several regions is assigned to the first of them.
+    """
+    path = None
+    if use_cache:
+        path = local_data_path(os.path.join(REGION_ASSIGNMENT_DIR_NAME,
+                                            '{}.npy'.format(_geometry_key(facilities, regions))))
+        try:
+            assignments = np.load(path)
+        except FileNotFoundError:
+            pass
+        else:
+            # Mark as recently used for evict_region_assignments.
+            os.utime(path)
+            return assignments
+
+    facility_positions, region_positions = _intersecting_regions(facilities, regions)
+
+    # Keep the first region found for each facility.
+    order = np.lexsort((region_positions, facility_positions))
+    facility_positions = facility_positions[order]
+    region_positions = region_positions[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = facility_positions[1:] != facility_positions[:-1]
+
+    assignments = np.full(len(facilities), -1, dtype=np.int64)
+    assignments[facility_positions[first]] = region_positions[first]
+
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, assignments)
+        evict_region_assignments()
+
+    return assignments
+
+def evict_region_assignments(max_entries=None):
+    """Removes the least recently used persisted region assignments until at
+    most max_entries remain.
+
+    Args:
+        max_entries: Number of assignment files to keep. Defaults to
+            MAX_REGION_ASSIGNMENTS.
+    """
+    if max_entries is None:
+        max_entries = MAX_REGION_ASSIGNMENTS
+
+    assignment_dir = local_data_path(REGION_ASSIGNMENT_DIR_NAME)
+    if not os.path.exists(assignment_dir):
+        return
+
+    entries = []
+    for file_name in os.listdir(assignment_dir):
+        path = os.path.join(assignment_dir, file_name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except FileNotFoundError:
+            # Removed by a concurrent eviction.
+            pass
+
+    entries.sort()
+    for _, path in entries[:max(len(entries) - max_entries, 0)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
 
 def sum_per_region(facilities,
                    regions,
@@ -148,7 +459,8 @@ def sum_per_region(facilities,
                    facility_count_columns=None,
                    facility_occupancy_columns=None,
                    population_columns=None,
-                   per_capita_base=PER_CAPITA_BASE):
+                   per_capita_base=PER_CAPITA_BASE,
+                   use_cache=True):
     """
     Aggregate facility-level data by region via summation.
 
@@ -168,6 +480,8 @@ def sum_per_region(facilities,
             that contain the population values. Defaults to the values generated in
             "Merge Region and Census Data" notebook.
         per_captia_base: Per capita base number. Defaults to 1000.
+        use_cache: Passed to assign_facilities_to_regions. If True, the facility to
+            region assignments are reused across calls for the same facilities and regions.
     """
     if population_columns is None:
         population_columns = CCM_POPULATION_COLUMNS
@@ -180,9 +494,44 @@ def sum_per_region(facilities,
         # Default to CovidCareMap columns
         facility_occupancy_columns = CCM_FACILITY_OCCUPANCY_COLUMNS
 
-    joined = gpd.sjoin(facilities, regions, how='inner', op='intersects')
-
-    compute_columns = []
+    joined = _join_region_columns(facilities, regions, groupby_columns, use_cache)
+    region_level = _sum_facilities(joined,
+                                   groupby_columns,
+                                   facility_count_columns,
+                                   facility_occupancy_columns)
+    return _finalize_region_level(region_level,
+                                  regions,
+                                  region_id_column,
+                                  facility_count_columns,
+                                  facility_occupancy_columns,
+                                  population_columns,
+                                  per_capita_base)
+
+def _join_region_columns(facilities, regions, groupby_columns, use_cache):
+    """Attaches the region groupby columns to each facility via the precomputed
+    assignments, dropping facilities outside every region."""
+    assignments = assign_facilities_to_regions(facilities, regions, use_cache=use_cache)
+    assigned = assignments >= 0
+    joined = pd.DataFrame(facilities[assigned].drop(columns=facilities.geometry.name))
+    region_columns = [groupby_columns] if isinstance(groupby_columns, str) else groupby_columns
+    for column in region_columns:
+        if column in regions.columns:
+            joined[column] = regions[column].values[assignments[assigned]]
+    return joined
+
+def _weighted_occupancy_columns(facility_occupancy_columns):
+    """The additive columns an occupancy rate is computed from."""
+    return [c
+            for occupancy_rate_column in facility_occupancy_columns
+            for c in ['weighted_{}'.format(occupancy_rate_column),
+                      'base_{}'.format(occupancy_rate_column)]]
+
+def _sum_facilities(joined,
+                    groupby_columns,
+                    facility_count_columns,
+                    facility_occupancy_columns):
+    """Sums facility counts per region, along with the weighted and base
+    columns used to compute occupancy rates."""
     for occupancy_rate_column, beds_column in facility_occupancy_columns.items():
         w = 'weighted_{}'.format(occupancy_rate_column)
         b = 'base_{}'.format(occupancy_rate_column)
@@ -193,15 +542,22 @@ def sum_per_region(facilities,
 
         # If a facility doesn't have an occupancy rate
         joined.loc[joined[w].isnull(), b] = 0
-        compute_columns.append(w)
-        compute_columns.append(b)
 
-    region_level = joined.groupby(groupby_columns, as_index='False')[
+    return joined.groupby(groupby_columns, as_index='False')[
         facility_count_columns +
         list(facility_occupancy_columns.keys()) +
-        compute_columns
+        _weighted_occupancy_columns(facility_occupancy_columns)
     ].sum().reset_index()
 
+def _finalize_region_level(region_level,
+                           regions,
+                           region_id_column,
+                           facility_count_columns,
+                           facility_occupancy_columns,
+                           population_columns,
+                           per_capita_base):
+    """Turns summed region data into occupancy rates and per capita counts,
+    and joins in the region information."""
     # Calculate occupancy rates via average weighted by
     # the number of beds.
     for occupancy_rate_column, beds_column in facility_occupancy_columns.items():
@@ -210,9 +566,11 @@ def sum_per_region(facilities,
             region_level['base_{}'.format(occupancy_rate_column)]
         ).round(2)
 
-    region_level = region_level.drop(columns=compute_columns)
+    region_level = region_level.drop(columns=_weighted_occupancy_columns(facility_occupancy_columns))
 
-    region_level = gpd.GeoDataFrame(region_level.merge(regions, on=region_id_column), crs=4326)
+    region_level = region_level.merge(regions, on=region_id_column)
+    if 'geometry' in region_level.columns:
+        region_level = gpd.GeoDataFrame(region_level, crs=4326)
 
     for count_column in facility_count_columns:
         for population in population_columns:
@@ -243,3 +601,121 @@ def sum_per_hrr(facilities):
                           read_us_hrr_gdf(),
                           groupby_columns=['HRR_BDRY_I', 'HRRCITY'],
                           region_id_column='HRRCITY')
+
+## Hierarchical rollup
+
+class RegionLevel:
+    """A level of a region hierarchy for rollup_per_region.
+
+    Args:
+        name: Name of the level, used as its key in the rollup result.
+        region_id_column: Column identifying the regions of this level. For levels
+            after the first, the previous level's regions need this column to say
+            which region they roll up into (e.g. a 'State' column on counties).
+        regions: Geopandas dataframe of the regions with their population columns.
+            If None, regions and their populations are summed from the previous
+            level's regions. If the previous level's regions also lack
+            region_id_column, they all roll up into a single region with the
+            level's name as its ID.
+        groupby_columns: For the first level only, the region columns that facilities
+            are grouped by. Defaults to region_id_column.
+    """
+    def __init__(self, name, region_id_column, regions=None, groupby_columns=None):
+        self.name = name
+        self.region_id_column = region_id_column
+        self.regions = regions
+        self.groupby_columns = groupby_columns or [region_id_column]
+
+def us_region_levels():
+    """County, state and national RegionLevels for CovidCareMap data."""
+    return [
+        RegionLevel('county', 'GEO_ID', read_us_counties_gdf()),
+        RegionLevel('state', 'State', read_us_states_gdf()),
+        RegionLevel('nation', 'Country')
+    ]
+
+def rollup_per_region(facilities,
+                      levels=None,
+                      facility_count_columns=None,
+                      facility_occupancy_columns=None,
+                      population_columns=None,
+                      per_capita_base=PER_CAPITA_BASE,
+                      use_cache=True):
+    """Aggregate facility-level data to several levels of a region hierarchy in one pass.
+
+    Facilities are aggregated to the first (finest) level only. Each following level
+    is derived by summing the additive columns of the level before it, and occupancy
+    rates and per capita columns are computed for every level at the end. Unlike
+    separate sum_per_region calls, every facility is therefore counted in the coarser
+    region containing its finest level region.
+
+    Args:
+        facilities - Facilities information in geopandas dataframe.
+            Must have the columns specified in constants.py. Must be EPSG:4326
+        levels: List of RegionLevel, from finest to coarsest. Defaults to
+            us_region_levels().
+        facility_count_columns, facility_occupancy_columns, population_columns,
+        per_capita_base, use_cache: See sum_per_region.
+
+    Returns:
+        Dict of level name -> dataframe of that level's aggregated data, as
+        sum_per_region returns it.
+    """
+    if levels is None:
+        levels = us_region_levels()
+
+    if population_columns is None:
+        population_columns = CCM_POPULATION_COLUMNS
+
+    if facility_count_columns is None:
+        facility_count_columns = CCM_FACILITY_COUNT_COLUMNS
+
+    if facility_occupancy_columns is None:
+        facility_occupancy_columns = CCM_FACILITY_OCCUPANCY_COLUMNS
+
+    additive_columns = (facility_count_columns +
+                        list(facility_occupancy_columns.keys()) +
+                        _weighted_occupancy_columns(facility_occupancy_columns))
+
+    def finalize(region_level, regions, level):
+        return _finalize_region_level(region_level.copy(),
+                                      regions,
+                                      level.region_id_column,
+                                      facility_count_columns,
+                                      facility_occupancy_columns,
+                                      population_columns,
+                                      per_capita_base)
+
+    finest = levels[0]
+    joined = _join_region_columns(facilities, finest.regions, finest.groupby_columns, use_cache)
+    region_level = _sum_facilities(joined,
+                                   finest.groupby_columns,
+                                   facility_count_columns,
+                                   facility_occupancy_columns)
+    regions = finest.regions
+
+    result = { finest.name: finalize(region_level, regions, finest) }
+    previous = finest
+    for level in levels[1:]:
+        # Map each finer region to the coarser region it rolls up into.
+        parents = pd.DataFrame(regions.drop(columns=regions.geometry.name)
+                               if isinstance(regions, gpd.GeoDataFrame) else regions)
+        if level.region_id_column not in parents.columns:
+            parents[level.region_id_column] = level.name
+
+        parent_ids = parents[[previous.region_id_column, level.region_id_column]].drop_duplicates()
+        region_level = region_level[[previous.region_id_column] + additive_columns] \
+            .merge(parent_ids, on=previous.region_id_column) \
+            .groupby(level.region_id_column)[additive_columns].sum().reset_index()
+
+        if level.regions is None:
+            regions = parents.groupby(level.region_id_column)[
+                list(population_columns.values())
+            ].sum().reset_index()
+        else:
+            regions = level.regions
+
+        result[level.name] = finalize(region_level, regions, level)
+        previous = level
+
+    return result
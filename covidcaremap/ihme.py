@@ -2,20 +2,26 @@ import io
 import os
 from zipfile import ZipFile
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import requests
-import us
 
-from covidcaremap.data import (read_us_states_gdf,
+from covidcaremap.cache import get_default_cache
+from covidcaremap.data import (local_data_path,
+                               read_us_states_gdf,
                                read_us_counties_gdf)
 
 ## IHME Columns
 
 class IHME:
     LOCATION = "location_name"
+    LOCATION_ID = "location_id"
     DATE = "date"
 
+    # IHME (GBD) location IDs of the US states and DC. Location names alone are
+    # ambiguous: e.g. "Georgia" is both a US state and a country.
+    US_STATE_LOCATION_IDS = set(range(523, 574))
+
     # Hospital Census
     ALL_BEDS_PER_DAY_MEAN = "allbed_mean"
     ALL_BEDS_PER_DAY_LOWER = "allbed_lower"
@@ -52,49 +58,226 @@ class IHME:
     ICU_BEDS_OVER_UPPER = "icuover_upper"
 
 
+    LATEST_URL = 'https://ihmecovid19storage.blob.core.windows.net/latest/ihme-covid19.zip'
+
+    @staticmethod
+    def value_columns(band=None):
+        """Returns the IHME value column names, optionally only those for one
+        band ('mean', 'lower' or 'upper')."""
+        columns = [v for k, v in vars(IHME).items()
+                   if k.endswith(('_MEAN', '_LOWER', '_UPPER'))]
+        if band is not None:
+            columns = [c for c in columns if c.endswith('_{}'.format(band))]
+        return columns
+
     @staticmethod
-    def get_latest(include_version=False):
+    def _hospitalization_csv_name(z):
+        return [x.filename
+                for x in z.filelist
+                if x.filename.endswith('Hospitalization_all_locs.csv') or
+                x.filename.endswith('Reference_hospitalization_all_locs.csv')
+        ][0]
+
+    @staticmethod
+    def get_latest(include_version=False, columns=None, locations=None, use_cache=True):
         """Gets the latest CSV file from IHME predictions.
 
+        With use_cache, the zip is only downloaded when it has changed upstream
+        (see covidcaremap.cache), and the hospitalization CSV for each model version
+        is converted once to Parquet under data/local/ihme. Later calls for the same
+        model version read the Parquet file memory-mapped, only loading the requested
+        columns and rows.
+
+        Args:
+            include_version: If True, also return the model version.
+            columns: Optional list of columns to read, e.g. IHME.value_columns('mean').
+                The location and date columns are always included. Columns that are
+                not in this model version's output are skipped.
+            locations: Optional list of location names to filter to while reading.
+            use_cache: If False, download and parse the zip directly.
+
         Returns:
             DataFrame or Tuple[DataFrame, str]: Returns the latest results in a DataFramee.
             If include_version is True, returns a tuple with the first element being the
             dataframe of results and the second being the model version string.
         """
-        url = 'https://ihmecovid19storage.blob.core.windows.net/latest/ihme-covid19.zip'
-        r = requests.get(url)
-        z = ZipFile(io.BytesIO(r.content))
-        model_version = os.path.dirname(z.filelist[0].filename)
-
-        latest_csv_name = [x.filename
-                           for x in z.filelist
-                           if x.filename.endswith('Hospitalization_all_locs.csv') or
-                           x.filename.endswith('Reference_hospitalization_all_locs.csv')
-        ][0]
+        if columns is not None:
+            columns = list(dict.fromkeys([IHME.LOCATION, IHME.DATE] + list(columns)))
+
+        if use_cache:
+            df, model_version = IHME._read_cached(columns, locations)
+        else:
+            import requests
+
+            r = requests.get(IHME.LATEST_URL)
+            z = ZipFile(io.BytesIO(r.content))
+            model_version = os.path.dirname(z.filelist[0].filename)
+
+            usecols = None
+            if columns is not None:
+                usecols = lambda c: c in columns
+            df = pd.read_csv(z.open(IHME._hospitalization_csv_name(z)), usecols=usecols)
+            if locations is not None:
+                df = df[df[IHME.LOCATION].isin(locations)].reset_index(drop=True)
 
-        df = pd.read_csv(z.open(latest_csv_name))
         if include_version:
             return (df, model_version)
         else:
             return df
 
+    @staticmethod
+    def _read_cached(columns, locations):
+        zip_path = get_default_cache().fetch(IHME.LATEST_URL)
+        with ZipFile(zip_path) as z:
+            model_version = os.path.dirname(z.filelist[0].filename)
+            parquet_path = local_data_path(
+                os.path.join('ihme', '{}.parquet'.format(model_version.replace(os.sep, '_')))
+            )
+            if not os.path.exists(parquet_path):
+                os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+                tmp_path = parquet_path + '.tmp'
+                pd.read_csv(z.open(IHME._hospitalization_csv_name(z))) \
+                  .to_parquet(tmp_path, index=False)
+                os.replace(tmp_path, parquet_path)
+
+        if columns is not None:
+            import pyarrow.parquet as pq
+            available = set(pq.read_schema(parquet_path).names)
+            columns = [c for c in columns if c in available]
+
+        filters = None
+        if locations is not None:
+            filters = [(IHME.LOCATION, 'in', list(locations))]
+
+        df = pd.read_parquet(parquet_path,
+                             columns=columns,
+                             filters=filters,
+                             memory_map=True)
+        return df, model_version
+
+    @staticmethod
+    def is_value_column(column):
+        """True for IHME columns that hold estimates (ending in _mean, _lower or _upper),
+        which scale with population when disaggregating."""
+        return column.split('_')[-1] in ('lower', 'upper', 'mean')
+
+    @classmethod
+    def get_latest_for_states(cls, columns=None):
+        """Gets the latest IHME predictions for US states, with the state
+        abbreviation in a 'State' column.
+
+        Rows are selected by location ID where the model output has one, so that
+        locations outside the US that share a state's name are left out.
+        """
+        import us
+
+        if columns is not None:
+            columns = list(columns) + [cls.LOCATION_ID]
+
+        state_abbrs = dict((x.name, x.abbr) for x in us.states.STATES)
+        ihme = cls.get_latest(columns=columns, locations=list(state_abbrs))
+        ihme = ihme[ihme[cls.LOCATION].isin(state_abbrs)]
+        if cls.LOCATION_ID in ihme.columns:
+            ihme = ihme[ihme[cls.LOCATION_ID].isin(cls.US_STATE_LOCATION_IDS)]
+        ihme = ihme.copy()
+        ihme['State'] = ihme[cls.LOCATION].map(state_abbrs)
+        return ihme
+
+    @staticmethod
+    def county_weights(counties=None, states=None):
+        """Returns each county's share of its state's population as a
+        DataFrame with GEO_ID, State and proportion_of_state columns."""
+        if counties is None:
+            counties = read_us_counties_gdf()
+        if states is None:
+            states = read_us_states_gdf()
+
+        state_pop = states.set_index('State')['Population']
+        return pd.DataFrame({
+            'GEO_ID': counties['GEO_ID'].values,
+            'State': counties['State'].values,
+            'proportion_of_state': (counties['Population'] /
+                                    counties['State'].map(state_pop)).values
+        })
+
+    @classmethod
+    def disaggregate_to_counties(cls, ihme=None, weights=None, value_columns=None):
+        """Disaggregates state-level IHME predictions to counties based on population.
+
+        The state predictions are arranged into a (state x date x metric) array, which is
+        multiplied by the county weight vector in a single broadcast. County geometry is
+        not involved; join the result to read_us_counties_gdf() on GEO_ID when needed.
+
+        Args:
+            ihme: State-level predictions with a 'State' column and one row per
+                state and date. Defaults to get_latest_for_states().
+            weights: County weights as returned by county_weights(). Defaults to
+                the weights of the processed county data.
+            value_columns: Columns to disaggregate. Defaults to all value columns in ihme.
+
+        Returns:
+            DataFrame: Long frame with GEO_ID, State, date and the disaggregated value
+            columns, one row per county and forecast date.
+        """
+        if ihme is None:
+            ihme = cls.get_latest_for_states()
+        if weights is None:
+            weights = cls.county_weights()
+        if value_columns is None:
+            value_columns = [c for c in ihme.columns if cls.is_value_column(c)]
+
+        if ihme.duplicated(['State', cls.DATE]).any():
+            raise Exception('IHME predictions must have one row per State and date')
+
+        # (state x date x metric) array. State/date pairs missing from
+        # the predictions are NaN and dropped from the result.
+        state_codes, state_index = pd.factorize(ihme['State'], sort=True)
+        date_codes, date_index = pd.factorize(ihme[cls.DATE], sort=True)
+        cube = np.full((len(state_index), len(date_index), len(value_columns)), np.nan)
+        cube[state_codes, date_codes] = ihme[value_columns].to_numpy(dtype=float)
+        present = np.zeros((len(state_index), len(date_index)), dtype=bool)
+        present[state_codes, date_codes] = True
+
+        weights = weights[weights['State'].isin(state_index)]
+        county_state = state_index.get_indexer(weights['State'])
+        county_weight = weights['proportion_of_state'].to_numpy(dtype=float)
+
+        # (county x date x metric)
+        county_cube = cube[county_state] * county_weight[:, np.newaxis, np.newaxis]
+        keep = present[county_state].ravel()
+
+        n_counties, n_dates = len(weights), len(date_index)
+        result = pd.DataFrame(county_cube.reshape(n_counties * n_dates,
+                                                  len(value_columns))[keep],
+                              columns=value_columns)
+        result.insert(0, 'GEO_ID', np.repeat(weights['GEO_ID'].values, n_dates)[keep])
+        result.insert(1, 'State', np.repeat(weights['State'].values, n_dates)[keep])
+        result.insert(2, cls.DATE, np.tile(np.asarray(date_index), n_counties)[keep])
+        return result
+
     @classmethod
     def get_latest_by_county(cls):
         """
         Gets the latest IHME predictions and disggregates them to the
         county level based on population, returns GeoDataFrame of counties.
+
+        Use disaggregate_to_counties to get the county predictions without
+        a copy of the county geometry on every row.
         """
         counties = read_us_counties_gdf()
-        states = read_us_states_gdf()
-
-        state_pop = dict(zip(states['State'], states['Population']))
-        counties['proportion_of_state'] = counties.apply(lambda r: r['Population'] / state_pop.get(r['State']), axis = 1)
+        weights = cls.county_weights(counties=counties)
+        counties['proportion_of_state'] = weights['proportion_of_state'].values
 
-        ihme = cls.get_latest()
-        ihme = ihme[ihme['location_name'].isin([x.name  for x in us.states.STATES])].copy()
-        ihme['State'] = ihme['location_name'].apply(lambda x: us.states.lookup(x).abbr)
+        ihme = cls.get_latest_for_states()
+        value_columns = [c for c in ihme.columns if cls.is_value_column(c)]
+        county_values = cls.disaggregate_to_counties(ihme=ihme,
+                                                     weights=weights,
+                                                     value_columns=value_columns)
 
-        county_ihme = pd.merge(ihme, counties, 'inner', on='State')
-        county_ihme = county_ihme.apply(lambda x: x * county_ihme['proportion_of_state'] if x.name.split('_')[-1] in ('lower', 'upper', 'mean') else x)
+        # Join the non-value IHME columns and the county attributes and geometry
+        # only now, for export.
+        ihme_other = ihme.drop(columns=value_columns)
+        county_ihme = county_values.merge(ihme_other, on=['State', cls.DATE]) \
+                                   .merge(counties.drop(columns=['State']), on='GEO_ID')
 
         return gpd.GeoDataFrame(county_ihme)
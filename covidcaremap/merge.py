@@ -1,23 +1,15 @@
+import os
 from collections import defaultdict
-import json
-from functools import reduce
 
-import folium
 import geopandas as gpd
-import libpysal
 import numpy as np
 import pandas as pd
-import networkx as nx
-from libpysal.cg import fast_knn
-from scipy.spatial.distance import euclidean
-from shapely.geometry import MultiPoint
-from shapely.ops import nearest_points
-from sklearn.preprocessing import normalize
-
-from covidcaremap.geo import spatial_join_facilities
-from covidcaremap.mapping import HospMap
 from rapidfuzz import fuzz
 
+# Columns added to facility records by facility_match_keys.
+MATCH_NAME_KEY = 'match_name_key'
+MATCH_HOUSE_NUMBER = 'match_house_number'
+
 class FacilityMatchResult:
     """Contains the match results from the "match_facilities" method.
 
@@ -29,14 +21,24 @@ class FacilityMatchResult:
         matches_df [DataFrame]: A dataframe only containing the ID columns for each dataset with
             matched facilities.
         unmatched_per_dataset: A dict keyed by dataset key that contains the IDs of unmatched facilities.
+        match_graph [FacilityMatchGraph]: The match graph, which can be saved and passed to
+            a later match_facilities run to only rematch changed facilities.
+        changelog [DataFrame]: If the match was run against a previous match graph, the
+            differences to the previous matches. Each row has the authoritative facility ID,
+            the 'dataset', the 'previous_id' and new 'id' matched from that dataset, and
+            the 'change', one of 'added', 'removed', 'matched', 'unmatched' or 'rematched'.
     """
     def __init__(self,
                  merged_df,
                  matches_df,
-                 unmatched_per_dataset):
+                 unmatched_per_dataset,
+                 match_graph=None,
+                 changelog=None):
         self.merged_df = merged_df
         self.matches = matches_df
         self.unmatched_per_dataset = unmatched_per_dataset
+        self.match_graph = match_graph
+        self.changelog = changelog
 
     def get_unmatched_dict(self):
         """Returns a dict that can be serialized into JSON for the unmatched ids per dataset."""
@@ -45,6 +47,90 @@ class FacilityMatchResult:
             result[dataset_key] = sorted(list(self.unmatched_per_dataset[dataset_key]))
         return result
 
+class FacilityMatchGraph:
+    """The state of a match_facilities run, to rematch only changed facilities later.
+
+    Nodes are the facilities of all datasets, identified by match ID. Arrays of
+    edges hold the candidate pairs of nodes, their distance in meters, and whether
+    the edge is a manual override.
+
+    Args:
+        settings (Dict): The datasets, columns and parameters the match was run with.
+        match_ids: Array of the match ID of each node.
+        fingerprints: Array of a hash of the records of each node.
+        components: Array of the connected component of each node.
+        edge_u: Array of the first node of each edge.
+        edge_v: Array of the second node of each edge.
+        edge_distance: Array of the distance of each edge, in meters.
+        edge_manual: Boolean array of whether each edge is a manual override.
+        matches [DataFrame]: The matches of the run, with an ID column per dataset.
+        match_components: Array of the component each row of matches was reduced from.
+    """
+    # Bump to ignore match graphs saved by earlier versions of the matching code.
+    VERSION = 1
+
+    def __init__(self,
+                 settings,
+                 match_ids,
+                 fingerprints,
+                 components,
+                 edge_u,
+                 edge_v,
+                 edge_distance,
+                 edge_manual,
+                 matches,
+                 match_components):
+        self.settings = settings
+        self.match_ids = match_ids
+        self.fingerprints = fingerprints
+        self.components = components
+        self.edge_u = edge_u
+        self.edge_v = edge_v
+        self.edge_distance = edge_distance
+        self.edge_manual = edge_manual
+        self.matches = matches
+        self.match_components = match_components
+
+    def save(self, path):
+        """Saves the match graph to a .npz file at path."""
+        import json
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                     settings=np.array(json.dumps(self.settings)),
+                     match_ids=self.match_ids,
+                     fingerprints=self.fingerprints,
+                     components=self.components,
+                     edge_u=self.edge_u,
+                     edge_v=self.edge_v,
+                     edge_distance=self.edge_distance,
+                     edge_manual=self.edge_manual,
+                     match_columns=np.array(self.matches.columns, dtype=str),
+                     matches=self.matches.fillna('').values.astype(str),
+                     match_components=self.match_components)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a match graph saved with save."""
+        import json
+
+        with np.load(path) as f:
+            matches = pd.DataFrame(f['matches'].astype(object), columns=list(f['match_columns']))
+            return cls(json.loads(str(f['settings'])),
+                       f['match_ids'],
+                       f['fingerprints'],
+                       f['components'],
+                       f['edge_u'],
+                       f['edge_v'],
+                       f['edge_distance'],
+                       f['edge_manual'],
+                       matches.where(matches != '', None),
+                       f['match_components'])
+
 class FacilityColumns:
     """This class represents the column names for a DataFrame
     that describe the information necessary to perform matching."""
@@ -62,9 +148,12 @@ def match_facilities(facility_datasets,
                      authoritative_dataset,
                      manual_matches_df=None,
                      max_distance=150,
-                     nearest_n=10,
+                     nearest_n=None,
                      meters_crs='epsg:5070',
-                     reducer_fn=None):
+                     reducer_fn=None,
+                     workers=None,
+                     executor=None,
+                     previous_graph=None):
     """Matches facilities. The dataset represented by the authoritative_dataset key
     in the facilities_dfs dict will considered authoritative - all other facilities
     in the remaining datasets will be dropped if they are not matched, and the point
@@ -81,13 +170,31 @@ def match_facilities(facility_datasets,
             columns for each of the ID columns of the datasets with matching IDs in each row.
         max_distance (int, optional): The maximum distance (in meters) that two matches can be apart.
             Defaults to 150 meters.
-        nearest_n (int, optional): The number of neighbors to consider as potential options.
-            Defaults to 10.
+        nearest_n (int, optional): If set, only the nearest_n closest neighbors of each facility
+            are considered as potential options. Defaults to None, which considers every facility
+            within max_distance.
         meters_crs: The EPSG code for the projection to use for meters distance computations.
             Defaults to EPSG:5070 (NAD83 / Conus Albers) for the U.S.
         reducer_fn: Function to reduce potentially matched facilities. Defaults to
             reduce_matched_facility_records. See that function's signature for required
             parameters. Pass in alternate implementations to implement other matching approaches.
+        workers: The number of processes to reduce components in. Components are
+            split into chunks of similar total size, and the result is identical to
+            a serial run. When running in processes, reducer_fn must be picklable,
+            i.e. defined at the top level of a module. Defaults to running serially.
+        executor: An existing concurrent.futures.Executor to reduce the chunks of
+            components in, instead of creating a process pool.
+        previous_graph (FacilityMatchGraph, optional): The match graph of an earlier run,
+            e.g. loaded with FacilityMatchGraph.load. Components whose records, candidate
+            edges and manual overrides are unchanged keep their previous match sets, and only
+            components touched by added, removed or changed records are reduced again. All
+            components are reduced if the earlier run used different settings or another
+            reducer_fn. Reducers are told apart by their module and name only, so match sets
+            are never reused for reducers without a stable name, such as lambdas, nested
+            functions, functools.partial objects or callable instances. Changes to a
+            reducer's code are not detected: bump FacilityMatchGraph.VERSION or start from
+            a fresh graph after changing one. The result's changelog lists the differences
+            to the previous matches.
 
     Result:
         (FacilityMatchResult): The result of the match.
@@ -95,6 +202,9 @@ def match_facilities(facility_datasets,
     Note:
         The resulting dataframes will convert the id columns of any dataset into a str type.
     """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
     MATCH_ID_SEP = '_-_'
 
     if reducer_fn is None:
@@ -103,30 +213,30 @@ def match_facilities(facility_datasets,
     def get_id_column(dataset_key):
         return facility_datasets[dataset_key]['columns'].facility_id
 
-    def get_matched_set(subcomponent):
+    def get_matched_set(component):
         """Method for collecting the data for the reducer_fn based on a
-        connected subcomponent. Returns the records of the matched set and a dictionary
+        connected component. Returns the records of the matched set and a dictionary
         that records the distances between the facilities.
         """
 
         records = []
         distances = {}
         manual_matches = set([])
-        for n in s:
-            ds, facility_id = deconstruct_match_id(n)
-            df = facility_datasets[ds]['df']
-            id_column = facility_datasets[ds]['columns'].facility_id
-            record = df[df[id_column].astype(str) == facility_id].to_dict(orient='record')[0]
+        for node in component_nodes[component]:
+            match_id = nodes[node]
+            ds, facility_id = deconstruct_match_id(match_id)
+            record = dict(records_per_dataset[ds][record_index[ds][facility_id]])
             record['dataset'] = ds
-            record['match_id'] = n
+            record['match_id'] = match_id
             records.append(record)
 
-            for u, v in G.edges(n):
-                edge_data = G.get_edge_data(u, v)
-                distances[(u, v)] = edge_data['weight']
-                if ds == authoritative_dataset and edge_data.get('manual_override', False):
-                    connected_ds, _ = deconstruct_match_id(v)
-                    manual_matches.add((u, connected_ds, v))
+        for e in component_edges[component]:
+            u, v = nodes[edge_u[e]], nodes[edge_v[e]]
+            distances[(u, v)] = distances[(v, u)] = edge_dist[e]
+            if edge_manual[e]:
+                for source, dest in [(u, v), (v, u)]:
+                    if deconstruct_match_id(source)[0] == authoritative_dataset:
+                        manual_matches.add((source, deconstruct_match_id(dest)[0], dest))
 
         return records, distances, manual_matches
 
@@ -160,60 +270,159 @@ def match_facilities(facility_datasets,
     ids = []
     # Set of (x,y) points aligned with ids, in meters_crs
     pts = []
-    # Mapping from match_id -> point
-    ids_to_pts = {}
+
+    # Fingerprints of the records aligned with ids, to find changed
+    # records when rematching against a previous match graph.
+    fingerprints = []
+
+    # Records of each dataset that are needed by a reducer, keyed by position,
+    # and a mapping per dataset from the facility ID (as a str) to the position
+    # of its record.
+    records_per_dataset = {}
+    record_index = {}
 
     # Construct a reprojected geodataframe per dataset, and
-    # record the match ids and points for usage in the KNN
-    # computation below.
+    # record the match ids and points for usage in the
+    # neighbor computation below.
     for dataset_key in dataset_order:
         df = facility_datasets[dataset_key]['df']
         meters_df = df.to_crs(meters_crs)
         id_column = get_id_column(dataset_key)
-        meters_df['match_id'] = '{}{}'.format(dataset_key, MATCH_ID_SEP) + \
-                                          meters_df[id_column].astype(str)
+        facility_ids = meters_df[id_column].astype(str).values
+        meters_df['match_id'] = '{}{}'.format(dataset_key, MATCH_ID_SEP) + facility_ids
         facility_datasets[dataset_key]['meters_df'] = meters_df
 
-        for _, row in meters_df.iterrows():
-            match_id = row['match_id']
-            pt = (row['geometry'].x, row['geometry'].y)
-            ids_to_pts[match_id] = pt
-            ids.append(match_id)
-            pts.append(pt)
-
-    # Compute the K Nearest Neighbors for all points in the dataset.
-    kd_tree = libpysal.cg.KDTree(np.array(pts))
-    nearest_neighbors = libpysal.weights.KNN(kd_tree, k=nearest_n, ids=ids).neighbors
-
-    # For every match, make an edge in a graph. Don't add an edge between
-    # points that are further than the max distance. The weight of the edge
-    # is the distance between them in meters.
-    G = nx.Graph()
-    for match_id in nearest_neighbors:
-        source_pt = ids_to_pts[match_id]
-        G.add_node(match_id)
-        for neighbor_id in nearest_neighbors[match_id]:
-            neighbor_pt = ids_to_pts[neighbor_id]
-            dist = euclidean(source_pt, neighbor_pt)
-            if  dist <= max_distance and not G.has_edge(match_id, neighbor_id):
-                G.add_edge(match_id, neighbor_id, weight=dist)
+        fingerprints.append(_record_fingerprints(df))
+        # Keep the first record for duplicated IDs.
+        record_index[dataset_key] = dict(
+            (facility_id, position)
+            for position, facility_id in reversed(list(enumerate(facility_ids)))
+        )
+
+        ids.extend(meters_df['match_id'].values)
+        pts.append(np.column_stack([meters_df.geometry.x.values,
+                                    meters_df.geometry.y.values]))
+
+    pts = np.concatenate(pts)
+
+    # Each distinct match_id is a node of the match graph.
+    node_of_point, nodes = pd.factorize(np.array(ids, dtype=object))
+    node_fingerprints = np.zeros(len(nodes), dtype=np.uint64)
+    np.add.at(node_fingerprints, node_of_point, np.concatenate(fingerprints))
+    node_index = dict((match_id, node) for node, match_id in enumerate(nodes))
+
+    # Edges between all points within max_distance of each other, stored as
+    # arrays of (node, node, distance in meters, manual override).
+    edges = candidate_edges(pts, max_distance, nearest_n=nearest_n)
+    edge_u = node_of_point[edges[0]]
+    edge_v = node_of_point[edges[1]]
+    edge_dist = edges[2]
+    edge_manual = np.zeros(len(edge_dist), dtype=bool)
 
     # Create edges for manual matches and mark them as such.
     if manual_matches_df is not None:
+        manual_u, manual_v = [], []
         auth_id_column = facility_datasets[authoritative_dataset]['columns'].facility_id
         for _, row in manual_matches_df.iterrows():
             # Get the authoritative dataset ID (required for each row)
             auth_id = construct_match_id(authoritative_dataset, row[auth_id_column])
-            source_pt = ids_to_pts[auth_id]
             for dataset_key in facility_datasets:
                 if dataset_key != authoritative_dataset:
                     id_column = facility_datasets[dataset_key]['columns'].facility_id
                     if id_column in row:
                         if row[id_column]:
                             neighbor_id = construct_match_id(dataset_key, row[id_column])
-                            neighbor_pt = ids_to_pts[neighbor_id]
-                            dist = euclidean(source_pt, neighbor_pt)
-                            G.add_edge(auth_id, neighbor_id, weight=dist, manual_override=True)
+                            manual_u.append(node_index[auth_id])
+                            manual_v.append(node_index[neighbor_id])
+
+        if manual_u:
+            manual_u = np.array(manual_u, dtype=edge_u.dtype)
+            manual_v = np.array(manual_v, dtype=edge_v.dtype)
+            node_pts = np.empty((len(nodes), 2))
+            node_pts[node_of_point] = pts
+            manual_dist = np.sqrt(((node_pts[manual_u] - node_pts[manual_v]) ** 2).sum(axis=1))
+            edge_u = np.concatenate([edge_u, manual_u])
+            edge_v = np.concatenate([edge_v, manual_v])
+            edge_dist = np.concatenate([edge_dist, manual_dist])
+            edge_manual = np.concatenate([edge_manual, np.ones(len(manual_u), dtype=bool)])
+
+    edge_u, edge_v, edge_dist, edge_manual = _dedupe_edges(edge_u, edge_v, edge_dist, edge_manual)
+
+    # Connected components of the match graph, as lists of node
+    # indices, and the edges that belong to each component.
+    graph = coo_matrix((np.ones(len(edge_u), dtype=np.int8), (edge_u, edge_v)),
+                       shape=(len(nodes), len(nodes)))
+    num_components, component_of_node = connected_components(graph, directed=False)
+    node_order = np.argsort(component_of_node, kind='stable')
+    node_splits = np.searchsorted(component_of_node[node_order], np.arange(1, num_components))
+    component_nodes = np.split(node_order, node_splits)
+
+    component_of_edge = component_of_node[edge_u]
+    edge_order = np.argsort(component_of_edge, kind='stable')
+    edge_splits = np.searchsorted(component_of_edge[edge_order], np.arange(1, num_components))
+    component_edges = np.split(edge_order, edge_splits)
+
+    # Authoritative facilities are the first nodes.
+    num_authoritative_nodes = len(set(ids[:len(facility_datasets[authoritative_dataset]['df'])]))
+    has_authoritative = np.bincount(component_of_node[:num_authoritative_nodes],
+                                    minlength=num_components) > 0
+
+    settings = {
+        'version': FacilityMatchGraph.VERSION,
+        'datasets': [[dataset_key,
+                      get_id_column(dataset_key),
+                      facility_datasets[dataset_key]['columns'].facility_name,
+                      facility_datasets[dataset_key]['columns'].street_address,
+                      [str(c) for c in facility_datasets[dataset_key]['df'].columns]]
+                     for dataset_key in dataset_order],
+        'max_distance': float(max_distance),
+        'nearest_n': None if nearest_n is None else int(nearest_n),
+        'meters_crs': str(meters_crs),
+        'reducer': _reducer_identity(reducer_fn)
+    }
+
+    # Find the components that have the same records and edges as a component
+    # of the previous match graph; their match sets are reused as they are.
+    previous_component = np.full(num_components, -1)
+    if previous_graph is not None:
+        previous_id_columns = [d[1] for d in previous_graph.settings['datasets']]
+        if previous_id_columns != [get_id_column(k) for k in dataset_order]:
+            raise Exception('The previous match graph was built from different datasets.')
+        if settings['reducer'] is not None and previous_graph.settings == settings:
+            previous_component = _unchanged_components(previous_graph,
+                                                       nodes,
+                                                       node_fingerprints,
+                                                       component_of_node,
+                                                       num_components,
+                                                       edge_u,
+                                                       edge_v,
+                                                       edge_manual)
+            previous_rows = defaultdict(list)
+            for row, component in enumerate(previous_graph.match_components):
+                previous_rows[component].append(row)
+            previous_matches = previous_graph.matches[[get_id_column(k) for k in dataset_order]] \
+                                             .to_numpy(dtype=object)
+
+    # Only read the records of components that need to be reduced.
+    needed_nodes = [component_nodes[c] for c in np.nonzero(has_authoritative & (previous_component < 0))[0]
+                    if len(component_nodes[c]) > 1]
+    needed_match_ids = nodes[np.concatenate(needed_nodes)] if needed_nodes else []
+    needed_positions = defaultdict(list)
+    for match_id in needed_match_ids:
+        ds, facility_id = deconstruct_match_id(match_id)
+        needed_positions[ds].append(record_index[ds][facility_id])
+    for dataset_key in dataset_order:
+        positions = needed_positions[dataset_key]
+        df = facility_datasets[dataset_key]['df'].iloc[positions]
+        records = df.to_dict(orient='records')
+        # Add the keys the reducer blocks candidate pairs on, computed once per record.
+        keys = facility_match_keys(df, facility_datasets[dataset_key]['columns'])
+        for record, name_key, house_number in zip(records,
+                                                  keys[MATCH_NAME_KEY].values,
+                                                  keys[MATCH_HOUSE_NUMBER].values):
+            record[MATCH_NAME_KEY] = name_key
+            record[MATCH_HOUSE_NUMBER] = house_number
+        records_per_dataset[dataset_key] = dict(zip(positions, records))
 
     # Set up a dict to be turned into the matches dataframe,
     # and a dict that tracks what non-authoritative datasets
@@ -228,41 +437,64 @@ def match_facilities(facility_datasets,
     dataset_columns = dict([(k, facility_datasets[k]['columns']) for k in facility_datasets])
 
     # Iterate over connected components, which gives us the subgraphs that are
-    # matched, and pass this into the reduce_matches method to
-    # reduce down each match to a single matched set.
-    for s in nx.connected_components(G):
-        # Ignore components that don't have a point from the authoritative dataset.
-        if authoritative_dataset in [deconstruct_match_id(m)[0] for m in s]:
-            records, distances, manual_matches = get_matched_set(s)
-            if len(records) == 1:
-                reduced_components = [[records[0]['match_id']]]
-            else:
-                authoritative_records = [r for r in records if r['dataset'] == authoritative_dataset]
-                records_to_match = [r for r in records if r['dataset'] != authoritative_dataset]
-                reduced_components = reducer_fn(authoritative_records,
-                                                records_to_match,
-                                                distances,
-                                                manual_matches,
-                                                dataset_columns)
-
-            for match_set in reduced_components:
-                # Ensure that the set has a facility from the authoritative datatset
-                assert authoritative_dataset in [deconstruct_match_id(match_id)[0]
-                                                 for match_id in match_set]
-
-                ds_ids = {}
-                for m in match_set:
-                    dataset_key, facility_id = deconstruct_match_id(m)
-                    ds_ids[dataset_key] = facility_id
-                    if dataset_key != authoritative_dataset:
-                        matched_ids[dataset_key].add(facility_id)
-
-                for dataset_key in dataset_order:
-                    col = get_id_column(dataset_key)
-                    if not dataset_key in ds_ids:
-                        matches[col].append(None)
-                    else:
-                        matches[col].append(ds_ids[dataset_key])
+    # matched, and collect the arguments to reduce down each match to a
+    # single matched set.
+    reduced_per_component = []
+    reduce_tasks = []
+    # Components that don't have a point from the authoritative dataset are ignored.
+    for component in np.nonzero(has_authoritative)[0]:
+        if previous_component[component] >= 0:
+            reduced_per_component.append((component, [
+                [construct_match_id(dataset_key, facility_id)
+                 for dataset_key, facility_id in zip(dataset_order, previous_matches[row])
+                 if not pd.isnull(facility_id)]
+                for row in previous_rows[previous_component[component]]
+            ]))
+        elif len(component_nodes[component]) == 1:
+            reduced_per_component.append((component, [[nodes[component_nodes[component][0]]]]))
+        else:
+            records, distances, manual_matches = get_matched_set(component)
+            authoritative_records = [r for r in records if r['dataset'] == authoritative_dataset]
+            records_to_match = [r for r in records if r['dataset'] != authoritative_dataset]
+            reduced_per_component.append((component, len(reduce_tasks)))
+            reduce_tasks.append((authoritative_records,
+                                 records_to_match,
+                                 distances,
+                                 manual_matches))
+
+    if workers is None and executor is None:
+        reduced_tasks = _reduce_components(reducer_fn, reduce_tasks, dataset_columns)
+    else:
+        reduced_tasks = _reduce_components_in_executor(reducer_fn,
+                                                       reduce_tasks,
+                                                       dataset_columns,
+                                                       workers,
+                                                       executor)
+
+    match_components = []
+    for component, reduced_components in reduced_per_component:
+        if isinstance(reduced_components, int):
+            reduced_components = reduced_tasks[reduced_components]
+
+        for match_set in reduced_components:
+            # Ensure that the set has a facility from the authoritative datatset
+            assert authoritative_dataset in [deconstruct_match_id(match_id)[0]
+                                             for match_id in match_set]
+
+            ds_ids = {}
+            for m in match_set:
+                dataset_key, facility_id = deconstruct_match_id(m)
+                ds_ids[dataset_key] = facility_id
+                if dataset_key != authoritative_dataset:
+                    matched_ids[dataset_key].add(facility_id)
+
+            for dataset_key in dataset_order:
+                col = get_id_column(dataset_key)
+                if not dataset_key in ds_ids:
+                    matches[col].append(None)
+                else:
+                    matches[col].append(ds_ids[dataset_key])
+            match_components.append(component)
 
     # Construct the FacilityMatchResult and return
     matches_df = pd.DataFrame.from_dict(matches)
@@ -293,7 +525,296 @@ def match_facilities(facility_datasets,
                    .sort_values([facility_datasets[dataset_key]['columns'].facility_id
                                  for dataset_key in dataset_order])
 
-    return FacilityMatchResult(merged_df, matches_df, unmatched_per_dataset)
+    match_graph = FacilityMatchGraph(settings,
+                                     np.array(nodes, dtype=str),
+                                     node_fingerprints,
+                                     component_of_node,
+                                     edge_u,
+                                     edge_v,
+                                     edge_dist,
+                                     edge_manual,
+                                     matches_df,
+                                     np.array(match_components, dtype=np.int64))
+
+    changelog = None
+    if previous_graph is not None:
+        changelog = _match_changelog(previous_graph.matches, matches_df, dataset_order)
+
+    return FacilityMatchResult(merged_df,
+                               matches_df,
+                               unmatched_per_dataset,
+                               match_graph=match_graph,
+                               changelog=changelog)
+
+def _name_key(name):
+    """Key for comparing facility names exactly, ignoring case."""
+    return name.lower() if isinstance(name, str) else None
+
+def _house_number(address):
+    """The leading house number of a street address, or -1 if it has none."""
+    if not isinstance(address, str):
+        return -1
+    first = address.split(' ')[0]
+    # Longer digit strings aren't house numbers, and wouldn't fit an int64.
+    if first.isdecimal() and len(first) <= 18:
+        return int(first)
+    return -1
+
+def facility_match_keys(df, columns):
+    """Computes the keys reduce_matched_facility_records compares facilities by.
+
+    Args:
+        df: DataFrame of facilities.
+        columns (FacilityColumns): The columns of df.
+
+    Returns:
+        DataFrame aligned with df with a MATCH_NAME_KEY column of lowercased names,
+        and a MATCH_HOUSE_NUMBER column of the house numbers parsed from the
+        street addresses, or -1 for addresses that don't start with one.
+    """
+    return pd.DataFrame({
+        MATCH_NAME_KEY: pd.Series([_name_key(name) for name in df[columns.facility_name].tolist()],
+                                  index=df.index,
+                                  dtype=object),
+        MATCH_HOUSE_NUMBER: np.array([_house_number(address)
+                                      for address in df[columns.street_address].tolist()],
+                                     dtype=np.int64)
+    }, index=df.index)
+
+def _pair_ratios(left_values, right_values, left_index, right_index):
+    """Scores the pairs of left_values[left_index[k]] and right_values[right_index[k]]
+    with fuzz.ratio, as a float array aligned with the indexes."""
+    left_values = [left_values[i] for i in left_index]
+    right_values = [right_values[j] for j in right_index]
+    try:
+        from rapidfuzz.process import cpdist
+    except ImportError:
+        # Older rapidfuzz versions without pairwise batch scoring.
+        return np.array([fuzz.ratio(l, r) for l, r in zip(left_values, right_values)],
+                        dtype=float)
+    return cpdist(left_values, right_values, scorer=fuzz.ratio, dtype=np.float64)
+
+def _reducer_identity(reducer_fn):
+    """The module and qualified name of a reducer, or None if it has
+    no name that identifies it across runs."""
+    module = getattr(reducer_fn, '__module__', None)
+    qualname = getattr(reducer_fn, '__qualname__', None)
+    # Callable instances get their class's module, but not its __qualname__.
+    if module is None or qualname is None or '<lambda>' in qualname or '<locals>' in qualname:
+        return None
+    return '{}.{}'.format(module, qualname)
+
+def _record_fingerprints(df):
+    """Returns a hash of each record of a GeoDataFrame, including its geometry."""
+    attributes = pd.util.hash_pandas_object(df.drop(columns=[df.geometry.name]), index=False).values
+    try:
+        wkbs = df.geometry.to_wkb()
+    except AttributeError:
+        # Older geopandas without vectorized WKB export.
+        wkbs = [None if geometry is None else geometry.wkb for geometry in df.geometry]
+    geometry = pd.util.hash_array(np.array([b'' if wkb is None else wkb for wkb in wkbs],
+                                           dtype=object))
+    return attributes * np.uint64(31) + geometry
+
+def _unchanged_components(previous_graph,
+                          match_ids,
+                          fingerprints,
+                          component_of_node,
+                          num_components,
+                          edge_u,
+                          edge_v,
+                          edge_manual):
+    """For each component of a match graph, returns the component of previous_graph
+    with the same records, edges and manual overrides, or -1 if there is none."""
+    previous_node = pd.Index(previous_graph.match_ids).get_indexer(np.asarray(match_ids, dtype=str))
+    unchanged = previous_node >= 0
+    unchanged[unchanged] = previous_graph.fingerprints[previous_node[unchanged]] == fingerprints[unchanged]
+    previous_component = np.full(len(previous_node), -1, dtype=np.int64)
+    previous_component[unchanged] = previous_graph.components[previous_node[unchanged]]
+
+    # A candidate has all nodes unchanged and in a single previous component
+    # of the same size.
+    low = np.full(num_components, np.iinfo(np.int64).max)
+    high = np.full(num_components, -1)
+    np.minimum.at(low, component_of_node, previous_component)
+    np.maximum.at(high, component_of_node, previous_component)
+    candidate = np.where((low == high) & (low >= 0), low, -1)
+
+    previous_sizes = np.bincount(previous_graph.components)
+    sizes = np.bincount(component_of_node, minlength=num_components)
+    candidate[candidate >= 0] = np.where(
+        previous_sizes[candidate[candidate >= 0]] == sizes[candidate >= 0],
+        candidate[candidate >= 0],
+        -1
+    )
+
+    # ... and the same edges, including which of them are manual overrides.
+    def edge_keys(u, v, manual):
+        u, v = np.minimum(u, v), np.maximum(u, v)
+        return (u * len(previous_graph.match_ids) + v) * 2 + manual
+
+    pu, pv = previous_node[edge_u], previous_node[edge_v]
+    known = (pu >= 0) & (pv >= 0)
+    known[known] = np.isin(edge_keys(pu[known], pv[known], edge_manual[known]),
+                           edge_keys(previous_graph.edge_u,
+                                     previous_graph.edge_v,
+                                     previous_graph.edge_manual))
+    unknown_edges = np.bincount(component_of_node[edge_u[~known]], minlength=num_components)
+    edge_counts = np.bincount(component_of_node[edge_u], minlength=num_components)
+    previous_edge_counts = np.bincount(previous_graph.components[previous_graph.edge_u],
+                                       minlength=len(previous_sizes))
+
+    has_candidate = candidate >= 0
+    same_edges = np.zeros(num_components, dtype=bool)
+    same_edges[has_candidate] = ((unknown_edges[has_candidate] == 0) &
+                                 (edge_counts[has_candidate] ==
+                                  previous_edge_counts[candidate[has_candidate]]))
+    return np.where(same_edges, candidate, -1)
+
+def _match_changelog(previous_matches, matches_df, dataset_order):
+    """Lists the differences between two matches dataframes. See
+    FacilityMatchResult for the columns."""
+    id_columns = list(matches_df.columns)
+    auth_column = id_columns[0]
+    previous = previous_matches.set_index(auth_column)
+    current = matches_df.set_index(auth_column)
+    auth_ids = previous.index.union(current.index)
+    previous = previous.reindex(auth_ids).astype(object)
+    current = current.reindex(auth_ids).astype(object)
+
+    changes = []
+    auth_ids = pd.Series(auth_ids, index=auth_ids, dtype=object)
+    added = ~auth_ids.isin(previous_matches[auth_column])
+    removed = ~auth_ids.isin(matches_df[auth_column])
+    for mask, change in [(added, 'added'), (removed, 'removed')]:
+        ids = auth_ids[mask].values
+        missing = np.full(len(ids), None, dtype=object)
+        changes.append(pd.DataFrame({
+            auth_column: ids,
+            'dataset': dataset_order[0],
+            'previous_id': ids if change == 'removed' else missing,
+            'id': ids if change == 'added' else missing,
+            'change': change
+        }))
+
+    for dataset_key, id_column in zip(dataset_order[1:], id_columns[1:]):
+        previous_ids = np.where(previous[id_column].isnull(), None, previous[id_column])
+        ids = np.where(current[id_column].isnull(), None, current[id_column])
+        changed = previous_ids != ids
+        change = np.where(pd.isnull(previous_ids), 'matched',
+                          np.where(pd.isnull(ids), 'unmatched', 'rematched'))
+        changes.append(pd.DataFrame({
+            auth_column: auth_ids.values[changed],
+            'dataset': dataset_key,
+            'previous_id': previous_ids[changed],
+            'id': ids[changed],
+            'change': change[changed]
+        }))
+
+    changelog = pd.concat(changes, ignore_index=True)
+    changelog['dataset'] = pd.Categorical(changelog['dataset'], categories=dataset_order)
+    changelog = changelog.sort_values([auth_column, 'dataset'], kind='stable')
+    changelog['dataset'] = changelog['dataset'].astype(object)
+    for column in ['previous_id', 'id']:
+        changelog[column] = changelog[column].astype(object).where(changelog[column].notnull(), None)
+    return changelog.reset_index(drop=True)
+
+def _reduce_components(reducer_fn, tasks, dataset_columns):
+    """Runs reducer_fn for each (authoritative_records, records_to_match,
+    distances, manual_matches) task, returning the results in task order."""
+    return [reducer_fn(authoritative_records,
+                       records_to_match,
+                       distances,
+                       manual_matches,
+                       dataset_columns)
+            for authoritative_records, records_to_match, distances, manual_matches in tasks]
+
+def _reduce_components_in_executor(reducer_fn, tasks, dataset_columns, workers=None, executor=None):
+    """Splits the reduce tasks into chunks of similar cost and runs them in a
+    process pool (or the given executor). Results are returned in task order."""
+    import heapq
+    from concurrent.futures import ProcessPoolExecutor
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Reducers score every authoritative record against every other record of
+    # a component, so the cost of a component grows with that product. Assign
+    # the most expensive components first, each to the cheapest chunk so far,
+    # so a single large urban component ends up in a chunk of its own.
+    n_chunks = max(1, min(len(tasks), workers * 4))
+    costs = [len(task[0]) * max(len(task[1]), 1) for task in tasks]
+    chunk_heap = [(0, c) for c in range(n_chunks)]
+    chunk_tasks = [[] for _ in range(n_chunks)]
+    for i in sorted(range(len(tasks)), key=lambda i: costs[i], reverse=True):
+        cost, c = heapq.heappop(chunk_heap)
+        chunk_tasks[c].append(i)
+        heapq.heappush(chunk_heap, (cost + costs[i], c))
+
+    def run(executor):
+        futures = [executor.submit(_reduce_components,
+                                   reducer_fn,
+                                   [tasks[i] for i in chunk],
+                                   dataset_columns)
+                   for chunk in chunk_tasks if chunk]
+        results = [None] * len(tasks)
+        for chunk, future in zip([chunk for chunk in chunk_tasks if chunk], futures):
+            for i, result in zip(chunk, future.result()):
+                results[i] = result
+        return results
+
+    if executor is not None:
+        return run(executor)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return run(executor)
+
+def candidate_edges(pts, max_distance, nearest_n=None):
+    """Finds the pairs of points that are within max_distance of each other.
+
+    Args:
+        pts: Array of shape (n, 2) of point coordinates, in meters.
+        max_distance: The maximum distance between the points of a pair.
+        nearest_n (int, optional): If set, a pair is only kept if one of its
+            points is among the nearest_n closest neighbors of the other.
+
+    Returns:
+        Tuple of arrays (i, j, distance), sorted by (i, j) and with i < j.
+    """
+    from scipy.spatial import cKDTree
+
+    pairs = cKDTree(pts).query_pairs(max_distance, output_type='ndarray')
+    i, j = pairs[:, 0], pairs[:, 1]
+    dist = np.sqrt(((pts[i] - pts[j]) ** 2).sum(axis=1))
+
+    if nearest_n is not None and len(dist):
+        # Rank each pair among the pairs of both of its points, by distance.
+        source = np.concatenate([i, j])
+        neighbor = np.concatenate([j, i])
+        order = np.lexsort((neighbor, np.concatenate([dist, dist]), source))
+        group_start = np.searchsorted(source[order], source[order])
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order)) - group_start
+        keep = (rank[:len(dist)] < nearest_n) | (rank[len(dist):] < nearest_n)
+        i, j, dist = i[keep], j[keep], dist[keep]
+
+    order = np.lexsort((j, i))
+    return i[order], j[order], dist[order]
+
+def _dedupe_edges(u, v, dist, manual):
+    """Makes edges undirected and unique, dropping self loops. An edge is
+    marked as a manual override if any of its duplicates was."""
+    u, v = np.minimum(u, v), np.maximum(u, v)
+    keep = u != v
+    u, v, dist, manual = u[keep], v[keep], dist[keep], manual[keep]
+
+    order = np.lexsort((v, u))
+    u, v, dist, manual = u[order], v[order], dist[order], manual[order]
+    first = np.ones(len(u), dtype=bool)
+    first[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    group = np.cumsum(first) - 1
+    any_manual = np.zeros(first.sum(), dtype=bool)
+    np.logical_or.at(any_manual, group, manual)
+    return u[first], v[first], dist[first], any_manual
 
 def reduce_matched_facility_records(authoritative_records,
                                     records_to_match,
@@ -305,7 +826,12 @@ def reduce_matched_facility_records(authoritative_records,
     Implementations can override this to implement their own matching approaches.
     Records contain all fields from the dataset dataframe as well as
     a 'match_id', which is the ID that contains the dataset information as well,
-    and a 'dataset' which is the dataset identifier.
+    and a 'dataset' which is the dataset identifier. match_facilities also adds the
+    keys computed by facility_match_keys, which are otherwise computed here.
+
+    Pairs whose addresses both start with a house number, and the numbers differ,
+    are only scored if their names match case insensitively. The remaining pairs
+    are scored by the fuzz.ratio of their names and then their addresses.
 
     Args:
         authoritative_records (List[Dict]): The records for the facilities
@@ -326,18 +852,6 @@ def reduce_matched_facility_records(authoritative_records,
         list should not contain any duplicate IDs from the same dataset and should contain at least
         one ID from the authoritative dataset.
     """
-    def address_could_match(address1, address2):
-        """Returns true if these addresses could match.
-        Returns false if the mailbox number is different between the two
-        """
-        parts1 = address1.split(' ')
-        parts2 = address2.split(' ')
-
-        if parts1[0].isnumeric() and parts2[0].isnumeric():
-            return int(parts1[0]) == int(parts2[0])
-        else:
-            return True
-
     result = []
     match_records_by_dataset = defaultdict(list)
     for record in records_to_match:
@@ -351,69 +865,89 @@ def reduce_matched_facility_records(authoritative_records,
             key=lambda r: r[id_column]
         )
 
-    # List of (source_id, dataset_key, dest_id, name_score, address_score)
-    scored_edges = []
+    def record_keys(records):
+        """Returns the names, addresses, name keys and house numbers of the records."""
+        columns = dataset_columns[records[0]['dataset']]
+        names = [r[columns.facility_name] for r in records]
+        addresses = [r[columns.street_address] for r in records]
+        name_keys = [r[MATCH_NAME_KEY] if MATCH_NAME_KEY in r else _name_key(name)
+                     for r, name in zip(records, names)]
+        house_numbers = np.array([r[MATCH_HOUSE_NUMBER] if MATCH_HOUSE_NUMBER in r
+                                  else _house_number(address)
+                                  for r, address in zip(records, addresses)], dtype=np.int64)
+        return names, addresses, name_keys, house_numbers
+
+    # Candidate edges as arrays of (source index, dataset index, dest index,
+    # name score, address score).
+    edge_arrays = []
+    dataset_keys = list(match_records_by_dataset)
 
     # Determine if each source record may be a match with the records
     # from non-authoritative datasets. If so, assign a score based on
-    # the name and address columns, and add to scored_edges.
-    for source_record in authoritative_records:
-        source_id = source_record['match_id']
-
-        source_name_column = dataset_columns[source_record['dataset']].facility_name
-        source_address_column = dataset_columns[source_record['dataset']].street_address
-
-        source_name = source_record[source_name_column]
-        source_address = source_record[source_address_column]
-
-        for dataset_key in match_records_by_dataset:
-            dest_name_column = dataset_columns[dataset_key].facility_name
-            dest_address_column = dataset_columns[dataset_key].street_address
-
-            dest_records = match_records_by_dataset[dataset_key]
-            for dest_record in dest_records:
-                dest_id = dest_record['match_id']
-                dest_name = dest_record[dest_name_column]
-
-                might_match = False
-
-                # Check to see if the address make this match unreasonable
-                address_possible = address_could_match(source_address, dest_record[dest_address_column])
-
-                if address_possible:
-                    might_match = True
-                else:
-                    # If the address don't match, only consider it if the names match exactly.
-                    if source_name.lower() == dest_name.lower():
-                        might_match = True
-
-                if might_match:
-                    name_score = fuzz.ratio(source_name, dest_name)
-                    address_score = fuzz.ratio(source_address, dest_record[dest_address_column])
-
-                    scored_edges.append((source_id, dataset_key, dest_id, name_score, address_score))
+    # the name and address columns.
+    if authoritative_records:
+        source_names, source_addresses, source_name_keys, source_numbers = \
+            record_keys(authoritative_records)
+    else:
+        dataset_keys = []
+
+    for dataset_index, dataset_key in enumerate(dataset_keys):
+        dest_names, dest_addresses, dest_name_keys, dest_numbers = \
+            record_keys(match_records_by_dataset[dataset_key])
+
+        # The addresses make a match unreasonable if both have a house number
+        # and they differ. In that case, only consider it if the names match exactly.
+        address_possible = ((source_numbers[:, None] < 0) |
+                            (dest_numbers[None, :] < 0) |
+                            (source_numbers[:, None] == dest_numbers[None, :]))
+        name_codes = {}
+        source_codes = np.array([-1 if k is None else name_codes.setdefault(k, len(name_codes))
+                                 for k in source_name_keys], dtype=np.int64)
+        dest_codes = np.array([-1 if k is None else name_codes.setdefault(k, len(name_codes))
+                               for k in dest_name_keys], dtype=np.int64)
+        same_name = ((source_codes[:, None] == dest_codes[None, :]) &
+                     (source_codes[:, None] >= 0))
+
+        source_index, dest_index = np.nonzero(address_possible | same_name)
+        if len(source_index) == 0:
+            continue
+
+        # Only the pairs that survived blocking are scored.
+        edge_arrays.append((source_index,
+                            np.full(len(source_index), dataset_index),
+                            dest_index,
+                            _pair_ratios(source_names, dest_names, source_index, dest_index),
+                            _pair_ratios(source_addresses, dest_addresses,
+                                         source_index, dest_index)))
 
     matched_to_source = defaultdict(dict)
-    matched_by_ds = defaultdict(list)
+    matched_by_ds = defaultdict(set)
 
     # Assign matches based on manual override first.
     for source_id, dataset_key, dest_id in manual_matches:
         matched_to_source[source_id][dataset_key] = dest_id
-        matched_by_ds[dataset_key].append(dest_id)
+        matched_by_ds[dataset_key].add(dest_id)
 
     # Assign matches based on the highest scores.
     # Go through the scored edges in descending order and assign matches
     # if there remaining matches available based on what has been previously
     # matched and only matching a single facility from a dataset_key.
-    sorted_scored_edges = sorted(scored_edges, key=lambda e: (e[3], e[4]), reverse=True)
-    for source_id, dataset_key, dest_id, _, _ in sorted_scored_edges:
-        # Don't take this edge if the dest_id is already matched
-        if dest_id not in matched_by_ds[dataset_key]:
-            source_matches = matched_to_source[source_id]
-            # Don't take this edge if the source_id is already matched to this dataset
-            if dataset_key not in source_matches:
-                source_matches[dataset_key] = dest_id
-                matched_by_ds[dataset_key].append(dest_id)
+    # Ties keep the order of source, dataset and dest records.
+    if edge_arrays:
+        source_index, dataset_index, dest_index, name_scores, address_scores = \
+            [np.concatenate(a) for a in zip(*edge_arrays)]
+        order = np.lexsort((dest_index, dataset_index, source_index, -address_scores, -name_scores))
+        for e in order:
+            source_id = authoritative_records[source_index[e]]['match_id']
+            dataset_key = dataset_keys[dataset_index[e]]
+            dest_id = match_records_by_dataset[dataset_key][dest_index[e]]['match_id']
+            # Don't take this edge if the dest_id is already matched
+            if dest_id not in matched_by_ds[dataset_key]:
+                source_matches = matched_to_source[source_id]
+                # Don't take this edge if the source_id is already matched to this dataset
+                if dataset_key not in source_matches:
+                    source_matches[dataset_key] = dest_id
+                    matched_by_ds[dataset_key].add(dest_id)
 
     # Create match sets for each source record.
     for source_record in authoritative_records:
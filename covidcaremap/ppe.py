@@ -8,7 +8,6 @@ from collections import defaultdict
 from itertools import chain
 
 import numpy as np
-import pandas as pd
 
 DEFAULT_PARAMS = {
 
@@ -76,6 +75,9 @@ BP_CUFF_ETC = 'bp_cuff_etc' # BP Cuff, Stethoscope, Pulse Ox, Ambu Bag
 VENT = 'ventilator'
 PAPR = 'papr'
 
+# Supplies reported by default
+DEFAULT_PPES = [N95, GOWN, DROPLET_MASK, GLOVES, WIPES]
+
 class SupplyCounts:
     def __init__(self, counts=None):
         if counts is None:
@@ -353,7 +355,7 @@ def calculate_ppe_burn_for_day(new_hospitalized,
         params = DEFAULT_PARAMS
 
     if ppes is None:
-        ppes = [N95, GOWN, DROPLET_MASK, GLOVES, WIPES]
+        ppes = DEFAULT_PPES
 
     if new_triaged is None:
         # Estimate based on ratio
@@ -384,3 +386,292 @@ def calculate_ppe_burn_for_day(new_hospitalized,
 
     result = dict([(ppe, math.ceil(counts.get(ppe, np.nan))) for ppe in ppes])
     return result
+
+### ARRAY-BACKED MODEL ###
+
+STAGES = [TRIAGE, HOSPITALIZED, ICU]
+
+SUPPLIES = [N95, GOWN, DROPLET_MASK, GLOVES, WIPES, TEST_KIT,
+            GOGGLES, BP_CUFF_ETC, VENT, PAPR]
+
+class SupplyModelArrays:
+    """A supply model per stage compiled into dense arrays.
+
+    Stages and supplies are laid out in the order of the STAGES and SUPPLIES
+    constants (or the stages and supplies given), and looked up by name through
+    stage_index and supply_index. Stages or supplies in the model that are not
+    part of that layout raise an error rather than being dropped. Staff types are
+    ordered by their first appearance in the model, so that sums are accumulated
+    in the same order as calculate_ppe_burn_for_day.
+
+    Attributes:
+        stages: Stage names, the first axis of every array.
+        staff: Staff types, the second axis of the per staff arrays.
+        supplies: Supply names, the last axis of the count arrays.
+        stage_index: Dict of stage name -> index into the first axis.
+        supply_index: Dict of supply name -> index into the last axis.
+        per_patient: (stage x supply) counts used per patient.
+        per_shift: (stage x staff x supply) counts used per staff shift.
+        per_encounter: (stage x staff x supply) counts used per patient encounter.
+        num_patients_per: (stage x staff) patients covered by one staff member,
+            NaN where the stage has no such staff.
+        encounters_per_patient: (stage x staff) encounters per patient.
+        known: (supply) True for supplies that appear anywhere in the model.
+    """
+    def __init__(self, supply_model_per_stage, stages=None, supplies=None):
+        if stages is None:
+            stages = STAGES
+        if supplies is None:
+            supplies = SUPPLIES
+
+        self.stages = list(stages)
+        self.supplies = list(supplies)
+        self.stage_index = dict((stage, i) for i, stage in enumerate(self.stages))
+        self.supply_index = dict((supply, k) for k, supply in enumerate(self.supplies))
+
+        unknown = set(supply_model_per_stage) - set(self.stage_index)
+        if unknown:
+            raise Exception('Unknown stages in supply model: {}'.format(
+                ', '.join(sorted(unknown))))
+        missing = set(self.stage_index) - set(supply_model_per_stage)
+        if missing:
+            raise Exception('Stages missing from supply model: {}'.format(
+                ', '.join(sorted(missing))))
+
+        staff = []
+        for stage in self.stages:
+            for staff_type in supply_model_per_stage[stage].per_staff:
+                if staff_type not in staff:
+                    staff.append(staff_type)
+
+        self.staff = staff
+
+        shape = (len(self.stages), len(staff), len(self.supplies))
+        self.per_patient = np.zeros((len(self.stages), len(self.supplies)))
+        self.per_shift = np.zeros(shape)
+        self.per_encounter = np.zeros(shape)
+        self.num_patients_per = np.full(shape[:2], np.nan)
+        self.encounters_per_patient = np.zeros(shape[:2])
+        self.known = np.zeros(len(self.supplies), dtype=bool)
+
+        def fill(target, supply_counts):
+            k = self.supply_indices(supply_counts.counts)
+            target[k] = list(supply_counts.counts.values())
+            self.known[k] = True
+
+        for stage, stage_model in supply_model_per_stage.items():
+            i = self.stage_index[stage]
+            fill(self.per_patient[i], stage_model.per_patient)
+            for staff_type, staff_model in stage_model.per_staff.items():
+                j = staff.index(staff_type)
+                fill(self.per_shift[i, j], staff_model.per_shift_counts)
+                fill(self.per_encounter[i, j], staff_model.per_encounter_counts)
+                self.num_patients_per[i, j] = staff_model.num_patients_per
+                self.encounters_per_patient[i, j] = staff_model.encounters_per_patient
+
+    def supply_indices(self, supplies):
+        """Returns the indices into the supply axis of the given supply names.
+
+        Raises an exception for supplies that are not part of this model.
+        """
+        unknown = [supply for supply in supplies if supply not in self.supply_index]
+        if unknown:
+            raise Exception('Unknown supplies: {}'.format(', '.join(unknown)))
+        return [self.supply_index[supply] for supply in supplies]
+
+SUPPLY_MODEL_ARRAYS = SupplyModelArrays(SUPPLY_MODEL_PER_STAGE)
+
+def calculate_ppe_burn(new_hospitalized,
+                       new_icu,
+                       new_triaged=None,
+                       params=None,
+                       ppes=None,
+                       model=None,
+                       in_hospital=None,
+                       in_icu=None):
+    """Vectorized calculate_ppe_burn_for_day for many rows at once.
+
+    Per patient supplies are counted for new patients. Staff, and so the
+    per shift and per encounter supplies, are sized to the patients in care,
+    which are the new patients unless in_hospital or in_icu is supplied.
+
+    Args:
+        new_hospitalized: Array of new hospitalized patients per row.
+        new_icu: Array of new ICU patients per row.
+        new_triaged: Optional array of new triaged patients per row. Estimated from
+            new_hospitalized if not supplied.
+        params: PPE model parameters. Defaults to DEFAULT_PARAMS.
+        ppes: Supplies to report. Defaults to DEFAULT_PPES.
+        model: SupplyModelArrays to use. Defaults to SUPPLY_MODEL_ARRAYS.
+        in_hospital: Optional array of hospitalized patients in care per row,
+            e.g. a hospital census.
+        in_icu: Optional array of ICU patients in care per row.
+
+    Returns:
+        Float array of shape (rows x ppes). Without in_hospital and in_icu this
+        holds the same values calculate_ppe_burn_for_day returns for each row.
+    """
+    if params is None:
+        params = DEFAULT_PARAMS
+    if ppes is None:
+        ppes = DEFAULT_PPES
+    if model is None:
+        model = SUPPLY_MODEL_ARRAYS
+
+    new_hospitalized = np.asarray(new_hospitalized, dtype=float)
+    new_icu = np.asarray(new_icu, dtype=float)
+    if new_triaged is None:
+        # Estimate based on ratio
+        new_triaged = new_hospitalized / params['hospitalized_to_traiged_ratio']
+    new_triaged = np.asarray(new_triaged, dtype=float)
+
+    patients_per_stage = {
+        TRIAGE: new_triaged,
+        HOSPITALIZED: new_hospitalized,
+        ICU: new_icu
+    }
+    patients_in_care = dict(patients_per_stage)
+    if in_hospital is not None:
+        patients_in_care[HOSPITALIZED] = np.asarray(in_hospital, dtype=float)
+    if in_icu is not None:
+        patients_in_care[ICU] = np.asarray(in_icu, dtype=float)
+
+    counts = np.zeros((len(new_hospitalized), len(model.supplies)))
+
+    def add(per_unit, units):
+        present = per_unit != 0
+        counts[:, present] += per_unit[present] * units[:, np.newaxis]
+
+    for stage, patient_count in patients_per_stage.items():
+        if stage not in model.stage_index:
+            raise Exception('Stage {} is not part of the supply model'.format(stage))
+        i = model.stage_index[stage]
+        add(model.per_patient[i], patient_count)
+        for j in np.nonzero(~np.isnan(model.num_patients_per[i]))[0]:
+            staff_needed = np.ceil(patients_in_care[stage] / model.num_patients_per[i, j])
+            add(model.per_shift[i, j], staff_needed * params['shifts_per_day'])
+            add(model.per_encounter[i, j], staff_needed * model.encounters_per_patient[i, j])
+
+    counts = np.where(model.known, np.ceil(counts), np.nan)
+    return counts[:, model.supply_indices(ppes)]
+
+### PROJECTIONS ###
+
+# Supplies that are reused rather than consumed, and so are accounted
+# as an inventory over time instead of a daily burn.
+REUSABLE = [GOGGLES, BP_CUFF_ETC, VENT, PAPR]
+
+def project_ppe_burn(forecast_df,
+                     region_column,
+                     day_column,
+                     new_hospitalized_columns,
+                     new_icu_columns,
+                     new_triaged_columns=None,
+                     in_hospital_columns=None,
+                     in_icu_columns=None,
+                     params=None,
+                     ppes=None,
+                     model=None):
+    """Projects PPE burn over a forecast series for every region at once.
+
+    All rows of every band are run through calculate_ppe_burn in a single call.
+    Disposable supplies get a daily and a cumulative burn per region. Reusable
+    supplies (see REUSABLE) get the daily count in use, the inventory that has
+    to be on hand by that day (the running maximum in use), and the number of
+    items acquired that day to grow the inventory.
+
+    Args:
+        forecast_df: DataFrame with one row per region and day.
+        region_column: The column holding the region ID.
+        day_column: The column holding the day or date.
+        new_hospitalized_columns: Dict of band name -> column of new hospitalized patients.
+        new_icu_columns: Dict of band name -> column of new ICU patients.
+        new_triaged_columns: Optional dict of band name -> column of new triaged patients.
+            Estimated from new hospitalized patients if not supplied.
+        in_hospital_columns: Optional dict of band name -> column of hospitalized
+            patients in care, which staffing is sized to. See calculate_ppe_burn.
+        in_icu_columns: Optional dict of band name -> column of ICU patients in care.
+        params: PPE model parameters. Defaults to DEFAULT_PARAMS.
+        ppes: Supplies to project. Defaults to every supply in the model.
+        model: SupplyModelArrays to use. Defaults to SUPPLY_MODEL_ARRAYS.
+
+    Returns:
+        DataFrame sorted by region and day with columns '<supply>_<band>' and
+        '<supply>_cumulative_<band>' for disposable supplies, and '<supply>_<band>',
+        '<supply>_inventory_<band>' and '<supply>_acquired_<band>' for reusable ones.
+    """
+    import pandas as pd
+
+    if model is None:
+        model = SUPPLY_MODEL_ARRAYS
+    if ppes is None:
+        ppes = [supply for supply, known in zip(model.supplies, model.known) if known]
+
+    df = forecast_df.sort_values([region_column, day_column], kind='stable')
+    bands = list(new_hospitalized_columns)
+    n = len(df)
+
+    def stack(columns):
+        if columns is None:
+            return None
+        return np.concatenate([df[columns[band]].to_numpy(dtype=float) for band in bands])
+
+    burn = calculate_ppe_burn(stack(new_hospitalized_columns),
+                              stack(new_icu_columns),
+                              new_triaged=stack(new_triaged_columns),
+                              params=params,
+                              ppes=ppes,
+                              model=model,
+                              in_hospital=stack(in_hospital_columns),
+                              in_icu=stack(in_icu_columns))
+
+    regions = pd.factorize(df[region_column])[0]
+    result = {
+        region_column: df[region_column].to_numpy(),
+        day_column: df[day_column].to_numpy()
+    }
+    for b, band in enumerate(bands):
+        daily = pd.DataFrame(burn[b * n:(b + 1) * n], columns=ppes)
+        by_region = daily.groupby(regions)
+        cumulative = by_region.cumsum()
+        inventory = by_region.cummax()
+        acquired = inventory - inventory.groupby(regions).shift(1, fill_value=0)
+        for ppe in ppes:
+            result['{}_{}'.format(ppe, band)] = daily[ppe].to_numpy()
+            if ppe in REUSABLE:
+                result['{}_inventory_{}'.format(ppe, band)] = inventory[ppe].to_numpy()
+                result['{}_acquired_{}'.format(ppe, band)] = acquired[ppe].to_numpy()
+            else:
+                result['{}_cumulative_{}'.format(ppe, band)] = cumulative[ppe].to_numpy()
+
+    return pd.DataFrame(result)
+
+def project_ppe_burn_from_ihme(ihme_df, bands=('lower', 'mean', 'upper'), **kwargs):
+    """Projects PPE burn from an IHME forecast (see IHME.get_latest) using
+    its admissions and new ICU columns, with staffing sized to the beds in
+    use. See project_ppe_burn for kwargs."""
+    from covidcaremap.ihme import IHME
+
+    return project_ppe_burn(ihme_df,
+                            IHME.LOCATION,
+                            IHME.DATE,
+                            dict((band, 'admis_{}'.format(band)) for band in bands),
+                            dict((band, 'newICU_{}'.format(band)) for band in bands),
+                            in_hospital_columns=dict((band, 'allbed_{}'.format(band))
+                                                     for band in bands),
+                            in_icu_columns=dict((band, 'ICUbed_{}'.format(band))
+                                                for band in bands),
+                            **kwargs)
+
+def project_ppe_burn_from_chime(predictions_df, region_id_column, **kwargs):
+    """Projects PPE burn from CHIME regional predictions (see
+    chime.get_regional_predictions) using their admissions as the 'mean' band,
+    with staffing sized to their census. See project_ppe_burn for kwargs."""
+    return project_ppe_burn(predictions_df,
+                            region_id_column,
+                            'day',
+                            { 'mean': 'hospitalized_admitted' },
+                            { 'mean': 'icu_admitted' },
+                            in_hospital_columns={ 'mean': 'hospitalized_census' },
+                            in_icu_columns={ 'mean': 'icu_census' },
+                            **kwargs)
@@ -1,9 +1,86 @@
-import io
+def _open_csv_source(url, use_cache):
+    """Returns something pd.read_csv can parse incrementally: the path to
+    the cached download, or the raw socket stream of the response."""
+    if use_cache:
+        from covidcaremap.cache import get_default_cache
+        return get_default_cache().fetch(url)
 
-import pandas as pd
-import requests
+    import requests
+    r = requests.get(url, stream=True)
+    r.raise_for_status()
+    # Let urllib3 undo any gzip/deflate transfer encoding while streaming.
+    r.raw.decode_content = True
+    return r.raw
 
-def fetch_df(url):
-    """Fetches a Pandas DataFrame from a remote source"""
-    r = requests.get(url)
-    return pd.read_csv(io.BytesIO(r.content))
+def fetch_df(url, use_cache=True, usecols=None, dtype=None, chunksize=None):
+    """Fetches a Pandas DataFrame from a remote source
+
+    The CSV is parsed while it is read, either from the on-disk cache or
+    directly off the network, so the full response body is never held in
+    memory. Pass usecols to only build the columns that are needed.
+
+    Args:
+        url: URL of the CSV to fetch.
+        use_cache: If True, the download is served from and stored in the
+            on-disk download cache (see covidcaremap.cache), and is only
+            re-downloaded when the remote content has changed.
+        usecols: Columns to parse, as accepted by pd.read_csv. All other
+            columns are skipped during parsing.
+        dtype: Column dtype hints, as accepted by pd.read_csv.
+        chunksize: If set, returns an iterator of DataFrames with
+            chunksize rows each instead of a single DataFrame. With
+            use_cache=False the iterator owns the network stream: it is
+            closed once the iterator is exhausted or closed.
+    """
+    import pandas as pd
+
+    source = _open_csv_source(url, use_cache)
+    if chunksize is not None:
+        chunks = pd.read_csv(source,
+                             usecols=usecols,
+                             dtype=dtype,
+                             chunksize=chunksize)
+        if use_cache:
+            return chunks
+        return _closing_chunks(chunks, source)
+    try:
+        return pd.read_csv(source, usecols=usecols, dtype=dtype)
+    finally:
+        if not use_cache:
+            source.close()
+
+def _closing_chunks(chunks, source):
+    """Yields the chunks, closing source when done."""
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        source.close()
+
+def fetch_dfs(urls, max_workers=8, **kwargs):
+    """Fetches several remote CSVs concurrently through the download cache.
+
+    Args:
+        urls: URLs of the CSVs to fetch.
+        max_workers: Maximum number of concurrent downloads.
+        kwargs: Passed to fetch_df for each URL. With use_cache=False
+            nothing is prefetched, and each URL is downloaded in turn.
+
+    Returns:
+        A list of DataFrames in the same order as urls.
+    """
+    if kwargs.get('use_cache', True):
+        from covidcaremap.cache import get_default_cache
+        get_default_cache().fetch_all(urls, max_workers=max_workers)
+    return [fetch_df(url, **kwargs) for url in urls]
+
+def fetch_csv_columns(url, use_cache=True):
+    """Fetches only the header of a remote CSV and returns its column names."""
+    import pandas as pd
+
+    source = _open_csv_source(url, use_cache)
+    try:
+        return list(pd.read_csv(source, nrows=0).columns)
+    finally:
+        if not use_cache:
+            source.close()
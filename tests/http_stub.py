@@ -0,0 +1,82 @@
+"""Local HTTP stand-in for tests that exercise remote data fetching."""
+
+import hashlib
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class StubHTTPServer:
+    """Serves in-memory files over HTTP on localhost.
+
+    Set `files` to a dict of path -> bytes. Every request is recorded
+    in `requests` as a (method, path, headers) tuple. Responses are held
+    back by `delay` seconds, and the first response for each path in
+    `truncate_once` drops the connection halfway through the body.
+    """
+    def __init__(self, files=None, delay=0, truncate_once=None):
+        self.files = dict(files or {})
+        self.requests = []
+        self.delay = delay
+        self.truncate_once = set(truncate_once or [])
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.requests.append(('GET', self.path, dict(self.headers)))
+                time.sleep(stub.delay)
+                if self.path not in stub.files:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+
+                body = stub.files[self.path]
+                etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                status = 200
+                range_header = self.headers.get('Range')
+                if_range = self.headers.get('If-Range')
+                if range_header and range_header.startswith('bytes=') and if_range in (None, etag):
+                    start = int(range_header[len('bytes='):].split('-')[0])
+                    if start >= len(body):
+                        self.send_response(416)
+                        self.send_header('Content-Range', 'bytes */{}'.format(len(body)))
+                        self.end_headers()
+                        return
+                    content_range = 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))
+                    body = body[start:]
+                    status = 206
+
+                self.send_response(status)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                if status == 206:
+                    self.send_header('Content-Range', content_range)
+                self.end_headers()
+                if self.path in stub.truncate_once:
+                    stub.truncate_once.remove(self.path)
+                    self.wfile.write(body[:len(body) // 2])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
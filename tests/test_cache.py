@@ -0,0 +1,176 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from covidcaremap.cache import DownloadCache
+from covidcaremap.util import _open_csv_source, fetch_df, fetch_dfs, fetch_csv_columns
+
+from tests.http_stub import StubHTTPServer
+
+CSV = b'countyFIPS,County Name,3/1/20,3/2/20\n1001,Autauga,0,1\n1003,Baldwin,2,3\n'
+
+class DownloadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_revalidates_with_etag_and_serves_cached_copy(self):
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name, ttl=0)
+            url = server.url('/cases.csv')
+
+            first = cache.fetch(url)
+            second = cache.fetch(url)
+
+            self.assertEqual(first, second)
+            with open(second, 'rb') as f:
+                self.assertEqual(f.read(), CSV)
+
+            self.assertNotIn('If-None-Match', server.requests[0][2])
+            self.assertIn('If-None-Match', server.requests[1][2])
+
+    def test_ttl_avoids_requests(self):
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name, ttl=3600)
+            url = server.url('/cases.csv')
+            cache.fetch(url)
+            cache.fetch(url)
+            self.assertEqual(len(server.requests), 1)
+
+    def test_offline_serves_last_good_copy(self):
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            url = server.url('/cases.csv')
+            DownloadCache(cache_dir=self.tmp.name).fetch(url)
+
+        offline = DownloadCache(cache_dir=self.tmp.name, offline=True)
+        with open(offline.fetch(url), 'rb') as f:
+            self.assertEqual(f.read(), CSV)
+
+        with self.assertRaises(Exception):
+            offline.fetch(url + '?missing')
+
+    def test_lru_eviction_is_bounded(self):
+        files = dict(('/{}.csv'.format(i), CSV + str(i).encode()) for i in range(4))
+        with StubHTTPServer(files) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name,
+                                  max_bytes=len(CSV) * 2 + 10,
+                                  eviction_grace=0)
+            for path in sorted(files):
+                cache.fetch(server.url(path))
+
+            self.assertIsNone(cache.get_entry(server.url('/0.csv')))
+            self.assertIsNotNone(cache.get_entry(server.url('/3.csv')))
+            self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, 'blobs'))), 2)
+
+    def test_concurrent_fetches_do_not_evict_returned_paths(self):
+        files = dict(('/{}.csv'.format(i), CSV + str(i).encode()) for i in range(8))
+        with StubHTTPServer(files, delay=0.1) as server:
+            # Room for a single download, while eight are fetched at once.
+            cache = DownloadCache(cache_dir=self.tmp.name, max_bytes=len(CSV) + 1)
+            paths = cache.fetch_all([server.url(path) for path in sorted(files)])
+
+            for path, content in zip(sorted(files), [files[p] for p in sorted(files)]):
+                with open(paths[server.url(path)], 'rb') as f:
+                    self.assertEqual(f.read(), content)
+
+        # Once the downloads age out, the size bound applies again.
+        cache.eviction_grace = 0
+        cache.evict()
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, 'blobs'))), 1)
+
+    def test_fetch_df_uses_cache(self):
+        import covidcaremap.cache as cache_module
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name)
+            cache_module.set_default_cache(cache)
+            try:
+                df = fetch_df(server.url('/cases.csv'))
+                df = fetch_df(server.url('/cases.csv'))
+            finally:
+                cache_module.set_default_cache(None)
+
+        self.assertEqual(list(df.columns), ['countyFIPS', 'County Name', '3/1/20', '3/2/20'])
+        self.assertEqual(len(server.requests), 1)
+
+    def test_fetch_df_streams_selected_columns(self):
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            url = server.url('/cases.csv')
+            columns = fetch_csv_columns(url, use_cache=False)
+            df = fetch_df(url, use_cache=False, usecols=['countyFIPS', columns[-1]])
+            chunks = list(fetch_df(url, use_cache=False, chunksize=1))
+
+            opened = []
+            def open_csv_source(url, use_cache):
+                opened.append(_open_csv_source(url, use_cache))
+                return opened[-1]
+
+            with mock.patch('covidcaremap.util._open_csv_source', side_effect=open_csv_source):
+                fetch_df(url, use_cache=False)
+                partial = fetch_df(url, use_cache=False, chunksize=1)
+                next(partial)
+                partial.close()
+
+        self.assertEqual(columns[-1], '3/2/20')
+        self.assertEqual(list(df.columns), ['countyFIPS', '3/2/20'])
+        self.assertEqual(list(df['3/2/20']), [1, 3])
+        self.assertEqual([len(c) for c in chunks], [1, 1])
+        self.assertEqual([source.closed for source in opened], [True, True])
+
+    def test_fetch_dfs_without_cache_downloads_once(self):
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            dfs = fetch_dfs([server.url('/cases.csv')], use_cache=False)
+
+        self.assertEqual(list(dfs[0]['countyFIPS']), [1001, 1003])
+        self.assertEqual(len(server.requests), 1)
+
+    def test_fetch_all_downloads_concurrently(self):
+        files = dict(('/{}.csv'.format(i), CSV) for i in range(4))
+        with StubHTTPServer(files, delay=0.5) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name)
+            urls = [server.url(path) for path in sorted(files)]
+            start = time.time()
+            paths = cache.fetch_all(urls)
+            elapsed = time.time() - start
+
+        self.assertEqual(list(paths), urls)
+        self.assertLess(elapsed, 1.5)
+
+    def test_interrupted_download_is_resumed(self):
+        # Larger than a download chunk, so part of it reaches the disk before the drop.
+        body = CSV * 40000
+        with StubHTTPServer({'/big.csv': body}, truncate_once=['/big.csv']) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name, backoff=0)
+            with open(cache.fetch(server.url('/big.csv')), 'rb') as f:
+                self.assertEqual(f.read(), body)
+
+        range_requests = [headers.get('Range') for _, _, headers in server.requests]
+        self.assertEqual(len(range_requests), 2)
+        self.assertIsNone(range_requests[0])
+        self.assertTrue(range_requests[1].startswith('bytes='))
+        self.assertNotEqual(range_requests[1], 'bytes=0-')
+
+    def test_complete_partial_download_is_discarded(self):
+        with StubHTTPServer({'/cases.csv': CSV}) as server:
+            cache = DownloadCache(cache_dir=self.tmp.name, backoff=0)
+            url = server.url('/cases.csv')
+            # A partial download left behind after all bytes were written.
+            part_path = cache._partial_path(url)
+            with open(part_path, 'wb') as f:
+                f.write(CSV)
+            with open(part_path + '.json', 'w') as f:
+                json.dump({'validator': '"{}"'.format(hashlib.md5(CSV).hexdigest())}, f)
+
+            with open(cache.fetch(url), 'rb') as f:
+                self.assertEqual(f.read(), CSV)
+            with open(cache.fetch(url), 'rb') as f:
+                self.assertEqual(f.read(), CSV)
+
+        self.assertEqual([headers.get('Range') for _, _, headers in server.requests][:2],
+                         ['bytes={}-'.format(len(CSV)), None])
+        self.assertFalse(os.path.exists(part_path))
@@ -0,0 +1,113 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import geopandas as gpd
+import pandas as pd
+
+import covidcaremap.cache as cache_module
+from covidcaremap.cache import DownloadCache
+from covidcaremap.cases import CaseStore, get_county_case_info, usafacts_to_long
+
+from tests.http_stub import StubHTTPServer
+
+def wide_usafacts(values_by_date):
+    df = pd.DataFrame({
+        'countyFIPS': [1001, 1003, 0],
+        'County Name': ['Autauga County', 'Baldwin County', 'Statewide Unallocated'],
+        'State': ['AL', 'AL', 'AL'],
+        'stateFIPS': [1, 1, 1]
+    })
+    for date, values in values_by_date.items():
+        df[date] = values
+    return df
+
+class CaseStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = CaseStore(root=self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_usafacts_to_long(self):
+        cases = wide_usafacts({'3/31/20': [1, 2, 3], '4/1/20': [2, 4, 6]})
+        deaths = wide_usafacts({'3/31/20': [0, 0, 1], '4/1/20': [0, 1, 1]})
+        df = usafacts_to_long(cases, deaths)
+
+        self.assertEqual(len(df), 6)
+        self.assertEqual(set(df['fips']), set([1001, 1003, 1000]))
+        row = df[(df['fips'] == 1003) & (df['date'] == pd.Timestamp('2020-04-01'))].iloc[0]
+        self.assertEqual((row['cases'], row['deaths']), (4, 1))
+
+    def test_incremental_append_and_queries(self):
+        first = usafacts_to_long(wide_usafacts({'3/31/20': [1, 2, 3]}),
+                                 wide_usafacts({'3/31/20': [0, 0, 1]}))
+        self.assertEqual(self.store.append(first), 3)
+
+        both_days = usafacts_to_long(
+            wide_usafacts({'3/31/20': [1, 2, 3], '4/1/20': [2, 4, 6]}),
+            wide_usafacts({'3/31/20': [0, 0, 1], '4/1/20': [0, 1, 1]}))
+        # Only the new day is appended
+        self.assertEqual(self.store.append(both_days), 3)
+        self.assertEqual(self.store.partitions(), ['2020-03', '2020-04'])
+        self.assertEqual(self.store.last_date(), pd.Timestamp('2020-04-01'))
+
+        april = self.store.read(start='2020-04-01')
+        self.assertEqual(len(april), 3)
+        self.assertEqual(len(self.store.read(fips=[1001])), 2)
+
+        as_of_march = self.store.as_of('2020-03-31').set_index('fips')
+        self.assertEqual(as_of_march.loc[1003, 'cases'], 2)
+        latest = self.store.as_of().set_index('fips')
+        self.assertEqual(latest.loc[1003, 'cases'], 4)
+
+    def test_as_of_keeps_fips_missing_from_latest_partition(self):
+        march = usafacts_to_long(wide_usafacts({'3/31/20': [1, 2, 3]}),
+                                 wide_usafacts({'3/31/20': [0, 0, 1]}))
+        april = march[march['fips'] != 1001].assign(date=pd.Timestamp('2020-04-01'), cases=[5, 7])
+        self.store.append(march)
+        self.store.append(april)
+
+        latest = self.store.as_of().set_index('fips')
+
+        self.assertEqual(sorted(latest.index), [1000, 1001, 1003])
+        self.assertEqual(latest.loc[1001, 'date'], pd.Timestamp('2020-03-31'))
+        self.assertEqual(latest.loc[1003, 'cases'], 7)
+
+    def test_update_appends_new_dates_and_feeds_county_case_info(self):
+        def csv(values_by_date):
+            return wide_usafacts(values_by_date).to_csv(index=False).encode('utf-8')
+
+        files = {
+            '/cases.csv': csv({'3/31/20': [1, 2, 3], '4/1/20': [2, 4, 6]}),
+            '/deaths.csv': csv({'3/31/20': [0, 0, 1], '4/1/20': [0, 1, 1]})
+        }
+        counties = gpd.GeoDataFrame({'COUNTY_FIPS': ['01001', '01003'], 'geometry': [None, None]})
+
+        with StubHTTPServer(files) as server, \
+             mock.patch('covidcaremap.cases.USAFACTS_CASES_URL', server.url('/cases.csv')), \
+             mock.patch('covidcaremap.cases.USAFACTS_DEATHS_URL', server.url('/deaths.csv')), \
+             mock.patch('covidcaremap.cases.read_us_counties_gdf', return_value=counties):
+            cache_module.set_default_cache(DownloadCache(cache_dir=self.tmp.name + '-http', ttl=0))
+            try:
+                self.assertEqual(self.store.update(), 6)
+                self.assertEqual(self.store.update(), 0)
+
+                server.files['/cases.csv'] = csv({'3/31/20': [1, 2, 3], '4/1/20': [2, 4, 6],
+                                                  '4/2/20': [3, 5, 7]})
+                server.files['/deaths.csv'] = csv({'3/31/20': [0, 0, 1], '4/1/20': [0, 1, 1],
+                                                   '4/2/20': [1, 1, 1]})
+                self.assertEqual(self.store.update(), 3)
+
+                latest = get_county_case_info(store=self.store)
+                earlier = get_county_case_info(date='4/1/20', store=self.store)
+                with self.assertRaises(Exception):
+                    get_county_case_info(date='4/5/20', store=self.store)
+            finally:
+                cache_module.set_default_cache(None)
+
+        self.assertEqual(list(latest['Confirmed Cases']), [3, 5])
+        self.assertEqual(list(latest['Confirmed Cases Last Updated']), ['4/2/20', '4/2/20'])
+        self.assertEqual(list(earlier['Confirmed Cases']), [2, 4])
+        self.assertEqual(list(earlier['Deaths']), [0, 1])
@@ -0,0 +1,190 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from covidcaremap.chime import (get_regional_predictions, run_regional_sir,
+                                run_regional_ensemble, iter_regional_ensemble,
+                                grid_param_draws, sample_param_draws, ProjectionCache)
+
+try:
+    from penn_chime.models import RegionalSirModel
+    HAS_PENN_CHIME = True
+except ImportError:
+    HAS_PENN_CHIME = False
+
+REFERENCE_PROJECTIONS_PATH = os.path.join(os.path.dirname(__file__),
+                                          'fixtures',
+                                          'chime_reference_projections.csv')
+
+# Regions and overrides of the saved reference projections.
+REFERENCE_REGIONS = 6
+REFERENCE_OVERRIDES = {'region-3': {'doubling_time': 6, 'icu_los': 12},
+                       'region-5': {'relative_contact_rate': 0.5}}
+
+def write_reference_projections():
+    """Regenerates the reference projections with penn_chime's RegionalSirModel.
+    Run with `python -m tests.test_chime` where penn_chime is installed."""
+    os.makedirs(os.path.dirname(REFERENCE_PROJECTIONS_PATH), exist_ok=True)
+    get_regional_predictions(make_regions(REFERENCE_REGIONS), 'Region',
+                             region_param_override=REFERENCE_OVERRIDES) \
+        .to_csv(REFERENCE_PROJECTIONS_PATH, index=False)
+
+def make_regions(n=25, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({
+        'Region': ['region-{}'.format(i) for i in range(n)],
+        'Population': rng.randint(1000, 2000000, size=n),
+        'Confirmed Cases': np.concatenate([[0], rng.randint(1, 5000, size=n - 1)])
+    })
+
+class VectorizedSirTest(unittest.TestCase):
+    @unittest.skipUnless(HAS_PENN_CHIME, 'penn_chime with RegionalSirModel is not installed')
+    def test_matches_regional_sir_model(self):
+        regions = make_regions()
+        overrides = {'region-3': {'doubling_time': 6, 'icu_los': 12}}
+
+        expected = get_regional_predictions(regions, 'Region',
+                                            region_param_override=overrides)
+        actual = get_regional_predictions(regions, 'Region',
+                                          region_param_override=overrides,
+                                          engine='numpy')
+
+        pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    @unittest.skipUnless(HAS_PENN_CHIME, 'penn_chime with RegionalSirModel is not installed')
+    def test_process_pool_matches_serial_run(self):
+        regions = make_regions()
+        serial = get_regional_predictions(regions, 'Region')
+        pooled = get_regional_predictions(regions, 'Region', workers=2)
+
+        pd.testing.assert_frame_equal(pooled, serial)
+
+    def test_numpy_process_pool_matches_serial_run(self):
+        regions = make_regions()
+        overrides = {'region-3': {'doubling_time': 6, 'icu_los': 12}}
+        serial = get_regional_predictions(regions, 'Region',
+                                          region_param_override=overrides,
+                                          engine='numpy')
+        pooled = get_regional_predictions(regions, 'Region',
+                                          region_param_override=overrides,
+                                          engine='numpy',
+                                          workers=2)
+
+        pd.testing.assert_frame_equal(pooled, serial)
+
+    def test_matches_reference_projections(self):
+        expected = pd.read_csv(REFERENCE_PROJECTIONS_PATH)
+        actual = get_regional_predictions(make_regions(REFERENCE_REGIONS), 'Region',
+                                          region_param_override=REFERENCE_OVERRIDES,
+                                          engine='numpy')
+
+        # Column names and order come from the RegionalSirModel output.
+        self.assertEqual(list(actual.columns), list(expected.columns))
+        pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected,
+                                      check_dtype=False)
+
+    def test_batched_run_matches_single_region_runs(self):
+        regions = make_regions()
+        batched = run_regional_sir(regions, 'Region')
+
+        self.assertNotIn('region-0', set(batched['Region']))
+        for i in [1, 7, 24]:
+            single = run_regional_sir(regions.iloc[[i]], 'Region')
+            from_batch = batched[batched['Region'] == regions['Region'].iloc[i]]
+            pd.testing.assert_frame_equal(single, from_batch)
+
+    def test_region_overrides_only_affect_their_region(self):
+        regions = make_regions()
+        base = run_regional_sir(regions, 'Region')
+        overridden = run_regional_sir(regions, 'Region',
+                                      region_param_override={'region-3': {'icu_los': 12}})
+
+        def region(df, region_id):
+            return df[df['Region'] == region_id].reset_index(drop=True)
+
+        pd.testing.assert_frame_equal(region(base, 'region-4'), region(overridden, 'region-4'))
+        self.assertEqual(region(overridden, 'region-3')['day'].max(), 60 - 12)
+        self.assertEqual(region(base, 'region-3')['day'].max(), 60 - 10)
+
+class EnsembleTest(unittest.TestCase):
+    def test_single_draw_matches_deterministic_run(self):
+        regions = make_regions()
+        draws = grid_param_draws({'doubling_time': [4]})
+        ensemble = run_regional_ensemble(regions, 'Region', draws, regions_per_chunk=7)
+        expected = run_regional_sir(regions, 'Region')
+
+        self.assertEqual(len(ensemble), len(expected))
+        np.testing.assert_array_equal(ensemble['Region'].values, expected['Region'].values)
+        np.testing.assert_array_equal(ensemble['day'].values, expected['day'].values)
+        for column in ['hospitalized_census', 'icu_admitted']:
+            for pct in [5, 50, 95]:
+                np.testing.assert_array_equal(ensemble['{}_p{}'.format(column, pct)].values,
+                                              expected[column].values)
+
+    def test_percentiles_are_ordered_and_chunking_is_invariant(self):
+        regions = make_regions(n=10)
+        draws = sample_param_draws({'doubling_time': (3, 6), 'hospitalized_rate': (0.02, 0.08)},
+                                   50, seed=1)
+        whole = run_regional_ensemble(regions, 'Region', draws)
+        chunked = run_regional_ensemble(regions, 'Region', draws, regions_per_chunk=3)
+
+        pd.testing.assert_frame_equal(whole, chunked)
+        self.assertTrue((whole['hospitalized_census_p5'] <= whole['hospitalized_census_p50']).all())
+        self.assertTrue((whole['hospitalized_census_p50'] <= whole['hospitalized_census_p95']).all())
+
+    def test_chunks_stay_within_element_budget(self):
+        regions = make_regions(n=10)
+        draws = sample_param_draws({'doubling_time': (3, 6)}, 400, seed=2)
+        budget = 3 * 400 * 31
+        chunks = list(iter_regional_ensemble(regions, 'Region', draws, num_days=30,
+                                             chunk_elements=budget))
+        # The first region has no cases and is dropped.
+        self.assertEqual([chunk['Region'].nunique() for chunk in chunks], [3, 3, 3])
+
+        # A single region over budget is still run on its own.
+        chunks = list(iter_regional_ensemble(regions, 'Region', draws, num_days=30,
+                                             chunk_elements=100))
+        self.assertEqual(len(chunks), 9)
+        self.assertTrue(all(chunk['Region'].nunique() == 1 for chunk in chunks))
+
+        pd.testing.assert_frame_equal(
+            pd.concat(chunks, ignore_index=True),
+            run_regional_ensemble(regions, 'Region', draws, num_days=30))
+
+    def test_grid_covers_every_combination(self):
+        draws = grid_param_draws({'doubling_time': [3, 4, 5], 'icu_los': [7, 9]})
+        self.assertEqual(len(draws), 6)
+        self.assertEqual(len(draws.drop_duplicates()), 6)
+
+class ProjectionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_only_changed_regions_are_recomputed(self):
+        regions = make_regions()
+        expected = get_regional_predictions(regions, 'Region', engine='numpy')
+
+        cache = ProjectionCache(cache_dir=self.tmp.name)
+        first = get_regional_predictions(regions, 'Region', engine='numpy', cache=cache)
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 24})
+        pd.testing.assert_frame_equal(first, expected)
+
+        regions.loc[5, 'Confirmed Cases'] += 10
+        overrides = {'region-9': {'icu_los': 12}}
+        cache = ProjectionCache(cache_dir=self.tmp.name)
+        second = get_regional_predictions(regions, 'Region', engine='numpy', cache=cache,
+                                          region_param_override=overrides)
+        self.assertEqual(cache.stats(), {'hits': 22, 'misses': 2})
+        pd.testing.assert_frame_equal(
+            second,
+            get_regional_predictions(regions, 'Region', engine='numpy',
+                                     region_param_override=overrides))
+
+if __name__ == '__main__':
+    write_reference_projections()
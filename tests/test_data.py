@@ -0,0 +1,59 @@
+import os
+import tempfile
+import time
+import unittest
+
+import geopandas as gpd
+from shapely.geometry import Point
+
+from covidcaremap.data import (read_geojson_gdf,
+                               local_data_path,
+                               GeoDataFrameRegistry,
+                               GEO_CACHE_DIR_NAME)
+
+class GeoJSONSidecarTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'test_regions_{}.geojson'.format(os.getpid()))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        sidecar = local_data_path(os.path.join(GEO_CACHE_DIR_NAME, os.path.basename(self.path)))
+        for suffix in ['.parquet', '.parquet.json']:
+            if os.path.exists(sidecar + suffix):
+                os.remove(sidecar + suffix)
+
+    def write(self, names):
+        gdf = gpd.GeoDataFrame({'name': names},
+                               geometry=[Point(i, i) for i in range(len(names))],
+                               crs='epsg:4326')
+        gdf.to_file(self.path, driver='GeoJSON')
+
+    def test_sidecar_is_rebuilt_when_source_changes(self):
+        self.write(['a', 'b'])
+        first = read_geojson_gdf(self.path)
+        second = read_geojson_gdf(self.path)
+        self.assertTrue(first.equals(second))
+        self.assertEqual(first.crs, second.crs)
+
+        time.sleep(0.01)
+        self.write(['a', 'b', 'c'])
+        third = read_geojson_gdf(self.path)
+        self.assertEqual(list(third['name']), ['a', 'b', 'c'])
+
+    def test_registry_loads_once_and_hands_out_copies(self):
+        self.write(['a', 'b'])
+        registry = GeoDataFrameRegistry()
+
+        first = registry.get(self.path)
+        first['name'] = 'changed'
+        second = registry.get(self.path)
+
+        self.assertEqual(list(second['name']), ['a', 'b'])
+        stats = registry.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(len(stats['memory_bytes']), 1)
+
+        registry.invalidate(self.path)
+        registry.get(self.path)
+        self.assertEqual(registry.stats()['misses'], 2)
@@ -0,0 +1,212 @@
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+
+from covidcaremap.constants import *
+from covidcaremap.data import local_data_path
+
+from covidcaremap.geo import (spatial_join_facilities,
+                              points_within_distance,
+                              normalize_strings,
+                              weighted_similarity_scores,
+                              assign_facilities_to_regions,
+                              sum_per_region,
+                              rollup_per_region,
+                              RegionLevel,
+                              _geometry_key,
+                              prepared_regions,
+                              evict_region_assignments,
+                              REGION_ASSIGNMENT_DIR_NAME)
+
+def make_facilities(ids, names, xy, id_column='ID', name_column='NAME'):
+    x, y = zip(*xy)
+    return gpd.GeoDataFrame({id_column: ids, name_column: names},
+                            geometry=gpd.points_from_xy(x, y),
+                            crs='EPSG:5070').to_crs(4326)
+
+class SpatialJoinTest(unittest.TestCase):
+    def test_points_within_distance(self):
+        left = make_facilities([1, 2, 3], ['a', 'b', 'c'], [(0, 0), (1000, 0), (5000, 0)])
+        right = make_facilities([1, 2], ['a', 'b'], [(0, 0), (1100, 0)])
+
+        left_positions, right_positions, distances = points_within_distance(
+            left.to_crs('EPSG:5070'), right.to_crs('EPSG:5070'), 150)
+        self.assertEqual(list(left_positions), [0, 1])
+        self.assertEqual(list(right_positions), [0, 1])
+        np.testing.assert_allclose(distances, [0, 100], atol=1e-6)
+
+    def test_matches_most_similar_nearby_facility(self):
+        left = make_facilities([1, 2, 3],
+                               ['General Hospital', 'Mercy Clinic', 'Lone Hospital'],
+                               [(0, 0), (60, 0), (10000, 0)],
+                               id_column='LID', name_column='LNAME')
+        right = make_facilities([10, 20, 30],
+                                ['Mercy Clinic', 'General Hospital', 'Far Away Hospital'],
+                                [(30, 0), (100, 0), (50000, 0)],
+                                id_column='RID', name_column='RNAME')
+
+        result = spatial_join_facilities(left, right, 'LID', 'RID', ['LNAME'], ['RNAME'],
+                                         include_distance=True)
+        matches = dict((l, r) for l, r in zip(result['LID'], result['RID'])
+                       if not np.isnan(l))
+
+        self.assertEqual(matches[1], 20)
+        self.assertEqual(matches[2], 10)
+        self.assertTrue(np.isnan(matches[3]))
+        self.assertIn(30, set(result['RID']))
+        self.assertAlmostEqual(result[result['LID'] == 1]['distance'].iloc[0], 100, places=3)
+
+    def test_weighted_similarity_scores(self):
+        names = normalize_strings(['St. Luke\'s  Hospital', np.nan, 'MERCY'])
+        self.assertEqual(list(names[[0, 2]]), ['st luke s hospital', 'mercy'])
+        self.assertTrue(np.isnan(names[1]))
+
+        scores = weighted_similarity_scores(
+            [names, ['1 Main St', '2 Elm St', None]],
+            [['st luke s hospital', 'mercy', 'mercy'], ['1 Main St', '2 Elm St', '3 Oak St']],
+            weights=[0.75, 0.25],
+            workers=2
+        )
+        np.testing.assert_allclose(scores, [100, 25, 75])
+
+def make_regions():
+    """Two by two grid of unit square regions."""
+    return gpd.GeoDataFrame({
+        'Region': ['SW', 'SE', 'NW', 'NE'],
+        'Population': [1000, 2000, 3000, 4000],
+        'Population (20+)': [800, 1600, 2400, 3200],
+        'Population (65+)': [100, 200, 300, 400],
+    }, geometry=[box(0, 0, 1, 1), box(1, 0, 2, 1), box(0, 1, 1, 2), box(1, 1, 2, 2)], crs=4326)
+
+def make_region_facilities():
+    xy = [(0.5, 0.5), (0.25, 0.75), (1.5, 0.5), (1.5, 1.5), (5, 5)]
+    x, y = zip(*xy)
+    return gpd.GeoDataFrame({
+        CCM_STAFFED_BEDS_COLUMN: [10.0, 30.0, 5.0, 7.0, 100.0],
+        CCM_STAFFED_ICU_BEDS_COLUMN: [1.0, 3.0, np.nan, 2.0, 10.0],
+        CCM_LICENSED_BEDS_COLUMN: [12.0, 40.0, 6.0, 8.0, 120.0],
+        CCM_BED_OCCUPANCY_COLUMN: [0.5, 1.5, np.nan, 0.25, 0.5],
+        CCM_ICU_BED_OCCUPANCY_COLUMN: [0.5, 0.5, np.nan, 1.0, 0.5],
+    }, geometry=gpd.points_from_xy(x, y), crs=4326)
+
+class RegionAggregationTest(unittest.TestCase):
+    def test_sum_per_region_uses_assignments(self):
+        regions = make_regions()
+        facilities = make_region_facilities()
+
+        assignments = assign_facilities_to_regions(facilities, regions, use_cache=False)
+        self.assertEqual(list(assignments), [0, 0, 1, 3, -1])
+
+        result = sum_per_region(facilities, regions, ['Region'], 'Region', use_cache=False)
+        result = result.set_index('Region')
+        self.assertEqual(sorted(result.index), ['NE', 'SE', 'SW'])
+        self.assertEqual(result.loc['SW', CCM_STAFFED_BEDS_COLUMN], 40)
+        # Occupancy is weighted by beds, with rates capped at 1.0
+        self.assertEqual(result.loc['SW', CCM_BED_OCCUPANCY_COLUMN], round((10 * 0.5 + 30) / 40, 2))
+        self.assertEqual(result.loc['NE', per_capita_column_name(CCM_STAFFED_BEDS_COLUMN,
+                                                                 PER_CAPITA_BASE,
+                                                                 POP_PEOPLE)], 1.75)
+
+    def test_rollup_matches_per_level_aggregation(self):
+        regions = make_regions()
+        regions['Half'] = ['S', 'S', 'N', 'N']
+        facilities = make_region_facilities()
+
+        result = rollup_per_region(facilities,
+                                   [RegionLevel('quadrant', 'Region', regions),
+                                    RegionLevel('half', 'Half'),
+                                    RegionLevel('total', 'Total')],
+                                   use_cache=False)
+
+        pd.testing.assert_frame_equal(
+            result['quadrant'],
+            sum_per_region(facilities, regions, ['Region'], 'Region', use_cache=False))
+
+        half = result['half'].set_index('Half')
+        self.assertEqual(half.loc['S', CCM_STAFFED_BEDS_COLUMN], 45)
+        self.assertEqual(half.loc['S', 'Population'], 3000)
+        self.assertEqual(half.loc['S', CCM_BED_OCCUPANCY_COLUMN], round((10 * 0.5 + 30) / 40, 2))
+
+        total = result['total'].iloc[0]
+        self.assertEqual(total['Total'], 'total')
+        self.assertEqual(total[CCM_STAFFED_BEDS_COLUMN], 52)
+        self.assertEqual(total['Population'], 10000)
+        self.assertEqual(total[CCM_BED_OCCUPANCY_COLUMN], round((5 + 30 + 7 * 0.25) / 47, 2))
+
+    def test_prepared_regions_match_exact_join(self):
+        regions = make_regions()
+        rng = np.random.RandomState(0)
+        # Random points, plus points on borders and corners.
+        x = np.concatenate([rng.uniform(-0.5, 2.5, 500), [1, 1, 0, 2]])
+        y = np.concatenate([rng.uniform(-0.5, 2.5, 500), [0.5, 1, 0, 2]])
+        points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(x, y), crs=4326)
+
+        prepared = prepared_regions(regions)
+        self.assertIs(prepared_regions(regions), prepared)
+
+        actual = prepared.query(points.geometry.values)
+        expected = regions.sindex.query(points.geometry.values, predicate='intersects')
+        self.assertEqual(set(zip(*actual)), set(zip(*expected)))
+
+    def test_assignments_are_persisted(self):
+        regions = make_regions()
+        facilities = make_region_facilities()
+        path = local_data_path(os.path.join(REGION_ASSIGNMENT_DIR_NAME,
+                                            '{}.npy'.format(_geometry_key(facilities, regions))))
+        try:
+            first = assign_facilities_to_regions(facilities, regions)
+            self.assertTrue(os.path.exists(path))
+            np.save(path, np.zeros(len(facilities), dtype=np.int64))
+            self.assertEqual(list(assign_facilities_to_regions(facilities, regions)), [0] * 5)
+            self.assertEqual(list(assign_facilities_to_regions(facilities, regions, use_cache=False)),
+                             list(first))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def test_border_facilities_go_to_first_region(self):
+        regions = make_regions()
+        # On the SW/SE border, and on the corner shared by all four regions.
+        facilities = gpd.GeoDataFrame(geometry=gpd.points_from_xy([1, 1], [0.5, 1]), crs=4326)
+
+        self.assertEqual(list(assign_facilities_to_regions(facilities, regions, use_cache=False)),
+                         [0, 0])
+        reordered = regions.iloc[::-1].reset_index(drop=True)
+        self.assertEqual(list(assign_facilities_to_regions(facilities, reordered, use_cache=False)),
+                         [2, 0])
+
+    def test_assignment_key_includes_crs(self):
+        regions = make_regions()
+        facilities = make_region_facilities()
+        self.assertNotEqual(_geometry_key(facilities, regions),
+                            _geometry_key(facilities.set_crs(3857, allow_override=True), regions))
+
+    def test_persisted_assignments_are_bounded(self):
+        regions = make_regions()
+        dir_name = 'test-region-assignments-{}'.format(os.getpid())
+        assignment_dir = local_data_path(dir_name)
+        try:
+            with mock.patch('covidcaremap.geo.REGION_ASSIGNMENT_DIR_NAME', dir_name), \
+                 mock.patch('covidcaremap.geo.MAX_REGION_ASSIGNMENTS', 2):
+                snapshots = [make_region_facilities().iloc[:n] for n in [3, 4, 5]]
+                for facilities in snapshots:
+                    assign_facilities_to_regions(facilities, regions)
+                    # Distinct modification times for the LRU order.
+                    for file_name in os.listdir(assignment_dir):
+                        path = os.path.join(assignment_dir, file_name)
+                        os.utime(path, (os.path.getmtime(path) - 10,) * 2)
+
+                kept = set(os.listdir(assignment_dir))
+                self.assertEqual(kept, set('{}.npy'.format(_geometry_key(facilities, regions))
+                                           for facilities in snapshots[1:]))
+
+                evict_region_assignments(max_entries=0)
+                self.assertEqual(os.listdir(assignment_dir), [])
+        finally:
+            shutil.rmtree(assignment_dir, ignore_errors=True)
@@ -0,0 +1,110 @@
+import io
+import os
+import tempfile
+import unittest
+from zipfile import ZipFile
+
+import pandas as pd
+
+import covidcaremap.cache as cache_module
+from covidcaremap.cache import DownloadCache
+from covidcaremap.data import local_data_path
+from covidcaremap.ihme import IHME
+
+from tests.http_stub import StubHTTPServer
+
+MODEL_VERSION = 'test_model_{}'.format(os.getpid())
+
+CSV = '\n'.join([
+    'location_id,location_name,date,allbed_mean,allbed_lower,allbed_upper,admis_mean',
+    '523,Alabama,2020-04-01,10,5,15,2',
+    '523,Alabama,2020-04-02,12,6,18,3',
+    '524,Alaska,2020-04-01,1,0,2,0',
+    # Georgia the country, and Georgia the US state.
+    '35,Georgia,2020-04-01,50,40,60,9',
+    '533,Georgia,2020-04-01,20,10,30,4',
+])
+
+def make_zip():
+    buf = io.BytesIO()
+    with ZipFile(buf, 'w') as z:
+        z.writestr('{}/Hospitalization_all_locs.csv'.format(MODEL_VERSION), CSV)
+    return buf.getvalue()
+
+class IHMECacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        cache_module.set_default_cache(DownloadCache(cache_dir=self.tmp.name, ttl=0))
+        self.latest_url = IHME.LATEST_URL
+
+    def tearDown(self):
+        IHME.LATEST_URL = self.latest_url
+        cache_module.set_default_cache(None)
+        self.tmp.cleanup()
+        parquet_path = local_data_path(os.path.join('ihme', MODEL_VERSION + '.parquet'))
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+
+    def test_projected_reads_from_version_cache(self):
+        with StubHTTPServer({'/ihme.zip': make_zip()}) as server:
+            IHME.LATEST_URL = server.url('/ihme.zip')
+            full, version = IHME.get_latest(include_version=True)
+            projected = IHME.get_latest(columns=IHME.value_columns('mean'),
+                                        locations=['Alabama'])
+
+        self.assertEqual(version, MODEL_VERSION)
+        self.assertEqual(len(full), 5)
+        self.assertEqual(list(projected.columns),
+                         ['location_name', 'date', 'allbed_mean', 'admis_mean'])
+        self.assertEqual(list(projected['allbed_mean']), [10, 12])
+        # The second call revalidated the zip instead of downloading it again.
+        self.assertIn('If-None-Match', server.requests[1][2])
+
+    def test_states_leave_out_countries_with_a_state_name(self):
+        with StubHTTPServer({'/ihme.zip': make_zip()}) as server:
+            IHME.LATEST_URL = server.url('/ihme.zip')
+            states = IHME.get_latest_for_states(columns=IHME.value_columns('mean'))
+
+        georgia = states[states['State'] == 'GA']
+        self.assertEqual(list(georgia['allbed_mean']), [20])
+        self.assertEqual(len(states), 4)
+
+        weights = pd.DataFrame({'GEO_ID': ['c1', 'c2'],
+                                'State': ['GA', 'AL'],
+                                'proportion_of_state': [0.5, 1.0]})
+        counties = IHME.disaggregate_to_counties(ihme=states, weights=weights)
+        self.assertEqual(list(counties[counties['GEO_ID'] == 'c1']['allbed_mean']), [10])
+
+class IHMEDisaggregationTest(unittest.TestCase):
+    def test_matches_row_wise_disaggregation(self):
+        ihme = pd.DataFrame({
+            'location_name': ['Alabama', 'Alabama', 'Alaska', 'Alaska', 'Alaska'],
+            'State': ['AL', 'AL', 'AK', 'AK', 'AK'],
+            'date': ['2020-04-02', '2020-04-01', '2020-04-01', '2020-04-02', '2020-04-03'],
+            'allbed_mean': [12.0, 10.0, 1.0, 2.0, 3.0],
+            'admis_upper': [3.0, 2.0, 0.0, 1.0, 1.0]
+        })
+        counties = pd.DataFrame({
+            'GEO_ID': ['c1', 'c2', 'c3', 'c4'],
+            'State': ['AL', 'AL', 'AK', 'WY'],
+            'Population': [30, 70, 10, 5]
+        })
+        states = pd.DataFrame({'State': ['AL', 'AK', 'WY'], 'Population': [100, 10, 5]})
+
+        result = IHME.disaggregate_to_counties(ihme=ihme,
+                                               weights=IHME.county_weights(counties, states))
+
+        # Reference implementation: merge every forecast row with its counties.
+        counties['proportion_of_state'] = counties['Population'] / counties['State'].map(
+            states.set_index('State')['Population'])
+        expected = pd.merge(ihme, counties, 'inner', on='State')
+        for c in ['allbed_mean', 'admis_upper']:
+            expected[c] = expected[c] * expected['proportion_of_state']
+
+        key = ['GEO_ID', 'date']
+        result = result.sort_values(key).reset_index(drop=True)
+        expected = expected.sort_values(key).reset_index(drop=True)
+        self.assertEqual(len(result), 7)
+        pd.testing.assert_frame_equal(result[key + ['State', 'allbed_mean', 'admis_upper']],
+                                      expected[key + ['State', 'allbed_mean', 'admis_upper']],
+                                      check_dtype=False)
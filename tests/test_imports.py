@@ -0,0 +1,49 @@
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+HEAVY_OPTIONAL_MODULES = [
+    'folium',
+    'fuzzywuzzy',
+    'libpysal',
+    'networkx',
+    'penn_chime',
+    'scipy',
+    'sklearn',
+    'us',
+]
+
+def import_in_subprocess(module):
+    """Imports a module in a fresh interpreter. Returns which of
+    HEAVY_OPTIONAL_MODULES (plus pandas/geopandas) ended up loaded."""
+    code = '\n'.join([
+        'import json, sys',
+        'import {}'.format(module),
+        'watched = {}'.format(HEAVY_OPTIONAL_MODULES + ['pandas', 'geopandas']),
+        'print(json.dumps(sorted(m for m in watched if m in sys.modules)))',
+    ])
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=PROJECT_ROOT)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+class ImportTimeTest(unittest.TestCase):
+    def test_package_import_is_lightweight(self):
+        self.assertEqual(import_in_subprocess('covidcaremap'), [])
+
+    def test_data_path_helpers_are_lightweight(self):
+        self.assertEqual(import_in_subprocess('covidcaremap.data'), [])
+
+    def test_ppe_does_not_import_optional_dependencies(self):
+        self.assertEqual(import_in_subprocess('covidcaremap.ppe'), [])
+
+    def test_modules_defer_heavy_optional_dependencies(self):
+        for module in ['covidcaremap.merge',
+                       'covidcaremap.geo',
+                       'covidcaremap.chime',
+                       'covidcaremap.ihme']:
+            loaded = import_in_subprocess(module)
+            self.assertEqual([m for m in loaded if m in HEAVY_OPTIONAL_MODULES], [],
+                             msg='Importing {}'.format(module))
@@ -0,0 +1,254 @@
+import functools
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+from covidcaremap.merge import (match_facilities,
+                                candidate_edges,
+                                facility_match_keys,
+                                reduce_matched_facility_records,
+                                FacilityColumns,
+                                FacilityMatchGraph)
+
+def make_dataset(rows, id_column, name_column, address_column):
+    """rows are (id, name, address, x, y) with x, y in EPSG:5070 meters."""
+    ids, names, addresses, xs, ys = zip(*rows)
+    df = gpd.GeoDataFrame({id_column: ids, name_column: names, address_column: addresses},
+                          geometry=gpd.points_from_xy(xs, ys),
+                          crs='epsg:5070').to_crs('epsg:4326')
+    return { 'df': df, 'columns': FacilityColumns(id_column, name_column, address_column) }
+
+def make_datasets():
+    return {
+        'hifld': make_dataset([
+            (1, 'General Hospital', '100 Main St', 0, 0),
+            (2, 'Mercy Clinic', '200 Main St', 80, 0),
+            (3, 'Lone Hospital', '5 Elm St', 10000, 0),
+            (4, 'Far Away Hospital', '9 Oak Ave', 50000, 0),
+        ], 'ID', 'NAME', 'ADDRESS'),
+        'dh': make_dataset([
+            (10, 'MERCY CLINIC', '200 Main Street', 100, 10),
+            (20, 'General Hospital', '100 Main St', 30, 0),
+            (30, 'Lone Hospital', '7 Elm St', 10050, 0),
+            (40, 'Unmatched Hospital', '1 Pine St', 90000, 0),
+        ], 'dh_id', 'Hospital Name', 'Address'),
+        'hcris': make_dataset([
+            (100, 'General Hosp', '100 Main St', 20, 20),
+            (300, 'Lone Hospital', '5 Elm St', 10000, 100),
+        ], 'PROVIDER', 'HOSP_NAME', 'STREET'),
+    }
+
+class MatchFacilitiesTest(unittest.TestCase):
+    def matches(self, result):
+        return sorted(tuple(r) for r in result.matches[['ID', 'dh_id', 'PROVIDER']]
+                                           .fillna('').values)
+
+    def test_matches_nearby_facilities_by_name_and_address(self):
+        result = match_facilities(make_datasets(), 'hifld', nearest_n=5)
+
+        self.assertEqual(self.matches(result), [
+            ('1', '20', '100'),
+            ('2', '10', ''),
+            # House numbers differ and names match exactly
+            ('3', '30', '300'),
+            ('4', '', ''),
+        ])
+        self.assertEqual(result.get_unmatched_dict(), {'dh': ['40'], 'hcris': []})
+        self.assertEqual(list(result.merged_df['ID']), ['1', '2', '3', '4'])
+        self.assertIn('dh_Hospital Name', result.merged_df.columns)
+
+    def test_manual_matches_take_precedence(self):
+        manual_matches = pd.DataFrame({'ID': [1], 'dh_id': [10]})
+        result = match_facilities(make_datasets(), 'hifld', nearest_n=5,
+                                  manual_matches_df=manual_matches)
+
+        matches = self.matches(result)
+        self.assertIn(('1', '10', '100'), matches)
+        # General Hospital in dh can't match Mercy Clinic: house numbers and names differ.
+        self.assertIn(('2', '', ''), matches)
+        self.assertEqual(result.get_unmatched_dict()['dh'], ['20', '40'])
+
+    def test_dense_clusters_do_not_drop_neighbors(self):
+        # Twelve facilities within a few meters, each with a counterpart in dh
+        # that is farther away than the other eleven.
+        hifld = [(i, 'Hospital {}'.format(i), '{} Main St'.format(i), i, 0) for i in range(12)]
+        dh = [(100 + i, 'Hospital {}'.format(i), '{} Main St'.format(i), i, 100) for i in range(12)]
+        datasets = {
+            'hifld': make_dataset(hifld, 'ID', 'NAME', 'ADDRESS'),
+            'dh': make_dataset(dh, 'dh_id', 'Hospital Name', 'Address'),
+        }
+
+        result = match_facilities(datasets, 'hifld')
+
+        self.assertEqual(sorted(tuple(r) for r in result.matches.values),
+                         sorted((str(i), str(100 + i)) for i in range(12)))
+
+    def test_parallel_reduction_matches_serial(self):
+        serial = match_facilities(make_datasets(), 'hifld')
+        parallel = match_facilities(make_datasets(), 'hifld', workers=2)
+
+        pd.testing.assert_frame_equal(serial.matches, parallel.matches)
+        self.assertEqual(serial.get_unmatched_dict(), parallel.get_unmatched_dict())
+
+    def test_custom_reducer_in_executor(self):
+        def reduce_authoritative_only(authoritative_records, *args):
+            return [[r['match_id']] for r in authoritative_records]
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            result = match_facilities(make_datasets(), 'hifld',
+                                      reducer_fn=reduce_authoritative_only,
+                                      executor=executor)
+
+        self.assertEqual(self.matches(result), [
+            ('1', '', ''), ('2', '', ''), ('3', '', ''), ('4', '', ''),
+        ])
+
+class CandidateEdgesTest(unittest.TestCase):
+    def test_pairs_within_distance(self):
+        pts = np.array([[0, 0], [3, 4], [0, 20], [1, 0]], dtype=float)
+
+        i, j, dist = candidate_edges(pts, 10)
+
+        self.assertEqual(list(zip(i, j)), [(0, 1), (0, 3), (1, 3)])
+        np.testing.assert_allclose(dist, [5, 1, np.sqrt(20)])
+
+    def test_nearest_n_limits_neighbors(self):
+        pts = np.array([[0, 0], [1, 0], [3, 0], [6, 0]], dtype=float)
+
+        i, j, _ = candidate_edges(pts, 10, nearest_n=1)
+
+        # Each point keeps the pair with its nearest neighbor.
+        self.assertEqual(list(zip(i, j)), [(0, 1), (1, 2), (2, 3)])
+
+class ReduceMatchedFacilityRecordsTest(unittest.TestCase):
+    def test_facility_match_keys(self):
+        df = pd.DataFrame({'NAME': ['Mercy CLINIC', None],
+                           'ADDRESS': ['200 Main St', 'Main St 200']})
+
+        keys = facility_match_keys(df, FacilityColumns('ID', 'NAME', 'ADDRESS'))
+
+        self.assertEqual(list(keys['match_name_key']), ['mercy clinic', None])
+        self.assertEqual(list(keys['match_house_number']), [200, -1])
+
+    def test_house_numbers_block_pairs_unless_names_match(self):
+        columns = {'a': FacilityColumns('ID', 'NAME', 'ADDRESS'),
+                   'b': FacilityColumns('bid', 'BNAME', 'BADDRESS')}
+        authoritative = [
+            {'ID': 1, 'NAME': 'General Hospital', 'ADDRESS': '100 Main St',
+             'dataset': 'a', 'match_id': 'a_-_1'},
+            {'ID': 2, 'NAME': 'Mercy Clinic', 'ADDRESS': '5 Oak Ave',
+             'dataset': 'a', 'match_id': 'a_-_2'},
+        ]
+        others = [
+            # Closest name to General Hospital, but at another house number.
+            {'bid': 10, 'BNAME': 'General Hospital East', 'BADDRESS': '300 Main St',
+             'dataset': 'b', 'match_id': 'b_-_10'},
+            {'bid': 20, 'BNAME': 'Gen. Hosp.', 'BADDRESS': '100 Main Street',
+             'dataset': 'b', 'match_id': 'b_-_20'},
+            # Different house number, same name ignoring case.
+            {'bid': 30, 'BNAME': 'MERCY CLINIC', 'BADDRESS': '7 Oak Ave',
+             'dataset': 'b', 'match_id': 'b_-_30'},
+        ]
+
+        result = reduce_matched_facility_records(authoritative, others, {}, set(), columns)
+
+        self.assertEqual(result, [{'a_-_1', 'b_-_20'}, {'a_-_2', 'b_-_30'}])
+
+    def test_matches_without_batch_scoring(self):
+        expected = match_facilities(make_datasets(), 'hifld').matches
+
+        # Older rapidfuzz versions have no rapidfuzz.process.cpdist.
+        with mock.patch.dict('sys.modules', {'rapidfuzz.process': None}):
+            with self.assertRaises(ImportError):
+                from rapidfuzz.process import cpdist
+            result = match_facilities(make_datasets(), 'hifld').matches
+
+        pd.testing.assert_frame_equal(result, expected)
+
+reduced_components = []
+
+def counting_reducer(authoritative_records, *args):
+    reduced_components.append(sorted(r['match_id'] for r in authoritative_records))
+    return reduce_matched_facility_records(authoritative_records, *args)
+
+class IncrementalMatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        del reduced_components[:]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def match(self, datasets, previous_graph=None):
+        return match_facilities(datasets, 'hifld',
+                                reducer_fn=counting_reducer,
+                                previous_graph=previous_graph)
+
+    def saved_graph(self):
+        path = os.path.join(self.tmp.name, 'match-graph.npz')
+        self.match(make_datasets()).match_graph.save(path)
+        del reduced_components[:]
+        return FacilityMatchGraph.load(path)
+
+    def test_unchanged_datasets_reuse_all_matches(self):
+        previous_graph = self.saved_graph()
+
+        result = self.match(make_datasets(), previous_graph)
+
+        self.assertEqual(reduced_components, [])
+        pd.testing.assert_frame_equal(result.matches, match_facilities(make_datasets(), 'hifld').matches)
+        self.assertEqual(len(result.changelog), 0)
+
+    def test_only_changed_components_are_reduced(self):
+        previous_graph = self.saved_graph()
+        datasets = make_datasets()
+        # Move dh's Lone Hospital away from the others, and add a new hifld facility.
+        dh = datasets['dh']['df']
+        dh.loc[dh['dh_id'] == 30, 'geometry'] = dh.loc[dh['dh_id'] == 40, 'geometry'].values
+        datasets['hifld']['df'] = pd.concat([
+            datasets['hifld']['df'],
+            make_dataset([(5, 'New Hospital', '1 Pine St', 90050, 0)], 'ID', 'NAME', 'ADDRESS')['df']
+        ], ignore_index=True)
+
+        result = self.match(datasets, previous_graph)
+
+        self.assertEqual(reduced_components, [['hifld_-_3'], ['hifld_-_5']])
+        pd.testing.assert_frame_equal(result.matches,
+                                      match_facilities(datasets, 'hifld').matches)
+        self.assertEqual(
+            [tuple(r) for r in result.changelog.values],
+            [('3', 'dh', '30', None, 'unmatched'),
+             ('5', 'hifld', None, '5', 'added'),
+             ('5', 'dh', None, '40', 'matched')]
+        )
+
+    def test_reducers_without_a_stable_name_are_never_reused(self):
+        partial_reducer = functools.partial(counting_reducer)
+        previous_graph = match_facilities(make_datasets(), 'hifld',
+                                          reducer_fn=partial_reducer).match_graph
+        del reduced_components[:]
+
+        result = match_facilities(make_datasets(), 'hifld',
+                                  reducer_fn=partial_reducer,
+                                  previous_graph=previous_graph)
+
+        self.assertEqual(len(reduced_components), 2)
+        pd.testing.assert_frame_equal(result.matches, match_facilities(make_datasets(), 'hifld').matches)
+
+        # A different lambda must not reuse the match sets of the first one.
+        previous_graph = match_facilities(make_datasets(), 'hifld',
+                                          reducer_fn=lambda *args: counting_reducer(*args)).match_graph
+        result = match_facilities(make_datasets(), 'hifld',
+                                  reducer_fn=lambda authoritative_records, *args: [
+                                      [r['match_id']] for r in authoritative_records
+                                  ],
+                                  previous_graph=previous_graph)
+
+        self.assertTrue(result.matches[['dh_id', 'PROVIDER']].isnull().all().all())
+        self.assertEqual(set(result.changelog['change']), set(['unmatched']))
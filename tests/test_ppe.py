@@ -7,6 +7,12 @@ import pandas as pd
 import geopandas as gpd
 
 from covidcaremap.ppe import (calculate_ppe_burn_for_day,
+                              calculate_ppe_burn,
+                              SupplyModelArrays,
+                              SupplyCounts,
+                              CareStageSupplyModel,
+                              project_ppe_burn_from_ihme,
+                              project_ppe_burn_from_chime,
                               SUPPLY_MODEL_PER_STAGE,
                               ICU,
                               TRIAGE,
@@ -16,7 +22,9 @@ from covidcaremap.ppe import (calculate_ppe_burn_for_day,
                               GOWN,
                               DROPLET_MASK,
                               GLOVES,
-                              WIPES)
+                              WIPES,
+                              TEST_KIT,
+                              GOGGLES)
 
 from covidcaremap.data import (processed_data_path,
                                external_data_path,
@@ -58,3 +66,105 @@ class PPETest(unittest.TestCase):
         self.assertEqual(set(result.keys()), set(expected.keys()))
         for k in result.keys():
             self.assertEqual(result[k], expected[k], msg='Failed with {}'.format(k))
+
+    def test_batch_burn_matches_per_day_burn(self):
+        rng = np.random.RandomState(0)
+        new_hospitalized = np.concatenate([[0, 1, 15, 30], rng.gamma(1, 30, size=200)])
+        new_icu = np.concatenate([[0, 1, 2, 10], rng.gamma(1, 10, size=200)])
+        new_triaged = rng.gamma(1, 300, size=len(new_icu))
+
+        ppes = [N95, GOWN, DROPLET_MASK, GLOVES, WIPES, TEST_KIT, GOGGLES]
+        for triaged in [None, new_triaged]:
+            result = calculate_ppe_burn(new_hospitalized, new_icu,
+                                        new_triaged=triaged, ppes=ppes)
+            for i in range(len(new_icu)):
+                expected = calculate_ppe_burn_for_day(
+                    new_hospitalized[i], new_icu[i],
+                    new_triaged=None if triaged is None else triaged[i],
+                    ppes=ppes)
+                self.assertEqual(list(result[i]), [expected[ppe] for ppe in ppes])
+
+        # Patients in care default to the new patients.
+        np.testing.assert_array_equal(
+            calculate_ppe_burn(new_hospitalized, new_icu, ppes=ppes,
+                               in_hospital=new_hospitalized, in_icu=new_icu),
+            calculate_ppe_burn(new_hospitalized, new_icu, ppes=ppes))
+
+    def test_supply_model_arrays_index_by_name(self):
+        model = SupplyModelArrays(SUPPLY_MODEL_PER_STAGE)
+        icu = SUPPLY_MODEL_PER_STAGE[ICU]
+        self.assertEqual(model.per_patient[model.stage_index[ICU], model.supply_index[N95]],
+                         icu.per_patient.counts.get(N95, 0))
+
+        # Reordered stages and supplies give the same burn.
+        reordered = SupplyModelArrays(SUPPLY_MODEL_PER_STAGE,
+                                      stages=[ICU, TRIAGE, HOSPITALIZED],
+                                      supplies=list(reversed(model.supplies)))
+        ppes = [N95, GOWN, GLOVES, GOGGLES]
+        np.testing.assert_array_equal(
+            calculate_ppe_burn([3, 20], [1, 7], ppes=ppes, model=model),
+            calculate_ppe_burn([3, 20], [1, 7], ppes=ppes, model=reordered))
+
+        with self.assertRaises(Exception):
+            calculate_ppe_burn([3], [1], ppes=['face_shield'], model=model)
+
+        with self.assertRaises(Exception):
+            SupplyModelArrays(SUPPLY_MODEL_PER_STAGE, supplies=[N95, GOWN])
+
+        extra_stage = dict(SUPPLY_MODEL_PER_STAGE)
+        extra_stage['outpatient'] = CareStageSupplyModel(per_patient=SupplyCounts({N95: 1}),
+                                                         per_staff={})
+        with self.assertRaises(Exception):
+            SupplyModelArrays(extra_stage)
+
+    def test_projection_accumulates_per_region(self):
+        rng = np.random.RandomState(0)
+        days = pd.date_range('2020-04-01', periods=10)
+        df = pd.DataFrame({
+            'location_name': np.repeat(['A', 'B'], len(days)),
+            'date': np.tile(days, 2)
+        })
+        for band in ['lower', 'mean', 'upper']:
+            df['admis_{}'.format(band)] = rng.gamma(1, 30, size=len(df))
+            df['newICU_{}'.format(band)] = rng.gamma(1, 10, size=len(df))
+            df['allbed_{}'.format(band)] = rng.gamma(1, 200, size=len(df))
+            df['ICUbed_{}'.format(band)] = rng.gamma(1, 60, size=len(df))
+
+        # Row order of the input should not matter.
+        result = project_ppe_burn_from_ihme(df.iloc[::-1])
+        self.assertEqual(list(result['location_name']), list(df['location_name']))
+
+        ppes = [N95, GOWN, GLOVES]
+        for i in [0, 13]:
+            expected = calculate_ppe_burn([df['admis_upper'][i]], [df['newICU_upper'][i]],
+                                          ppes=ppes,
+                                          in_hospital=[df['allbed_upper'][i]],
+                                          in_icu=[df['ICUbed_upper'][i]])[0]
+            self.assertEqual([result['{}_upper'.format(ppe)][i] for ppe in ppes],
+                             list(expected))
+
+        b = result[result['location_name'] == 'B']
+        self.assertEqual(list(b['gloves_cumulative_mean']), list(b['gloves_mean'].cumsum()))
+        self.assertEqual(list(b['goggles_inventory_mean']), list(b['goggles_mean'].cummax()))
+        self.assertEqual(b['goggles_acquired_mean'].sum(), b['goggles_mean'].max())
+        self.assertNotIn('goggles_cumulative_mean', result.columns)
+
+    def test_chime_projection_staffs_to_census(self):
+        predictions = pd.DataFrame({
+            'Region': ['A'] * 3,
+            'day': [0, 1, 2],
+            'hospitalized_admitted': [10.0, 12.0, 0.0],
+            'icu_admitted': [3.0, 4.0, 0.0],
+            'hospitalized_census': [10.0, 22.0, 22.0],
+            'icu_census': [3.0, 7.0, 7.0]
+        })
+        result = project_ppe_burn_from_chime(predictions, 'Region', ppes=[N95, GOWN])
+        expected = calculate_ppe_burn(predictions['hospitalized_admitted'],
+                                      predictions['icu_admitted'],
+                                      ppes=[N95, GOWN],
+                                      in_hospital=predictions['hospitalized_census'],
+                                      in_icu=predictions['icu_census'])
+        np.testing.assert_array_equal(result[['n95_mean', 'gown_mean']].values, expected)
+
+        # Patients still in care keep using staff PPE on a day without admissions.
+        self.assertGreater(result['gown_mean'][2], 0)